@@ -0,0 +1,190 @@
+"""
+Opt-in per-request performance instrumentation.
+
+PerformanceMiddleware is enabled with PERF_INSTRUMENTATION=True. For every
+request it records wall time, database query count and time (through
+connection.execute_wrapper), response rendering time, response size and any
+named span() blocks the code ran. The numbers go out as a Server-Timing
+header and as one JSON log line on the "backend.performance" logger.
+
+A sampled share of requests (PERF_PROFILE_SAMPLE_RATE) runs under cProfile
+and the profile is dumped to PERF_PROFILE_DIR when the request was slower
+than PERF_SLOW_REQUEST_MS. Requests that run the same SQL shape more than
+PERF_N_PLUS_ONE_THRESHOLD times log a warning.
+"""
+import cProfile
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger("backend.performance")
+
+_current = ContextVar("request_metrics", default=None)
+
+_SQL_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"%s"), "?"),
+    (re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)"), "(...)"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize_sql(sql):
+    """
+    Reduces a statement to its shape: literals and parameters become "?"
+    and IN lists collapse, so the same query with other ids compares equal
+    """
+    for pattern, replacement in _SQL_LITERALS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.shapes = Counter()
+        self.spans = defaultdict(float)
+        self.render_ms = None
+        self._render_started = None
+
+    def __call__(self, execute, sql, params, many, context):
+        # execute_wrapper hook
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_ms += (time.perf_counter() - started) * 1000
+            self.queries += 1
+            self.shapes[normalize_sql(sql)] += 1
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def server_timing(self, total_ms):
+        entries = [
+            f"total;dur={total_ms:.1f}",
+            f'db;dur={self.db_ms:.1f};desc="{self.queries} queries"',
+        ]
+        if self.render_ms is not None:
+            entries.append(f"serialize;dur={self.render_ms:.1f}")
+        entries.extend(f"{name};dur={ms:.1f}" for name, ms in self.spans.items())
+        return ", ".join(entries)
+
+
+def current_metrics():
+    return _current.get()
+
+
+@contextmanager
+def span(name):
+    """
+    Times a named block for the current request's Server-Timing header.
+    Does nothing when no instrumented request is running.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.spans[name] += (time.perf_counter() - started) * 1000
+
+
+class PerformanceMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, "PERF_INSTRUMENTATION", False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.slow_ms = settings.PERF_SLOW_REQUEST_MS
+        self.sample_rate = settings.PERF_PROFILE_SAMPLE_RATE
+        self.profile_dir = Path(settings.PERF_PROFILE_DIR)
+        self.n_plus_one_threshold = settings.PERF_N_PLUS_ONE_THRESHOLD
+
+    def __call__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        profiler = cProfile.Profile() if random.random() < self.sample_rate else None
+
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(metrics))
+                if profiler:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler:
+                        profiler.disable()
+        finally:
+            _current.reset(token)
+
+        total_ms = metrics.elapsed_ms()
+        response["Server-Timing"] = metrics.server_timing(total_ms)
+        self.report(request, response, metrics, total_ms)
+        if profiler and total_ms >= self.slow_ms:
+            self.dump_profile(request, profiler)
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses render after the view returns; time that step
+        metrics = _current.get()
+        if metrics is not None:
+            metrics._render_started = time.perf_counter()
+
+            def rendered(response):
+                metrics.render_ms = (time.perf_counter() - metrics._render_started) * 1000
+
+            response.add_post_render_callback(rendered)
+        return response
+
+    def get_view_name(self, request):
+        match = getattr(request, "resolver_match", None)
+        return match.view_name if match else None
+
+    def report(self, request, response, metrics, total_ms):
+        view = self.get_view_name(request)
+        record = {
+            "method": request.method,
+            "path": request.path,
+            "view": view,
+            "status": response.status_code,
+            "wall_ms": round(total_ms, 2),
+            "queries": metrics.queries,
+            "db_ms": round(metrics.db_ms, 2),
+            "serialize_ms": round(metrics.render_ms, 2) if metrics.render_ms is not None else None,
+            "response_bytes": None if response.streaming else len(response.content),
+            "spans": {name: round(ms, 2) for name, ms in metrics.spans.items()},
+        }
+        logger.info(json.dumps(record))
+
+        for shape, count in metrics.shapes.items():
+            if count > self.n_plus_one_threshold:
+                logger.warning(json.dumps({
+                    "n_plus_one": shape,
+                    "count": count,
+                    "view": view,
+                    "path": request.path,
+                }))
+
+    def dump_profile(self, request, profiler):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        name = re.sub(r"[^\w]+", "_", request.path).strip("_") or "root"
+        path = self.profile_dir / f"{time.strftime('%Y%m%d-%H%M%S')}-{request.method}-{name}.prof"
+        profiler.dump_stats(path)
+        logger.info(json.dumps({"profile": str(path), "path": request.path}))
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 from pathlib import Path
 import os
 import dj_database_url
+from corsheaders.defaults import default_headers
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -45,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'backend.instrumentation.PerformanceMiddleware',
     "corsheaders.middleware.CorsMiddleware",
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
@@ -57,6 +59,8 @@ MIDDLEWARE = [
 ]
 
 CORS_ALLOWED_ORIGINS = os.environ.get('CORS_ALLOWED_ORIGINS', 'http://localhost:3000').split(',')
+CORS_ALLOW_HEADERS = (*default_headers, 'if-none-match')
+CORS_EXPOSE_HEADERS = ['ETag', 'Last-Modified', 'Server-Timing']
 ROOT_URLCONF = 'backend.urls'
 
 TEMPLATES = [
@@ -88,6 +92,88 @@ DATABASES = {
 }
 
 
+# Django REST framework
+# https://www.django-rest-framework.org/api-guide/settings/
+
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'medications.pagination.IdCursorPagination',
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+# The "timeline" cache holds per-patient timelines (see medications/cache.py).
+# It defaults to locmem; set TIMELINE_CACHE_BACKEND to "file" or "db" when
+# several workers need to share it ("db" needs `manage.py createcachetable`).
+
+TIMELINE_CACHE_BACKEND = os.environ.get('TIMELINE_CACHE_BACKEND', 'locmem')
+TIMELINE_CACHE_TIMEOUT = int(os.environ.get('TIMELINE_CACHE_TIMEOUT', 60 * 60 * 24))
+
+_TIMELINE_CACHES = {
+    'locmem': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'timeline',
+    },
+    'file': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('TIMELINE_CACHE_LOCATION', str(BASE_DIR / '.timeline_cache')),
+    },
+    'db': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'timeline_cache',
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'timeline': {
+        **_TIMELINE_CACHES[TIMELINE_CACHE_BACKEND],
+        'TIMEOUT': TIMELINE_CACHE_TIMEOUT,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+
+# Point-in-time timelines (see medications/history.py): a patient's state is
+# snapshotted every TIMELINE_SNAPSHOT_INTERVAL logged changes.
+
+TIMELINE_SNAPSHOT_INTERVAL = int(os.environ.get('TIMELINE_SNAPSHOT_INTERVAL', 50))
+
+
+# Timeline change feed (see medications/events.py): the pub/sub broker behind
+# /api/patients/<id>/events/. The in-process default only reaches clients
+# connected to the same worker process.
+
+TIMELINE_EVENTS_BACKEND = os.environ.get(
+    'TIMELINE_EVENTS_BACKEND', 'medications.events.InProcessBroker'
+)
+
+
+# Performance instrumentation (see backend/instrumentation.py)
+# Off unless PERF_INSTRUMENTATION=True. Adds a Server-Timing header and a JSON
+# log line per request; PERF_PROFILE_SAMPLE_RATE of requests run under cProfile
+# and are dumped to PERF_PROFILE_DIR when slower than PERF_SLOW_REQUEST_MS.
+
+PERF_INSTRUMENTATION = os.environ.get('PERF_INSTRUMENTATION', 'False') == 'True'
+PERF_SLOW_REQUEST_MS = float(os.environ.get('PERF_SLOW_REQUEST_MS', 500))
+PERF_PROFILE_SAMPLE_RATE = float(os.environ.get('PERF_PROFILE_SAMPLE_RATE', 0))
+PERF_PROFILE_DIR = os.environ.get('PERF_PROFILE_DIR', str(BASE_DIR / 'profiles'))
+PERF_N_PLUS_ONE_THRESHOLD = int(os.environ.get('PERF_N_PLUS_ONE_THRESHOLD', 10))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'backend.performance': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
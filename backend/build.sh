@@ -6,5 +6,7 @@ pip install -r requirements.txt
 
 python manage.py collectstatic --no-input
 python manage.py migrate
+python manage.py rebuild_timeline_projection --missing
+python manage.py createcachetable
 python manage.py create_superuser
 python manage.py seed_data
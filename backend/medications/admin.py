@@ -38,10 +38,12 @@ class PrescriptionAdmin(admin.ModelAdmin):
         "patient",
         "medication",
         "start_date",
+        "end_date",
         "source_facility",
         "contributor",
     )
     list_filter = ("medication", "source_facility")
+    readonly_fields = ("total_duration", "end_date")
     search_fields = ("medication__name", "patient__name")
     inlines = [DosageScheduleInline]
 
@@ -0,0 +1,171 @@
+"""
+Benchmarks for the timeline service and the endpoints built on it.
+
+Each size preset generates a synthetic dataset inside a transaction that
+is rolled back afterwards, then times every case: wall time over a number
+of repeats, plus query count and peak Python memory (tracemalloc) from one
+extra instrumented run. Results can be saved as JSON and compared against
+a stored baseline to flag regressions.
+"""
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .lean import prescription_rows, render_prescriptions
+from .models import Prescription
+from .serializer import PrescriptionSerializer
+from .services import build_timeline_items, get_timeline_queryset, get_truncated_prescriptions
+from .synthetic import generate_dataset
+
+# name: (patients, prescriptions per patient)
+SIZES = {
+    "tiny": (1, 10),
+    "small": (1, 1_000),
+    "medium": (1, 10_000),
+    "large": (1, 50_000),
+    "population": (100_000, 10),
+}
+DEFAULT_SIZES = ("tiny", "small")
+
+# Endpoints are measured without the timeline cache so every request
+# runs the full computation
+BENCHMARK_SETTINGS = {
+    "ALLOWED_HOSTS": ["*"],
+    "CACHES": {
+        **settings.CACHES,
+        "timeline": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+    },
+}
+
+
+def measure(fn, repeat):
+    """
+    Times fn() repeat times, then runs it once more under tracemalloc and
+    query capture
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "wall_ms": round(statistics.median(timings), 3),
+        "wall_ms_min": round(min(timings), 3),
+        "queries": len(queries),
+        "peak_kib": round(peak / 1024, 1),
+    }
+
+
+def get_cases(patient_id):
+    client = Client()
+
+    def prescriptions():
+        return list(get_timeline_queryset(patient_id=patient_id))
+
+    def all_prescriptions():
+        return Prescription.objects.filter(patient_id=patient_id).order_by("id")
+
+    def serialized():
+        queryset = all_prescriptions().select_related("patient", "medication", "source_facility")
+        return PrescriptionSerializer(queryset.prefetch_related("dosageschedule_set"), many=True).data
+
+    def get(path):
+        def request():
+            response = client.get(path)
+            assert response.status_code == 200, response.status_code
+        return request
+
+    return {
+        "get_truncated_prescriptions": lambda: get_truncated_prescriptions(prescriptions()),
+        "build_timeline_items": lambda: build_timeline_items(prescriptions()),
+        "timeline_endpoint": get(f"/api/patients/{patient_id}/timeline/"),
+        "undated_medications_endpoint": get(f"/api/patients/{patient_id}/undated_medications/"),
+        # The same payload through DRF's serializers and through medications.lean
+        "prescription_serializer": serialized,
+        "lean_prescriptions": lambda: render_prescriptions(prescription_rows(all_prescriptions())),
+    }
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, repeat=5, cases=None, log=None):
+    """
+    Returns {"meta": {...}, "results": {size: {case: measurements}}}
+    """
+    results = {}
+    with override_settings(**BENCHMARK_SETTINGS):
+        for size in sizes:
+            patients, per_patient = SIZES[size]
+            with transaction.atomic():
+                dataset = generate_dataset(patients, per_patient)
+                if log:
+                    log(f"{size}: generated {dataset.prescriptions} prescriptions "
+                        f"in {dataset.elapsed:.1f}s")
+
+                results[size] = {}
+                for name, fn in get_cases(dataset.patient_ids[0]).items():
+                    if cases and name not in cases:
+                        continue
+                    results[size][name] = measure(fn, repeat)
+                    if log:
+                        log(f"{size} / {name}: {results[size][name]}")
+                transaction.set_rollback(True)
+
+    return {
+        "meta": {
+            "created_at": timezone.now().isoformat(),
+            "python": platform.python_version(),
+            "database": connection.vendor,
+            "repeat": repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(results, baseline, tolerance=0.25):
+    """
+    Lists the cases that got slower than baseline * (1 + tolerance) or
+    started running more queries. Cases missing from either side are
+    skipped.
+    """
+    regressions = []
+    for size, cases in results["results"].items():
+        for name, current in cases.items():
+            previous = baseline.get("results", {}).get(size, {}).get(name)
+            if not previous:
+                continue
+            if current["wall_ms"] > previous["wall_ms"] * (1 + tolerance):
+                regressions.append(
+                    f"{size} / {name}: {current['wall_ms']}ms vs {previous['wall_ms']}ms baseline"
+                )
+            if current["queries"] > previous["queries"]:
+                regressions.append(
+                    f"{size} / {name}: {current['queries']} queries vs {previous['queries']} baseline"
+                )
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+        f.write("\n")
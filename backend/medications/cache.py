@@ -0,0 +1,135 @@
+"""
+Per-patient timeline cache.
+
+Entries are keyed by patient id and Patient.timeline_version, so a write
+only has to bump the version; stale entries are never read again and age
+out of the backend on their own. The backend is the "timeline" alias in
+settings.CACHES (locmem by default, file or database in production).
+"""
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db.models import F
+from django.utils import timezone
+from .models import Patient
+
+CACHE_ALIAS = "timeline"
+STATS_KEYS = {"hits": "timeline:stats:hits", "misses": "timeline:stats:misses"}
+
+
+def get_key(patient, variant):
+    return f"timeline:{patient.pk}:{patient.timeline_version}:{variant}"
+
+
+def get_etag(patient, variant):
+    """
+    Strong ETag for a cached variant; changes whenever the version does
+    """
+    digest = hashlib.md5(variant.encode()).hexdigest()[:12]
+    return f'"{patient.pk}-{patient.timeline_version}-{digest}"'
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def bump_timeline_version(patient_ids):
+    """
+    Invalidates the cached timelines of the given patients. Accepts ids or
+    a values("patient_id") subquery.
+    """
+    if isinstance(patient_ids, (set, list, tuple)):
+        patient_ids = {pid for pid in patient_ids if pid}
+        if not patient_ids:
+            return 0
+    return Patient.objects.filter(pk__in=patient_ids).update(
+        timeline_version=F("timeline_version") + 1,
+        timeline_modified_at=timezone.now(),
+    )
+
+
+def _count(stat, delta=1):
+    if not delta:
+        return
+    cache = get_cache()
+    key = STATS_KEYS[stat]
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # Evicted between add() and incr(); losing one count is fine
+        pass
+
+
+def get_cached(patient, variant, compute):
+    """
+    Returns the cached value for (patient, version, variant), calling
+    compute() and storing its result on a miss
+    """
+    cache = get_cache()
+    key = get_key(patient, variant)
+    value = cache.get(key)
+    if value is not None:
+        _count("hits")
+        return value
+
+    _count("misses")
+    value = compute()
+    cache.set(key, value)
+    return value
+
+
+async def aget_cached(patient, variant, compute):
+    """
+    Async form of get_cached(); compute is a coroutine function
+    """
+    cache = get_cache()
+    key = get_key(patient, variant)
+    value = await cache.aget(key)
+    if value is not None:
+        await sync_to_async(_count)("hits")
+        return value
+
+    await sync_to_async(_count)("misses")
+    value = await compute()
+    await cache.aset(key, value)
+    return value
+
+
+def get_many_cached(patients, variant, compute_many):
+    """
+    Batch form of get_cached(). compute_many(missing_patients) is called
+    once for every patient that missed and must return a dict keyed by
+    patient id.
+
+    Returns:
+        dict[patient_id] = value
+    """
+    cache = get_cache()
+    keys = {get_key(patient, variant): patient for patient in patients}
+    found = cache.get_many(list(keys))
+    values = {keys[key].pk: value for key, value in found.items()}
+
+    missing = [patient for key, patient in keys.items() if key not in found]
+    _count("hits", len(found))
+    _count("misses", len(missing))
+    if missing:
+        computed = compute_many(missing)
+        cache.set_many({
+            get_key(patient, variant): computed[patient.pk] for patient in missing
+        })
+        values.update(computed)
+    return values
+
+
+def get_stats():
+    cache = get_cache()
+    stats = {stat: cache.get(key, 0) for stat, key in STATS_KEYS.items()}
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = stats["hits"] / lookups if lookups else None
+    return stats
+
+
+def reset_stats():
+    get_cache().delete_many(list(STATS_KEYS.values()))
@@ -0,0 +1,49 @@
+"""
+Population queries over the persisted timeline (TimelineItem): who is on
+a medication on a given day, and how many patients are on it per day.
+
+A course is active from its start_date up to, not including, its
+(truncated) end_date, as in the dose calendars. Truncation never lets
+two courses of one patient and medication overlap, so counting rows
+counts patients. Both queries are range scans of the
+(medication, end_date, start_date) index: recent days only touch the
+courses that end after them.
+"""
+import numpy as np
+
+from .models import Patient, TimelineItem
+
+
+def active_items(medication_id, on):
+    return TimelineItem.objects.filter(
+        medication_id=medication_id, end_date__gt=on, start_date__lte=on
+    )
+
+
+def active_patients(medication_id, on):
+    """
+    Patients with a course of the medication active on that day
+    """
+    return Patient.objects.filter(pk__in=active_items(medication_id, on).values("patient_id"))
+
+
+def count_active_per_day(medication_id, date_from, date_to):
+    """
+    Returns:
+        list with the number of patients on the medication for each day
+        from date_from to date_to (inclusive)
+    """
+    days = (date_to - date_from).days + 1
+    rows = TimelineItem.objects.filter(
+        medication_id=medication_id, end_date__gt=date_from, start_date__lte=date_to
+    ).values_list("start_date", "end_date")
+
+    starts, ends = [], []
+    for start, end in rows.iterator(chunk_size=10000):
+        starts.append((start - date_from).days)
+        ends.append((end - date_from).days)
+
+    counts = np.zeros(days + 1, dtype=np.int64)
+    np.add.at(counts, np.clip(np.asarray(starts, dtype=np.int64), 0, days), 1)
+    np.add.at(counts, np.clip(np.asarray(ends, dtype=np.int64), 0, days), -1)
+    return np.cumsum(counts)[:days].tolist()
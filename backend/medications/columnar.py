@@ -0,0 +1,132 @@
+"""
+Compact columnar encoding of timeline items.
+
+Instead of a list of dicts repeating every key, the medication name and
+full date strings, items become one array per field:
+
+    {
+        "format": "columnar",
+        "count": 2,
+        "base_date": "2025-01-01",
+        "medications": ["Aspirin", ...],
+        "strings": ["", "100mg", ...],
+        "items": {"id": [...], "medication": [...], "start": [...], ...},
+        "dosages": {"item": [...], "dose": [...], "start": [...], ...},
+    }
+
+Dates are day offsets from base_date, medications index the medications
+table and the other text columns index the strings table. Dosage rows
+point at their item's position through "item". Columns that no item has
+(lane) are left out.
+"""
+from datetime import date
+
+FORMAT = "columnar"
+
+# Output column: item key
+ITEM_DATES = {"start": "start_date", "end": "end_date", "natural_end": "natural_end_date"}
+DOSAGE_DATES = {"start": "start_date", "end": "end_date"}
+DOSAGE_STRINGS = ("dose", "frequency", "route", "duration", "dose_unit")
+DOSAGE_NUMBERS = ("dose_amount", "doses_per_day", "daily_amount")
+
+
+def _as_date(value):
+    # Items read back from the projection carry dosage dates as strings
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+
+class _Table:
+    def __init__(self):
+        self.index = {}
+
+    def __call__(self, value):
+        if value is None:
+            return None
+        return self.index.setdefault(value, len(self.index))
+
+    def values(self):
+        return list(self.index)
+
+
+def encode_timeline(items, lane_count=None):
+    """
+    Encodes build_timeline_items() / read_timeline() output
+    """
+    starts = [_as_date(item["start_date"]) for item in items]
+    base = min(starts, default=None)
+
+    def day(value):
+        value = _as_date(value)
+        return None if value is None else (value - base).days
+
+    medications, strings = _Table(), _Table()
+    columns = {
+        "id": [item["id"] for item in items],
+        "medication": [medications(item["medication"]) for item in items],
+        **{column: [day(item[key]) for item in items] for column, key in ITEM_DATES.items()},
+        "is_truncated": [int(item["is_truncated"]) for item in items],
+        "notes": [strings(item["notes"]) for item in items],
+    }
+    if items and all("lane" in item for item in items):
+        columns["lane"] = [item["lane"] for item in items]
+
+    rows = [(position, d) for position, item in enumerate(items) for d in item["dosages"]]
+    dosages = {
+        "item": [position for position, _ in rows],
+        **{column: [day(d[key]) for _, d in rows] for column, key in DOSAGE_DATES.items()},
+        **{key: [strings(d[key]) for _, d in rows] for key in DOSAGE_STRINGS},
+        **{key: [d[key] for _, d in rows] for key in DOSAGE_NUMBERS},
+    }
+
+    payload = {
+        "format": FORMAT,
+        "count": len(items),
+        "base_date": base.isoformat() if base else None,
+        "medications": medications.values(),
+        "strings": strings.values(),
+        "items": columns,
+        "dosages": dosages,
+    }
+    if lane_count is not None:
+        payload["lane_count"] = lane_count
+    return payload
+
+
+def decode_timeline(payload):
+    """
+    The items encode_timeline() was given, with dates as ISO strings
+    """
+    base = date.fromisoformat(payload["base_date"]) if payload["base_date"] else None
+    medications, strings = payload["medications"], payload["strings"]
+    columns, dosages = payload["items"], payload["dosages"]
+
+    def day(offset):
+        return None if offset is None else date.fromordinal(base.toordinal() + offset).isoformat()
+
+    def text(index):
+        return None if index is None else strings[index]
+
+    items = []
+    for i in range(payload["count"]):
+        item = {
+            "id": columns["id"][i],
+            "medication": medications[columns["medication"][i]],
+            **{key: day(columns[column][i]) for column, key in ITEM_DATES.items()},
+            "is_truncated": bool(columns["is_truncated"][i]),
+            "dosages": [],
+            "notes": text(columns["notes"][i]),
+        }
+        if "lane" in columns:
+            item["lane"] = columns["lane"][i]
+        items.append(item)
+
+    for row, position in enumerate(dosages["item"]):
+        items[position]["dosages"].append({
+            **{key: text(dosages[key][row]) for key in DOSAGE_STRINGS[:4]},
+            **{key: day(dosages[column][row]) for column, key in DOSAGE_DATES.items()},
+            "dose_amount": dosages["dose_amount"][row],
+            "dose_unit": text(dosages["dose_unit"][row]),
+            "doses_per_day": dosages["doses_per_day"][row],
+            "daily_amount": dosages["daily_amount"][row],
+        })
+    return items
@@ -0,0 +1,97 @@
+"""
+Conflict checks over a patient's dated prescriptions, built on IntervalIndex.
+
+- same_medication_overlap: two courses of one medication whose natural
+  spans overlap, so the later one overrides (truncates) the earlier one
+- duplicate_route_overlap: dosage segments of different medications given
+  by the same route at the same time
+- multi_segment_overlap: days on which more than max_concurrent
+  medications are active at once
+"""
+from collections import defaultdict
+
+from .intervals import Interval, IntervalIndex
+from .services import compute_prescription_spans, get_schedule_segments
+
+MAX_CONCURRENT_MEDICATIONS = 5
+
+
+def same_medication_overlaps(prescriptions):
+    by_medication = defaultdict(list)
+    for p in prescriptions:
+        by_medication[p.medication_id].append(Interval(p.start_date, p.end_date, p.id, p))
+
+    conflicts = []
+    for intervals in by_medication.values():
+        index = IntervalIndex(intervals)
+        for interval in index:
+            for other in index.overlapping(interval.start, interval.end):
+                if (other.start, other.key) <= (interval.start, interval.key):
+                    continue
+                conflicts.append({
+                    "type": "same_medication_overlap",
+                    "medication": interval.data.medication.name,
+                    "prescriptions": [interval.key, other.key],
+                    "start_date": other.start,
+                    "end_date": min(interval.end, other.end),
+                })
+    return conflicts
+
+
+def duplicate_route_overlaps(index):
+    conflicts = []
+    for segment in index:
+        schedule = segment.data
+        if not schedule.route:
+            continue
+        for other in index.overlapping(segment.start, segment.end):
+            if other.key <= segment.key or other.data.route != schedule.route:
+                continue
+            first, second = segment.data.prescription, other.data.prescription
+            if first.medication_id == second.medication_id:
+                continue
+            conflicts.append({
+                "type": "duplicate_route_overlap",
+                "route": schedule.route,
+                "medications": [first.medication.name, second.medication.name],
+                "prescriptions": [first.id, second.id],
+                "start_date": max(segment.start, other.start),
+                "end_date": min(segment.end, other.end),
+            })
+    return conflicts
+
+
+def multi_segment_overlaps(index, max_concurrent):
+    # The set of active segments only changes where a segment starts
+    conflicts = []
+    for day in sorted({segment.start for segment in index}):
+        active = index.stabbing(day)
+        medications = {s.data.prescription.medication_id for s in active}
+        if len(medications) <= max_concurrent:
+            continue
+        conflicts.append({
+            "type": "multi_segment_overlap",
+            "date": day,
+            "medication_count": len(medications),
+            "prescriptions": sorted({s.data.prescription.id for s in active}),
+        })
+    return conflicts
+
+
+def find_conflicts(prescriptions, max_concurrent=MAX_CONCURRENT_MEDICATIONS):
+    """
+    Runs every check over the patient's prescriptions. Pass them with
+    medication selected and dosageschedule_set prefetched.
+    """
+    prescriptions = [p for p in prescriptions if p.start_date]
+    spans = compute_prescription_spans(prescriptions)
+
+    index = IntervalIndex(
+        segment for p in prescriptions for segment in get_schedule_segments(p, spans[p.id])
+    )
+
+    return [
+        *same_medication_overlaps(prescriptions),
+        *duplicate_route_overlaps(index),
+        *multi_segment_overlaps(index, max_concurrent),
+    ]
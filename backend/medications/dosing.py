@@ -0,0 +1,105 @@
+"""
+Parses the free-text dose and frequency of a DosageSchedule into numbers.
+
+parse_dose("100mg") -> (100.0, "mg"); mass units are normalized to mg so
+amounts of one medication add up. parse_frequency("twice daily") -> 2.0
+doses per day; "as needed" and anything unrecognized give None. Both are
+memoized since the same few strings repeat across most rows.
+"""
+import re
+from functools import lru_cache
+
+# Factor to the normalized unit
+DOSE_UNITS = {
+    "g": ("mg", 1000.0),
+    "gram": ("mg", 1000.0),
+    "grams": ("mg", 1000.0),
+    "mg": ("mg", 1.0),
+    "mcg": ("mg", 0.001),
+    "µg": ("mg", 0.001),
+    "ug": ("mg", 0.001),
+    "ml": ("ml", 1.0),
+    "l": ("ml", 1000.0),
+    "iu": ("unit", 1.0),
+    "unit": ("unit", 1.0),
+    "units": ("unit", 1.0),
+    "tablet": ("tablet", 1.0),
+    "tablets": ("tablet", 1.0),
+    "tab": ("tablet", 1.0),
+    "tabs": ("tablet", 1.0),
+    "capsule": ("capsule", 1.0),
+    "capsules": ("capsule", 1.0),
+    "cap": ("capsule", 1.0),
+    "caps": ("capsule", 1.0),
+    "puff": ("puff", 1.0),
+    "puffs": ("puff", 1.0),
+    "drop": ("drop", 1.0),
+    "drops": ("drop", 1.0),
+}
+
+_DOSE = re.compile(r"^\s*(\d+(?:[.,]\d+)?)\s*([a-zµ]+)?\b", re.IGNORECASE)
+
+_WORD_COUNTS = {
+    "once": 1, "one": 1, "every": 1, "each": 1, "twice": 2, "two": 2, "thrice": 3, "three": 3,
+    "four": 4, "five": 5, "six": 6,
+}
+_ABBREVIATIONS = {
+    "qd": 1.0, "od": 1.0, "daily": 1.0, "bid": 2.0, "bd": 2.0,
+    "tid": 3.0, "tds": 3.0, "qid": 4.0, "qds": 4.0,
+    "nightly": 1.0, "bedtime": 1.0, "weekly": 1 / 7, "qod": 0.5,
+}
+_AS_NEEDED = re.compile(r"\b(as needed|prn|when required|if needed)\b", re.IGNORECASE)
+_EVERY_HOURS = re.compile(r"\b(?:every|q)\s*(\d+(?:\.\d+)?)\s*(?:h|hr|hrs|hour|hours)\b", re.IGNORECASE)
+_TIMES_PER = re.compile(
+    r"\b(\d+|[a-z]+)\s*(?:x|times?)?\s*(?:a|per|/)?\s*(day|daily|week|weekly)\b", re.IGNORECASE
+)
+
+
+@lru_cache(maxsize=4096)
+def parse_dose(text):
+    """
+    Returns (amount, unit) or (None, "") when the dose can't be read
+    """
+    match = _DOSE.match(text or "")
+    if not match:
+        return None, ""
+    amount = float(match.group(1).replace(",", "."))
+    unit = (match.group(2) or "").lower()
+    if not unit:
+        return amount, ""
+    if unit not in DOSE_UNITS:
+        return None, ""
+    unit, factor = DOSE_UNITS[unit]
+    return amount * factor, unit
+
+
+@lru_cache(maxsize=4096)
+def parse_frequency(text):
+    """
+    Returns the number of doses per day, or None for as-needed and
+    unrecognized frequencies
+    """
+    text = (text or "").strip().lower()
+    if not text or _AS_NEEDED.search(text):
+        return None
+    if text in _ABBREVIATIONS:
+        return _ABBREVIATIONS[text]
+    if "every other day" in text:
+        return 0.5
+
+    match = _EVERY_HOURS.search(text)
+    if match:
+        hours = float(match.group(1))
+        return 24 / hours if hours else None
+
+    match = _TIMES_PER.search(text)
+    if match:
+        count, period = match.groups()
+        count = int(count) if count.isdigit() else _WORD_COUNTS.get(count)
+        if count is not None:
+            return count / 7 if period.startswith("week") else float(count)
+
+    for word in text.split():
+        if word in _ABBREVIATIONS:
+            return _ABBREVIATIONS[word]
+    return None
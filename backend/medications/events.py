@@ -0,0 +1,92 @@
+"""
+Timeline change feed: per-patient pub/sub behind the SSE endpoint.
+
+The timeline projection publishes a compact diff event for every item a
+write added, removed, updated or (un)truncated; bulk writes publish a
+"reset" telling clients to refetch. Events go out once the transaction
+commits.
+
+The broker is pluggable through TIMELINE_EVENTS_BACKEND (a dotted path to
+a Broker subclass). The default InProcessBroker keeps subscribers in
+memory, which is enough for a single server process and for tests; a
+multi-process deployment needs a broker backed by a shared service.
+"""
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+DEFAULT_BACKEND = "medications.events.InProcessBroker"
+
+
+class Broker:
+    def publish(self, patient_id, event):
+        raise NotImplementedError
+
+    def subscribe(self, patient_id):
+        """
+        Async context manager yielding an asyncio.Queue of the patient's
+        events
+        """
+        raise NotImplementedError
+
+    def has_subscribers(self, patient_id):
+        # Lets publishers skip building events nobody listens to
+        return True
+
+
+class InProcessBroker(Broker):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = {}  # patient id -> {queue: loop}
+
+    def publish(self, patient_id, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(patient_id, {}).items())
+        for queue, loop in subscribers:
+            # Publishers run in sync code, possibly on another thread
+            loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    @asynccontextmanager
+    async def subscribe(self, patient_id):
+        queue = asyncio.Queue()
+        with self._lock:
+            self._subscribers.setdefault(patient_id, {})[queue] = asyncio.get_running_loop()
+        try:
+            yield queue
+        finally:
+            with self._lock:
+                subscribers = self._subscribers.get(patient_id, {})
+                subscribers.pop(queue, None)
+                if not subscribers:
+                    self._subscribers.pop(patient_id, None)
+
+    def has_subscribers(self, patient_id):
+        with self._lock:
+            return bool(self._subscribers.get(patient_id))
+
+
+@lru_cache(maxsize=None)
+def _load_broker(path):
+    return import_string(path)()
+
+
+def get_broker():
+    return _load_broker(getattr(settings, "TIMELINE_EVENTS_BACKEND", DEFAULT_BACKEND))
+
+
+def publish(patient_id, event):
+    """
+    Publishes event to the patient's subscribers after the current
+    transaction commits
+    """
+    broker = get_broker()
+    transaction.on_commit(lambda: broker.publish(patient_id, event))
+
+
+def is_watched(patient_id):
+    return get_broker().has_subscribers(patient_id)
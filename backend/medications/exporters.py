@@ -0,0 +1,164 @@
+"""
+Streaming export of prescription histories as NDJSON or CSV.
+
+Rows are read with values() projections and .iterator(), ordered by
+patient, and handled one batch of whole patients at a time: one extra
+query fetches the batch's schedules and truncation is computed per patient
+with services.compute_prescription_spans. Memory use depends on the batch
+size, not on the size of the table.
+
+The output uses the same columns / keys as medications.importers, so an
+export can be imported again.
+"""
+import csv
+from collections import defaultdict
+from itertools import groupby
+from types import SimpleNamespace
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Prescription, DosageSchedule
+from .services import compute_prescription_spans
+
+PRESCRIPTION_FIELDS = {
+    "id": "id",
+    "patient_id": "patient_id",
+    "patient": "patient__name",
+    "patient_external_id": "patient__external_id",
+    "medication_id": "medication_id",
+    "medication": "medication__name",
+    "medication_external_id": "medication__external_id",
+    "facility": "source_facility__name",
+    "facility_external_id": "source_facility__external_id",
+    "start_date": "start_date",
+    "natural_end_date": "end_date",
+    "total_duration": "total_duration",
+    "notes": "notes",
+    "contributor_id": "contributor_id",
+}
+SCHEDULE_FIELDS = ("dose", "frequency", "route", "duration_days")
+CSV_COLUMNS = (
+    "prescription_ref", "patient", "patient_external_id", "medication",
+    "medication_external_id", "facility", "facility_external_id",
+    "start_date", "notes", *SCHEDULE_FIELDS, "natural_end_date",
+)
+TIMELINE_COLUMNS = ("end_date", "is_truncated")
+
+
+def duration_days(duration):
+    days = duration.total_seconds() / 86400
+    return int(days) if days.is_integer() else days
+
+
+def _batches(rows, batch_size):
+    """
+    Groups rows (ordered by patient) into batches of whole patients
+    """
+    batch = []
+    for row in rows:
+        if len(batch) >= batch_size and row["patient_id"] != batch[-1]["patient_id"]:
+            yield batch
+            batch = []
+        batch.append(row)
+    if batch:
+        yield batch
+
+
+def _add_timeline_fields(batch):
+    for _, rows in groupby(batch, key=lambda row: row["patient_id"]):
+        rows = list(rows)
+        spans = compute_prescription_spans(
+            SimpleNamespace(
+                id=row["id"],
+                medication_id=row["medication_id"],
+                start_date=row["start_date"],
+                end_date=row["natural_end_date"],
+                total_duration=row["total_duration"],
+            )
+            for row in rows
+        )
+        for row in rows:
+            span = spans.get(row["id"])
+            row["end_date"] = span.end_date if span else None
+            row["is_truncated"] = bool(span and span.cutoff)
+
+
+def iter_prescription_rows(queryset=None, include_timeline=False, batch_size=2000):
+    """
+    Yields one dict per prescription, with its dosage_schedules and, if
+    include_timeline is set, the truncated end_date and is_truncated flag
+    """
+    if queryset is None:
+        queryset = Prescription.objects.all()
+    keys = list(PRESCRIPTION_FIELDS)
+    rows = (
+        queryset.order_by("patient_id", "medication_id", "start_date", "id")
+        .values_list(*PRESCRIPTION_FIELDS.values())
+        .iterator(chunk_size=batch_size)
+    )
+    rows = (dict(zip(keys, row)) for row in rows)
+
+    for batch in _batches(rows, batch_size):
+        schedules = defaultdict(list)
+        schedule_rows = (
+            DosageSchedule.objects.filter(prescription_id__in=[row["id"] for row in batch])
+            .order_by("id")
+            .values_list("prescription_id", "dose", "frequency", "route", "duration")
+        )
+        for prescription_id, dose, frequency, route, duration in schedule_rows:
+            schedules[prescription_id].append({
+                "dose": dose,
+                "frequency": frequency,
+                "route": route,
+                "duration_days": duration_days(duration),
+            })
+
+        if include_timeline:
+            _add_timeline_fields(batch)
+        for row in batch:
+            del row["total_duration"]
+            row["dosage_schedules"] = schedules[row["id"]]
+            yield row
+
+
+def stream_ndjson(rows):
+    encoder = JSONEncoder()
+    for row in rows:
+        yield encoder.encode(row) + "\n"
+
+
+class _Echo:
+    """File-like object whose write() hands the line back to csv.writer"""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows, include_timeline=False):
+    """
+    One CSV line per dosage schedule; prescription_ref ties a prescription's
+    lines together as in the import format
+    """
+    columns = CSV_COLUMNS + (TIMELINE_COLUMNS if include_timeline else ())
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+
+    for row in rows:
+        row["prescription_ref"] = row["id"]
+        for schedule in row["dosage_schedules"] or [dict.fromkeys(SCHEDULE_FIELDS, "")]:
+            line = {**row, **schedule}
+            yield writer.writerow(
+                "" if line.get(column) is None else line[column] for column in columns
+            )
+
+
+def export_prescriptions(output_format, queryset=None, include_timeline=False, batch_size=2000):
+    """
+    Returns an iterator of text chunks in the given format ("ndjson" / "csv")
+    """
+    rows = iter_prescription_rows(queryset, include_timeline, batch_size)
+    if output_format == "csv":
+        return stream_csv(rows, include_timeline)
+    if output_format == "ndjson":
+        return stream_ndjson(rows)
+    raise ValueError(f"Unknown format {output_format!r}; expected ndjson or csv.")
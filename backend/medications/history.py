@@ -0,0 +1,218 @@
+"""
+Point-in-time timelines from an append-only change log.
+
+Every prescription write is logged as a TimelineChange holding the
+prescription's full state (schedules included) afterwards, or its
+deletion. Every TIMELINE_SNAPSHOT_INTERVAL changes a TimelineSnapshot of
+the patient's whole state is stored, so rebuilding the state as of some
+moment replays at most that many changes on top of the nearest snapshot.
+
+A patient's history starts with a baseline snapshot taken on the first
+write that reaches this module; earlier moments can't be rebuilt.
+Bulk writes (imports) take a fresh snapshot instead of logging rows.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils.dateparse import parse_date, parse_duration
+from django.utils.duration import duration_iso_string
+
+from .models import (
+    DosageSchedule,
+    Medication,
+    Prescription,
+    TimelineChange,
+    TimelineSnapshot,
+)
+
+DEFAULT_SNAPSHOT_INTERVAL = 50
+
+
+def get_snapshot_interval():
+    return getattr(settings, "TIMELINE_SNAPSHOT_INTERVAL", DEFAULT_SNAPSHOT_INTERVAL)
+
+
+def serialize_prescription(prescription):
+    """
+    The logged state of one prescription. Pass it with medication selected
+    and dosageschedule_set prefetched.
+    """
+    return {
+        "id": prescription.id,
+        "medication_id": prescription.medication_id,
+        "medication": prescription.medication.name,
+        "source_facility_id": prescription.source_facility_id,
+        "start_date": prescription.start_date.isoformat() if prescription.start_date else None,
+        "notes": prescription.notes,
+        "schedules": [
+            {
+                "id": d.id,
+                "dose": d.dose,
+                "frequency": d.frequency,
+                "route": d.route,
+                "duration": duration_iso_string(d.duration),
+                "dose_amount": d.dose_amount,
+                "dose_unit": d.dose_unit,
+                "doses_per_day": d.doses_per_day,
+            }
+            for d in sorted(prescription.dosageschedule_set.all(), key=lambda d: d.id)
+        ],
+    }
+
+
+def deserialize_prescription(patient_id, data):
+    """
+    Rebuilds an unsaved Prescription (with medication and schedules cached
+    on it) that the timeline service accepts like a loaded one
+    """
+    prescription = Prescription(
+        id=data["id"],
+        patient_id=patient_id,
+        medication=Medication(id=data["medication_id"], name=data["medication"]),
+        source_facility_id=data["source_facility_id"],
+        start_date=parse_date(data["start_date"]) if data["start_date"] else None,
+        notes=data["notes"],
+    )
+    schedules = [
+        DosageSchedule(
+            prescription_id=data["id"],
+            **{**schedule, "duration": parse_duration(schedule["duration"])},
+        )
+        for schedule in data["schedules"]
+    ]
+    prescription.total_duration = sum((d.duration for d in schedules), timedelta(0))
+    prescription.end_date = prescription.compute_end_date()
+    prescription._prefetched_objects_cache = {"dosageschedule_set": schedules}
+    return prescription
+
+
+def _state_queryset():
+    return Prescription.objects.select_related("medication").prefetch_related("dosageschedule_set")
+
+
+def take_snapshots(patient_ids):
+    """
+    Stores the current state of each patient, covering every change
+    logged so far
+    """
+    patient_ids = set(patient_ids)
+    if not patient_ids:
+        return
+    last_ids = dict(
+        TimelineChange.objects.filter(patient_id__in=patient_ids)
+        .values("patient_id")
+        .annotate(last=Max("id"))
+        .values_list("patient_id", "last")
+    )
+    states = {pid: [] for pid in patient_ids}
+    for p in _state_queryset().filter(patient_id__in=patient_ids).order_by("id"):
+        states[p.patient_id].append(serialize_prescription(p))
+
+    TimelineSnapshot.objects.bulk_create(
+        TimelineSnapshot(
+            patient_id=pid,
+            last_change_id=last_ids.get(pid, 0),
+            data={"prescriptions": prescriptions},
+        )
+        for pid, prescriptions in states.items()
+    )
+
+
+def _tracked(patient_ids):
+    """
+    The patients whose history has started (they have a baseline snapshot)
+    """
+    return set(
+        TimelineSnapshot.objects.filter(patient_id__in=patient_ids)
+        .values_list("patient_id", flat=True)
+        .distinct()
+    )
+
+
+def record_changes(saved_ids=(), deleted=()):
+    """
+    Logs the current state of the saved prescriptions and the deletion of
+    the (prescription_id, patient_id) pairs in deleted. Patients without a
+    history get their baseline snapshot instead; patients that reach the
+    snapshot interval get a new snapshot.
+    """
+    saved = list(_state_queryset().filter(pk__in={pk for pk in saved_ids if pk}))
+    deleted = [(pk, pid) for pk, pid in deleted if pk and pid]
+    patient_ids = {p.patient_id for p in saved} | {pid for _, pid in deleted}
+    if not patient_ids:
+        return
+
+    tracked = _tracked(patient_ids)
+    TimelineChange.objects.bulk_create([
+        *(
+            TimelineChange(
+                patient_id=p.patient_id,
+                prescription_id=p.id,
+                action=TimelineChange.Action.SAVE,
+                data=serialize_prescription(p),
+            )
+            for p in saved if p.patient_id in tracked
+        ),
+        *(
+            TimelineChange(patient_id=pid, prescription_id=pk, action=TimelineChange.Action.DELETE)
+            for pk, pid in deleted if pid in tracked
+        ),
+    ])
+
+    interval = get_snapshot_interval()
+    due = set()
+    for pid, last_change_id in _latest_snapshots(tracked).items():
+        pending = TimelineChange.objects.filter(patient_id=pid, id__gt=last_change_id)
+        if pending.count() >= interval:
+            due.add(pid)
+    take_snapshots((patient_ids - tracked) | due)
+
+
+def record_bulk_write(patient_ids):
+    """
+    Bulk writers don't log rows; patients with a history get a snapshot of
+    their new state instead
+    """
+    take_snapshots(_tracked(set(patient_ids)))
+
+
+def _latest_snapshots(patient_ids):
+    return dict(
+        TimelineSnapshot.objects.filter(patient_id__in=patient_ids)
+        .values("patient_id")
+        .annotate(last=Max("last_change_id"))
+        .values_list("patient_id", "last")
+    )
+
+
+def get_history_start(patient):
+    first = patient.timeline_snapshots.order_by("taken_at", "id").first()
+    return first.taken_at if first else None
+
+
+def get_prescriptions_as_of(patient, as_of):
+    """
+    The patient's prescriptions as they were at as_of, rebuilt from the
+    nearest earlier snapshot plus the changes logged after it. Returns None
+    when as_of is before the patient's history starts.
+    """
+    snapshot = (
+        patient.timeline_snapshots.filter(taken_at__lte=as_of)
+        .order_by("-taken_at", "-id")
+        .first()
+    )
+    if snapshot is None:
+        return None
+
+    state = {data["id"]: data for data in snapshot.data["prescriptions"]}
+    changes = patient.timeline_changes.filter(
+        id__gt=snapshot.last_change_id, created_at__lte=as_of
+    ).order_by("id")
+    for change in changes:
+        if change.action == TimelineChange.Action.DELETE:
+            state.pop(change.prescription_id, None)
+        else:
+            state[change.prescription_id] = change.data
+
+    return [deserialize_prescription(patient.pk, data) for data in state.values()]
@@ -0,0 +1,440 @@
+"""
+Bulk import of prescription histories.
+
+Readers turn an input file into canonical row dicts one line at a time:
+
+    {
+        "patient": "Jane Doe", "patient_external_id": "P-1",
+        "medication": "Aspirin", "medication_external_id": "",
+        "facility": "General Hospital", "facility_external_id": "GH001",
+        "start_date": "2025-01-01", "notes": "",
+        "dosage_schedules": [
+            {"dose": "100mg", "frequency": "twice daily", "route": "oral", "duration_days": 7},
+        ],
+    }
+
+duration_days may be fractional (1.5 is 36 hours), as exports write it.
+
+PrescriptionImporter resolves the referenced rows through in-memory lookup
+caches and writes prescriptions and schedules with bulk_create, one
+transaction per batch. The timelines of the patients it wrote to are
+rebuilt once, after the last batch. A bad row is reported and skipped; it
+never aborts the import.
+"""
+import csv
+import json
+import math
+import time
+from dataclasses import dataclass, field
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils.dateparse import parse_date
+
+from . import search, sync
+from .choices import Route
+from .models import Patient, Medication, Facility, Prescription, DosageSchedule
+
+LOOKUP_QUERY_SIZE = 500
+FHIR_DURATION_DAYS = {"d": 1, "wk": 7, "mo": 30, "a": 365}
+FHIR_FREQUENCY_NAMES = {1: "once daily", 2: "twice daily", 3: "three times daily", 4: "four times daily"}
+
+
+class ImportRowError(ValueError):
+    pass
+
+
+# Readers
+
+def read_ndjson(lines):
+    for line_number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_number, ImportRowError(f"Invalid JSON: {e.msg}")
+
+
+def read_csv(lines):
+    """
+    One dosage schedule per CSV row. Consecutive rows sharing a non-empty
+    prescription_ref are merged into a single prescription.
+    """
+    pending = None
+    pending_ref = None
+    reader = csv.DictReader(lines)
+
+    for row in reader:
+        line_number = reader.line_num
+        ref = (row.get("prescription_ref") or "").strip()
+        schedule = {
+            key: row.get(key, "")
+            for key in ("dose", "frequency", "route", "duration_days")
+        }
+        # A prescription without schedules is one line with empty schedule cells
+        schedules = [schedule] if any((value or "").strip() for value in schedule.values()) else []
+
+        if pending and ref and ref == pending_ref:
+            pending[1]["dosage_schedules"].extend(schedules)
+            continue
+
+        if pending:
+            yield pending
+        pending_ref = ref
+        pending = (line_number, {**row, "dosage_schedules": schedules})
+
+    if pending:
+        yield pending
+
+
+def _fhir_reference(element):
+    """
+    Returns (display, identifier) for a FHIR Reference / CodeableConcept
+    """
+    element = element or {}
+    if "concept" in element:  # R5 CodeableReference
+        element = element["concept"]
+    coding = (element.get("coding") or [{}])[0]
+    display = element.get("display") or element.get("text") or coding.get("display") or ""
+    identifier = (element.get("identifier") or {}).get("value") or coding.get("code") or ""
+    if not identifier and "/" in element.get("reference", ""):
+        identifier = element["reference"].rsplit("/", 1)[1]
+    return display, identifier
+
+
+def _fhir_schedule(dosage):
+    repeat = (dosage.get("timing") or {}).get("repeat") or {}
+
+    dose = ""
+    dose_and_rate = dosage.get("doseAndRate") or []
+    if dose_and_rate and "doseQuantity" in dose_and_rate[0]:
+        quantity = dose_and_rate[0]["doseQuantity"]
+        dose = f"{quantity.get('value', '')}{quantity.get('unit') or quantity.get('code') or ''}"
+
+    frequency = dosage.get("text", "")
+    if repeat.get("frequency"):
+        count, period, unit = repeat["frequency"], repeat.get("period", 1), repeat.get("periodUnit", "d")
+        frequency = f"{count} times per {period} {unit}"
+        if period == 1 and unit == "d":
+            frequency = FHIR_FREQUENCY_NAMES.get(count, frequency)
+
+    duration_days = ""
+    bounds = repeat.get("boundsDuration")
+    if bounds:
+        unit = bounds.get("code") or bounds.get("unit") or "d"
+        duration_days = round(bounds.get("value", 0) * FHIR_DURATION_DAYS.get(unit, 1))
+    elif repeat.get("boundsPeriod"):
+        start = parse_date((repeat["boundsPeriod"].get("start") or "")[:10])
+        end = parse_date((repeat["boundsPeriod"].get("end") or "")[:10])
+        if start and end:
+            duration_days = (end - start).days
+
+    route, _ = _fhir_reference(dosage.get("route"))
+    return {
+        "dose": dose,
+        "frequency": frequency,
+        "route": route.lower(),
+        "duration_days": duration_days,
+    }
+
+
+def read_fhir(lines):
+    """
+    FHIR bulk data NDJSON: one MedicationStatement resource per line
+    """
+    for line_number, resource in read_ndjson(lines):
+        if isinstance(resource, Exception):
+            yield line_number, resource
+            continue
+        if resource.get("resourceType") != "MedicationStatement":
+            yield line_number, ImportRowError("Not a MedicationStatement resource.")
+            continue
+
+        patient, patient_id = _fhir_reference(resource.get("subject"))
+        medication, medication_id = _fhir_reference(
+            resource.get("medicationCodeableConcept") or resource.get("medication")
+        )
+        source = resource.get("informationSource") or {}
+        facility, facility_id = "", ""
+        if source.get("reference", "Organization/").startswith("Organization/"):
+            facility, facility_id = _fhir_reference(source)
+        effective = (resource.get("effectivePeriod") or {}).get("start") or resource.get("effectiveDateTime")
+
+        yield line_number, {
+            "patient": patient,
+            "patient_external_id": patient_id,
+            "medication": medication,
+            "medication_external_id": medication_id,
+            "facility": facility,
+            "facility_external_id": facility_id,
+            "start_date": (effective or "")[:10],
+            "notes": "\n".join(n.get("text", "") for n in resource.get("note") or []),
+            "dosage_schedules": [_fhir_schedule(d) for d in resource.get("dosage") or []],
+        }
+
+
+READERS = {
+    "csv": read_csv,
+    "ndjson": read_ndjson,
+    "fhir": read_fhir,
+}
+
+
+# Lookups
+
+class LookupCache:
+    """
+    name / external_id -> pk map for Patient, Medication or Facility. Misses
+    are resolved a batch at a time with a single query and, if allowed,
+    created with bulk_create.
+    """
+
+    def __init__(self, model, create_missing=True):
+        self.model = model
+        self.create_missing = create_missing
+        self.by_external_id = {}
+        self.by_name = {}
+        self.created = 0
+
+    def get(self, name, external_id):
+        if external_id:
+            return self.by_external_id.get(external_id)
+        return self.by_name.get(name)
+
+    def resolve(self, refs):
+        refs = {(name, ext) for name, ext in refs if name or ext}
+        ext_misses = {ext for _, ext in refs if ext and ext not in self.by_external_id}
+        name_misses = {name for name, ext in refs if not ext and name not in self.by_name}
+
+        for chunk in _chunks(sorted(ext_misses), LOOKUP_QUERY_SIZE):
+            rows = self.model.objects.filter(external_id__in=chunk).order_by("pk")
+            for pk, ext in rows.values_list("pk", "external_id"):
+                self.by_external_id.setdefault(ext, pk)
+        for chunk in _chunks(sorted(name_misses), LOOKUP_QUERY_SIZE):
+            rows = self.model.objects.filter(name__in=chunk).order_by("pk")
+            for pk, name in rows.values_list("pk", "name"):
+                self.by_name.setdefault(name, pk)
+
+        if not self.create_missing:
+            return
+        missing = {
+            (name, ext) for name, ext in refs
+            if self.get(name, ext) is None
+        }
+        if not missing:
+            return
+        new = [self.model(name=name or ext, external_id=ext) for name, ext in sorted(missing)]
+        if self.model is Medication:
+            for obj in new:
+                obj.normalize()
+        new = self.model.objects.bulk_create(new)
+        if self.model is Medication:
+            search.medications_saved(new)
+        for obj in new:
+            if obj.external_id:
+                self.by_external_id[obj.external_id] = obj.pk
+            else:
+                self.by_name[obj.name] = obj.pk
+        self.created += len(new)
+
+
+def _chunks(values, size):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+# Import
+
+@dataclass
+class ImportResult:
+    rows: int = 0
+    prescriptions: int = 0
+    schedules: int = 0
+    errors: list = field(default_factory=list)
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self, max_errors=100):
+        return {
+            "rows": self.rows,
+            "prescriptions": self.prescriptions,
+            "schedules": self.schedules,
+            "error_count": len(self.errors),
+            "errors": [
+                {"line": line, "error": message}
+                for line, message in self.errors[:max_errors]
+            ],
+            "elapsed_seconds": round(self.elapsed, 3),
+            "rows_per_second": round(self.rows_per_second, 1),
+        }
+
+
+def _text(raw, key):
+    value = raw.get(key)
+    return str(value).strip() if value is not None else ""
+
+
+def clean_row(raw):
+    """
+    Validates a canonical row, returning the values used for the write
+    """
+    if not isinstance(raw, dict):
+        raise ImportRowError("Expected an object.")
+
+    patient = (_text(raw, "patient"), _text(raw, "patient_external_id"))
+    medication = (_text(raw, "medication"), _text(raw, "medication_external_id"))
+    facility = (_text(raw, "facility"), _text(raw, "facility_external_id"))
+    if not any(patient):
+        raise ImportRowError("Missing patient.")
+    if not any(medication):
+        raise ImportRowError("Missing medication.")
+
+    start_date = None
+    if _text(raw, "start_date"):
+        try:
+            start_date = parse_date(_text(raw, "start_date"))
+        except ValueError:
+            pass
+        if start_date is None:
+            raise ImportRowError(f"Invalid start_date {raw['start_date']!r}.")
+
+    raw_schedules = raw.get("dosage_schedules") or []
+    if not isinstance(raw_schedules, list) or not all(isinstance(s, dict) for s in raw_schedules):
+        raise ImportRowError("dosage_schedules must be a list of objects.")
+
+    schedules = []
+    for schedule in raw_schedules:
+        route = _text(schedule, "route").lower()
+        if route and route not in Route.values:
+            raise ImportRowError(f"Unknown route {route!r}.")
+        try:
+            days = float(_text(schedule, "duration_days"))
+        except ValueError:
+            days = math.nan
+        if not math.isfinite(days):
+            raise ImportRowError(f"Invalid duration_days {schedule.get('duration_days')!r}.")
+        if days < 0:
+            raise ImportRowError("duration_days must not be negative.")
+        try:
+            duration = timedelta(days=days)
+        except OverflowError:
+            raise ImportRowError(f"duration_days {schedule.get('duration_days')!r} is out of range.")
+        schedules.append({
+            "dose": _text(schedule, "dose")[:100],
+            "frequency": _text(schedule, "frequency")[:100],
+            "route": route,
+            "duration": duration,
+        })
+
+    return {
+        "patient": patient,
+        "medication": medication,
+        "facility": facility if any(facility) else None,
+        "start_date": start_date,
+        "notes": _text(raw, "notes"),
+        "schedules": schedules,
+    }
+
+
+class PrescriptionImporter:
+    def __init__(self, batch_size=1000, create_missing=True):
+        self.batch_size = batch_size
+        self.patients = LookupCache(Patient, create_missing)
+        self.medications = LookupCache(Medication, create_missing)
+        self.facilities = LookupCache(Facility, create_missing)
+
+    def run(self, rows):
+        """
+        Imports (line_number, raw_row) pairs as produced by the READERS
+        """
+        result = ImportResult()
+        started = time.perf_counter()
+
+        batch, patient_ids = [], set()
+        try:
+            for line_number, raw in rows:
+                result.rows += 1
+                try:
+                    if isinstance(raw, Exception):
+                        raise raw
+                    batch.append((line_number, clean_row(raw)))
+                except ImportRowError as e:
+                    result.errors.append((line_number, str(e)))
+
+                if len(batch) >= self.batch_size:
+                    patient_ids |= self._write_batch(batch, result)
+                    batch = []
+            if batch:
+                patient_ids |= self._write_batch(batch, result)
+        finally:
+            # Also after a failure, for the batches already committed
+            with transaction.atomic():
+                sync.sync_patients(patient_ids)
+
+        result.elapsed = time.perf_counter() - started
+        return result
+
+    def _write_batch(self, batch, result):
+        """
+        Writes one batch, returning the ids of the patients it wrote to
+        """
+        self.patients.resolve(row["patient"] for _, row in batch)
+        self.medications.resolve(row["medication"] for _, row in batch)
+        self.facilities.resolve(row["facility"] for _, row in batch if row["facility"])
+
+        prescriptions, schedules = [], []
+        for line_number, row in batch:
+            patient_id = self.patients.get(*row["patient"])
+            medication_id = self.medications.get(*row["medication"])
+            if patient_id is None or medication_id is None:
+                missing = "patient" if patient_id is None else "medication"
+                result.errors.append((line_number, f"Unknown {missing} {row[missing]!r}."))
+                continue
+
+            prescription = Prescription(
+                patient_id=patient_id,
+                medication_id=medication_id,
+                source_facility_id=self.facilities.get(*row["facility"]) if row["facility"] else None,
+                start_date=row["start_date"],
+                notes=row["notes"],
+            )
+            try:
+                prescription.total_duration = sum((s["duration"] for s in row["schedules"]), timedelta(0))
+                prescription.end_date = prescription.compute_end_date()
+            except OverflowError:
+                result.errors.append((line_number, "The schedules run past the last supported date."))
+                continue
+            prescriptions.append(prescription)
+            schedules.append(row["schedules"])
+
+        new_schedules = [
+            DosageSchedule(prescription=prescription, **data)
+            for prescription, rows in zip(prescriptions, schedules)
+            for data in rows
+        ]
+        for schedule in new_schedules:
+            schedule.parse_dosing()
+
+        with transaction.atomic():
+            Prescription.objects.bulk_create(prescriptions, batch_size=self.batch_size)
+            DosageSchedule.objects.bulk_create(new_schedules, batch_size=self.batch_size)
+
+        result.prescriptions += len(prescriptions)
+        result.schedules += len(new_schedules)
+        return {p.patient_id for p in prescriptions}
+
+
+def import_prescriptions(lines, input_format, batch_size=1000, create_missing=True):
+    """
+    Imports an iterable of text lines in one of the READERS formats
+    """
+    try:
+        reader = READERS[input_format]
+    except KeyError:
+        raise ValueError(f"Unknown format {input_format!r}; expected one of {', '.join(READERS)}.")
+    importer = PrescriptionImporter(batch_size=batch_size, create_missing=create_missing)
+    return importer.run(reader(lines))
@@ -0,0 +1,139 @@
+"""
+Interval index over half-open [start, end) date ranges.
+
+IntervalIndex answers overlap and stabbing queries in O(log n + k) with a
+centered interval tree, and nearest queries (the next interval to start,
+the last one to end) by bisecting sorted arrays. The tree is only built on
+the first overlap / stab query, so callers that just walk neighbours in
+start order (truncation) pay for a sort and nothing else.
+"""
+from bisect import bisect_left, bisect_right
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Any
+
+
+@dataclass(frozen=True)
+class Interval:
+    """
+    [start, end) with an arbitrary payload. Keys break ties between
+    intervals that start on the same day, so they must be comparable.
+    """
+    start: Any
+    end: Any
+    key: Any
+    data: Any = None
+
+    def overlaps(self, start, end):
+        # Empty intervals (start == end) overlap nothing
+        return self.start < self.end and self.start < end and start < self.end
+
+
+class _Node:
+    __slots__ = ("center", "by_start", "by_end", "left", "right")
+
+    def __init__(self, center, here, left, right):
+        self.center = center
+        self.by_start = sorted(here, key=lambda i: i.start)
+        self.by_end = sorted(here, key=lambda i: i.end, reverse=True)
+        self.left = left
+        self.right = right
+
+
+def _build(intervals):
+    if not intervals:
+        return None
+    # The median start always lands in "here", so both halves shrink
+    center = sorted(i.start for i in intervals)[len(intervals) // 2]
+    here, left, right = [], [], []
+    for i in intervals:
+        if i.end <= center:
+            left.append(i)
+        elif i.start > center:
+            right.append(i)
+        else:
+            here.append(i)
+    return _Node(center, here, _build(left), _build(right))
+
+
+class IntervalIndex:
+    def __init__(self, intervals):
+        self.intervals = sorted(intervals, key=lambda i: (i.start, i.key))
+        self._starts = [i.start for i in self.intervals]
+        self._positions = {i.key: n for n, i in enumerate(self.intervals)}
+        self._by_end = sorted(self.intervals, key=lambda i: (i.end, i.key))
+        self._ends = [i.end for i in self._by_end]
+        self._root = None
+        self._built = False
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def __iter__(self):
+        return iter(self.intervals)
+
+    @property
+    def root(self):
+        if not self._built:
+            # Empty intervals overlap nothing, so they stay out of the tree
+            self._root = _build([i for i in self.intervals if i.start < i.end])
+            self._built = True
+        return self._root
+
+    def overlapping(self, start, end):
+        """
+        Intervals sharing at least one point with [start, end), in start order
+        """
+        found = []
+        if not start < end:
+            return found
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            if end <= node.center:
+                for i in node.by_start:
+                    if i.start >= end:
+                        break
+                    found.append(i)
+                stack.append(node.left)
+            elif start > node.center:
+                for i in node.by_end:
+                    if i.end <= start:
+                        break
+                    found.append(i)
+                stack.append(node.right)
+            else:
+                found.extend(node.by_start)
+                stack.append(node.left)
+                stack.append(node.right)
+        found.sort(key=lambda i: (i.start, i.key))
+        return found
+
+    def stabbing(self, point):
+        """
+        Intervals active on point (start <= point < end), in start order
+        """
+        return self.overlapping(point, point + timedelta(days=1))
+
+    def successor(self, interval):
+        """
+        The interval after this one in (start, key) order
+        """
+        n = self._positions[interval.key] + 1
+        return self.intervals[n] if n < len(self.intervals) else None
+
+    def next_starting(self, point):
+        """
+        The first interval starting on or after point
+        """
+        n = bisect_left(self._starts, point)
+        return self.intervals[n] if n < len(self.intervals) else None
+
+    def last_ending(self, point):
+        """
+        The last interval to end on or before point
+        """
+        n = bisect_right(self._ends, point)
+        return self._by_end[n - 1] if n else None
@@ -0,0 +1,118 @@
+"""
+Lean read path for prescription payloads.
+
+Renders the same structures PrescriptionSerializer does, so the JSON is
+byte for byte the same, without DRF's per-field work: rows come from a
+values() projection, every output key has a getter compiled once per
+call, each medication and facility is rendered once and shared by the
+rows that use it, and the schedules of all rows come from one more query.
+Read-only; writes still go through the serializers.
+"""
+from collections import defaultdict
+
+from .models import DosageSchedule
+from .serializer import DosageScheduleSerializer, PrescriptionSerializer
+
+PRESCRIPTION_FIELDS = tuple(PrescriptionSerializer.Meta.fields)
+SCHEDULE_FIELDS = tuple(DosageScheduleSerializer.Meta.fields)
+SCHEDULE_COLUMNS = tuple("prescription_id" if name == "prescription" else name for name in SCHEDULE_FIELDS)
+
+# Output key: the values() columns it needs
+COLUMNS = {
+    "id": ("id",),
+    "patient": ("patient_id", "patient__name"),
+    "medication": ("medication_id", "medication__name"),
+    "start_date": ("start_date",),
+    "source_facility": ("source_facility_id", "source_facility__name", "source_facility__external_id"),
+    "notes": ("notes",),
+    "contributor": ("contributor_id",),
+    "dosage_schedules": ("id",),
+}
+
+
+class LookupTable:
+    """
+    Related rows rendered once per id from the joined values() columns
+    and shared by every row that points at them
+    """
+
+    def __init__(self, id_column, columns):
+        self.id_column = id_column
+        self.columns = columns  # output key -> values() column
+        self.rows = {}
+
+    def get(self, row):
+        pk = row[self.id_column]
+        if pk is None:
+            return None
+        rendered = self.rows.get(pk)
+        if rendered is None:
+            rendered = self.rows[pk] = {key: row[column] for key, column in self.columns.items()}
+        return rendered
+
+
+def _isoformat(value):
+    return None if value is None else value.isoformat()
+
+
+def _schedule_getters():
+    getters = {name: (lambda name: lambda row: row[name])(name) for name in SCHEDULE_FIELDS}
+    getters["prescription"] = lambda row: row["prescription_id"]
+    # DurationFieldSerializer renders str(timedelta)
+    getters["duration"] = lambda row: str(row["duration"])
+    return [(name, getters[name]) for name in SCHEDULE_FIELDS]
+
+
+def get_fields(fields=None):
+    return [name for name in PRESCRIPTION_FIELDS if fields is None or name in fields]
+
+
+def prescription_rows(queryset, fields=None):
+    """
+    The values() projection render_prescriptions() needs for the requested
+    fields. Stays a queryset, so it can be filtered, ordered and paginated.
+    """
+    columns = {column for name in get_fields(fields) for column in COLUMNS[name]}
+    return queryset.values(*sorted(columns | {"id"}))
+
+
+def render_prescriptions(rows, fields=None):
+    """
+    Renders prescription_rows() output as PrescriptionSerializer would,
+    keeping only the requested top-level fields
+    """
+    rows = list(rows)
+    fields = get_fields(fields)
+
+    medications = LookupTable("medication_id", {"id": "medication_id", "name": "medication__name"})
+    facilities = LookupTable("source_facility_id", {
+        "id": "source_facility_id",
+        "name": "source_facility__name",
+        "external_id": "source_facility__external_id",
+    })
+
+    schedules = defaultdict(list)
+    if "dosage_schedules" in fields:
+        schedule_getters = _schedule_getters()
+        schedule_rows = (
+            DosageSchedule.objects.filter(prescription_id__in=[row["id"] for row in rows])
+            .order_by("id")
+            .values(*SCHEDULE_COLUMNS)
+        )
+        for row in schedule_rows:
+            schedules[row["prescription_id"]].append(
+                {name: getter(row) for name, getter in schedule_getters}
+            )
+
+    getters = {
+        "id": lambda row: row["id"],
+        "patient": lambda row: {"id": row["patient_id"], "name": row["patient__name"]},
+        "medication": medications.get,
+        "start_date": lambda row: _isoformat(row["start_date"]),
+        "source_facility": facilities.get,
+        "notes": lambda row: row["notes"],
+        "contributor": lambda row: row["contributor_id"],
+        "dosage_schedules": lambda row: schedules[row["id"]],
+    }
+    getters = [(name, getters[name]) for name in fields]
+    return [{name: getter(row) for name, getter in getters} for row in rows]
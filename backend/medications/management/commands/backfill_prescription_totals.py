@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from medications import sync
+from medications.models import Prescription
+
+
+class Command(BaseCommand):
+    help = 'Recompute stored total_duration / end_date for existing prescriptions'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        ids = list(Prescription.objects.order_by('id').values_list('id', flat=True))
+
+        updated = 0
+        changed_patients = set()
+        for i in range(0, len(ids), batch_size):
+            batch = Prescription.objects.filter(id__in=ids[i:i + batch_size])
+            before = set(batch.values_list('id', 'patient_id', 'total_duration', 'end_date'))
+            updated += batch.refresh_schedule_totals()
+            after = set(batch.values_list('id', 'patient_id', 'total_duration', 'end_date'))
+            changed_patients.update(patient_id for _, patient_id, _, _ in after - before)
+
+        # Their persisted and cached timelines were built from the old totals
+        with transaction.atomic():
+            sync.sync_patients(changed_patients)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Updated {updated} prescriptions; rebuilt the timelines of {len(changed_patients)} patients'
+        ))
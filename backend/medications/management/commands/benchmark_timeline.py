@@ -0,0 +1,52 @@
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from medications import benchmarks
+
+DEFAULT_BASELINE = Path(settings.BASE_DIR) / 'benchmarks' / 'baseline.json'
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the timeline service and endpoints on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', default=','.join(benchmarks.DEFAULT_SIZES),
+            help=f"Comma separated presets: {', '.join(benchmarks.SIZES)}",
+        )
+        parser.add_argument('--cases', help='Comma separated case names (default: all)')
+        parser.add_argument('--repeat', type=int, default=5)
+        parser.add_argument('--output', '-o', help='Write the results JSON here')
+        parser.add_argument('--baseline', default=str(DEFAULT_BASELINE))
+        parser.add_argument('--save-baseline', action='store_true', help='Store these results as the baseline')
+        parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown before flagging')
+
+    def handle(self, *args, **options):
+        sizes = [size.strip() for size in options['sizes'].split(',') if size.strip()]
+        unknown = set(sizes) - set(benchmarks.SIZES)
+        if unknown:
+            raise CommandError(f"Unknown sizes: {', '.join(sorted(unknown))}")
+        cases = set(options['cases'].split(',')) if options['cases'] else None
+
+        results = benchmarks.run_benchmarks(sizes, options['repeat'], cases, log=self.stdout.write)
+        if options['output']:
+            benchmarks.save(results, options['output'])
+
+        baseline = Path(options['baseline'])
+        if options['save_baseline']:
+            baseline.parent.mkdir(parents=True, exist_ok=True)
+            benchmarks.save(results, baseline)
+            self.stdout.write(self.style.SUCCESS(f'Saved baseline to {baseline}'))
+            return
+
+        if not baseline.exists():
+            self.stdout.write(f'No baseline at {baseline}; run with --save-baseline to create one')
+            return
+
+        regressions = benchmarks.compare(results, benchmarks.load(baseline), options['tolerance'])
+        if regressions:
+            for regression in regressions:
+                self.stderr.write(regression)
+            raise CommandError(f'{len(regressions)} regression(s) against {baseline}')
+        self.stdout.write(self.style.SUCCESS('No regressions against the baseline'))
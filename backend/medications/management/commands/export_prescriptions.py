@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from medications.exporters import export_prescriptions
+from medications.models import Prescription
+
+
+class Command(BaseCommand):
+    help = 'Stream prescription histories to NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+        parser.add_argument('--output', '-o', help='Output file (defaults to stdout)')
+        parser.add_argument('--patient', type=int, action='append', help='Only this patient (repeatable)')
+        parser.add_argument(
+            '--include-timeline', action='store_true',
+            help='Add the truncated end_date and is_truncated fields',
+        )
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        queryset = Prescription.objects.all()
+        if options['patient']:
+            queryset = queryset.filter(patient_id__in=options['patient'])
+
+        chunks = export_prescriptions(
+            options['format'],
+            queryset,
+            include_timeline=options['include_timeline'],
+            batch_size=options['batch_size'],
+        )
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as f:
+                f.writelines(chunks)
+        else:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from medications.synthetic import generate_dataset
+
+
+def fraction(value):
+    value = float(value)
+    if not 0 <= value <= 1:
+        raise ValueError(value)
+    return value
+
+
+class Command(BaseCommand):
+    help = 'Generate a seeded synthetic dataset of patients, prescriptions and schedules'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=1000)
+        parser.add_argument('--prescriptions-per-patient', type=int, default=20)
+        parser.add_argument('--medications', type=int, default=200, help='Size of the medication pool')
+        parser.add_argument('--medications-per-patient', type=int, default=5)
+        parser.add_argument('--overlap-rate', type=fraction, default=0.1,
+                            help='Share of courses that restart a medication before the previous one ended')
+        parser.add_argument('--undated-fraction', type=fraction, default=0.05)
+        parser.add_argument('--schedules-per-prescription', type=int, default=1)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        for name in ('patients', 'prescriptions_per_patient', 'medications',
+                     'medications_per_patient', 'schedules_per_prescription', 'batch_size'):
+            if options[name] < 1:
+                raise CommandError(f"--{name.replace('_', '-')} must be at least 1")
+
+        result = generate_dataset(
+            options['patients'],
+            options['prescriptions_per_patient'],
+            medications=options['medications'],
+            medications_per_patient=options['medications_per_patient'],
+            overlap_rate=options['overlap_rate'],
+            undated_fraction=options['undated_fraction'],
+            schedules_per_prescription=options['schedules_per_prescription'],
+            seed=options['seed'],
+            batch_size=options['batch_size'],
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(result.patient_ids)} patients, {result.prescriptions} prescriptions "
+            f"and {result.schedules} schedules in {result.elapsed:.1f}s "
+            f"({result.rows_per_second:,.0f} rows/s)"
+        ))
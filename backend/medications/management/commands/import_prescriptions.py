@@ -0,0 +1,52 @@
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from medications.importers import READERS, import_prescriptions
+
+EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+
+class Command(BaseCommand):
+    help = 'Bulk import prescription histories from CSV, NDJSON or FHIR MedicationStatement NDJSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="Input file, or '-' for stdin")
+        parser.add_argument('--format', choices=sorted(READERS), help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument(
+            '--no-create', action='store_true',
+            help='Report unknown patients, medications and facilities instead of creating them',
+        )
+        parser.add_argument('--max-errors', type=int, default=50, help='Errors to print')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        input_format = options['format'] or EXTENSIONS.get(Path(path).suffix.lower())
+        if not input_format:
+            raise CommandError('Could not tell the format from the file name; pass --format.')
+
+        if path == '-':
+            result = self.run(sys.stdin, input_format, options)
+        else:
+            try:
+                with open(path, newline='', encoding='utf-8') as f:
+                    result = self.run(f, input_format, options)
+            except OSError as e:
+                raise CommandError(str(e))
+
+        for line, message in result.errors[:options['max_errors']]:
+            self.stderr.write(f'line {line}: {message}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {result.prescriptions} prescriptions and {result.schedules} schedules '
+            f'from {result.rows} rows in {result.elapsed:.2f}s '
+            f'({result.rows_per_second:.0f} rows/s), {len(result.errors)} errors'
+        ))
+
+    def run(self, lines, input_format, options):
+        return import_prescriptions(
+            lines,
+            input_format,
+            batch_size=options['batch_size'],
+            create_missing=not options['no_create'],
+        )
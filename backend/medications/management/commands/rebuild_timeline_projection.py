@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from medications import projection
+from medications.cache import bump_timeline_version
+from medications.models import Patient, Prescription
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the persisted timeline (TimelineItem rows) for every patient'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Patients per batch')
+        parser.add_argument(
+            '--missing', action='store_true',
+            help='Only patients with dated prescriptions that have no timeline item (safe on every deploy)',
+        )
+
+    def handle(self, *args, **options):
+        if options['missing']:
+            patients = (
+                Prescription.objects.filter(start_date__isnull=False, timeline_item__isnull=True)
+                .values_list('patient_id', flat=True)
+                .distinct()
+            )
+        else:
+            patients = Patient.objects.values_list('id', flat=True)
+        ids = sorted(patients)
+
+        batch_size = options['batch_size']
+        projection.rebuild_patients(ids, batch_size=batch_size)
+        # Timelines cached while the rows were missing are stale
+        for i in range(0, len(ids), batch_size):
+            bump_timeline_version(ids[i:i + batch_size])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the timelines of {len(ids)} patients'))
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.10 on 2026-10-18 09:50
+
+import datetime
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def backfill_totals(apps, schema_editor):
+    Prescription = apps.get_model('medications', 'Prescription')
+    DosageSchedule = apps.get_model('medications', 'DosageSchedule')
+
+    totals = dict(
+        DosageSchedule.objects.values('prescription')
+        .annotate(total=Sum('duration'))
+        .values_list('prescription', 'total')
+    )
+    prescriptions = list(Prescription.objects.only('id', 'start_date'))
+    for p in prescriptions:
+        p.total_duration = totals.get(p.id) or datetime.timedelta(0)
+        p.end_date = p.start_date + p.total_duration if p.start_date else None
+    Prescription.objects.bulk_update(prescriptions, ['total_duration', 'end_date'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='prescription',
+            name='end_date',
+            field=models.DateField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='prescription',
+            name='total_duration',
+            field=models.DurationField(default=datetime.timedelta(0), editable=False),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
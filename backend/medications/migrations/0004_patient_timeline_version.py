@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 09:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0003_prescription_timeline_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='timeline_version',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
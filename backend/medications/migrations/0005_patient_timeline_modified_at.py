@@ -0,0 +1,18 @@
+# Generated by Django 5.2.10 on 2026-10-18 09:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0004_patient_timeline_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patient',
+            name='timeline_modified_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
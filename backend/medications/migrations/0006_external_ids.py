@@ -0,0 +1,28 @@
+# Generated by Django 5.2.10 on 2026-10-18 09:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0005_patient_timeline_modified_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medication',
+            name='external_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='patient',
+            name='external_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AlterField(
+            model_name='facility',
+            name='external_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+    ]
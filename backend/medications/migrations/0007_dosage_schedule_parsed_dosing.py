@@ -0,0 +1,43 @@
+# Generated by Django 5.2.10 on 2026-10-18 10:06
+
+from django.db import migrations, models
+
+from medications.dosing import parse_dose, parse_frequency
+
+
+def backfill_dosing(apps, schema_editor):
+    DosageSchedule = apps.get_model('medications', 'DosageSchedule')
+
+    schedules = list(DosageSchedule.objects.only('id', 'dose', 'frequency'))
+    for schedule in schedules:
+        schedule.dose_amount, schedule.dose_unit = parse_dose(schedule.dose)
+        schedule.doses_per_day = parse_frequency(schedule.frequency)
+    DosageSchedule.objects.bulk_update(
+        schedules, ['dose_amount', 'dose_unit', 'doses_per_day'], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0006_external_ids'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dosageschedule',
+            name='dose_amount',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='dosageschedule',
+            name='dose_unit',
+            field=models.CharField(blank=True, editable=False, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='dosageschedule',
+            name='doses_per_day',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_dosing, migrations.RunPython.noop),
+    ]
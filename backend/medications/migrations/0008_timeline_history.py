@@ -0,0 +1,42 @@
+# Generated by Django 5.2.10 on 2026-10-18 10:09
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0007_dosage_schedule_parsed_dosing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('prescription_id', models.BigIntegerField()),
+                ('action', models.CharField(choices=[('save', 'Save'), ('delete', 'Delete')], max_length=10)),
+                ('data', models.JSONField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_changes', to='medications.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient', 'created_at'], name='timeline_change_pat_created')],
+            },
+        ),
+        migrations.CreateModel(
+            name='TimelineSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_change_id', models.BigIntegerField(default=0)),
+                ('data', models.JSONField()),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_snapshots', to='medications.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient', 'taken_at'], name='timeline_snapshot_pat_taken')],
+            },
+        ),
+    ]
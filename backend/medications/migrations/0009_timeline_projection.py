@@ -0,0 +1,32 @@
+# Generated by Django 5.2.10 on 2026-10-18 10:12
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0008_timeline_history'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineItem',
+            fields=[
+                ('prescription', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='timeline_item', serialize=False, to='medications.prescription')),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField()),
+                ('natural_end_date', models.DateField()),
+                ('is_truncated', models.BooleanField(default=False)),
+                ('dosages', models.JSONField(default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('notes', models.TextField(blank=True)),
+                ('medication', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='medications.medication')),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='medications.patient')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient', 'medication'], name='timeline_item_pat_med'), models.Index(fields=['patient', 'start_date'], name='timeline_item_pat_start')],
+            },
+        ),
+    ]
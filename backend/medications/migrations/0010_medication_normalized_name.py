@@ -0,0 +1,34 @@
+# Generated by Django 5.2.10 on 2026-10-18 10:18
+
+from django.db import migrations, models
+
+from medications.models import normalize_name
+
+
+def backfill_normalized_names(apps, schema_editor):
+    Medication = apps.get_model('medications', 'Medication')
+
+    medications = list(Medication.objects.only('id', 'name'))
+    for medication in medications:
+        medication.normalized_name = normalize_name(medication.name)
+    Medication.objects.bulk_update(medications, ['normalized_name'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0009_timeline_projection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='medication',
+            name='normalized_name',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.RunPython(backfill_normalized_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='medication',
+            index=models.Index(fields=['normalized_name'], name='medication_normalized_name', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
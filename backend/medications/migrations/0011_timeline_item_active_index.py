@@ -0,0 +1,17 @@
+# Generated by Django 5.2.10 on 2026-10-18 10:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('medications', '0010_medication_normalized_name'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='timelineitem',
+            index=models.Index(fields=['medication', 'end_date', 'start_date'], name='timeline_item_med_active'),
+        ),
+    ]
@@ -1,27 +1,112 @@
+import re
+import unicodedata
+
 from django.db import models
 from django.contrib.auth.models import User
-from datetime import date
+from datetime import date, timedelta
 from .choices import Route
-from django.db.models import Q
+from .dosing import parse_dose, parse_frequency
+from django.db.models import Q, Sum
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import transaction
+from django.utils import timezone
 
 class Patient(models.Model):
     name = models.CharField(max_length=255)
+    external_id = models.CharField(max_length=100, blank=True, db_index=True)
+    # Bumped on every Prescription / DosageSchedule write for this patient,
+    # used to key the timeline cache (see medications.cache)
+    timeline_version = models.PositiveIntegerField(default=0, editable=False)
+    timeline_modified_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        # Only bump_timeline_version() moves the version; writing back a
+        # stale copy of it would bring old cache entries back
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in ("timeline_version", "timeline_modified_at")
+            ]
+        super().save(*args, **kwargs)
+
+NORMALIZED_NAME_LENGTH = 255
+
+
+def normalize_name(name):
+    """
+    Search form of a name: accents stripped, case folded, runs of anything
+    but letters and digits collapsed to one space
+    """
+    text = unicodedata.normalize("NFKD", name or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return " ".join(re.findall(r"[^\W_]+", text))[:NORMALIZED_NAME_LENGTH].rstrip()
+
 
 class Medication(models.Model):
     name = models.CharField(max_length=1000)
+    external_id = models.CharField(max_length=100, blank=True, db_index=True)
+    # Set from name on save, for prefix search (see medications.search)
+    normalized_name = models.CharField(max_length=NORMALIZED_NAME_LENGTH, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # varchar_pattern_ops lets PostgreSQL answer LIKE 'prefix%' from
+            # the B-tree whatever the collation; other backends ignore it
+            models.Index(
+                fields=["normalized_name"],
+                name="medication_normalized_name",
+                opclasses=["varchar_pattern_ops"],
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
+    def normalize(self):
+        """
+        Fills normalized_name. bulk_create skips save(), so bulk writers
+        call this themselves.
+        """
+        self.normalized_name = normalize_name(self.name)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "name" in update_fields:
+            self.normalize()
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "normalized_name"}
+        super().save(*args, **kwargs)
+
 
 class Facility(models.Model):
     name = models.CharField(max_length=255)
-    external_id = models.CharField(max_length=100, blank=True)
+    external_id = models.CharField(max_length=100, blank=True, db_index=True)
 
     def __str__(self):
         return self.name
 
+class PrescriptionQuerySet(models.QuerySet):
+    def refresh_schedule_totals(self, batch_size=500):
+        """
+        Recomputes the stored total_duration / end_date columns from the
+        DosageSchedule rows. Returns the number of prescriptions updated.
+        """
+        totals = dict(
+            DosageSchedule.objects.filter(prescription__in=self.values("pk"))
+            .values("prescription")
+            .annotate(total=Sum("duration"))
+            .values_list("prescription", "total")
+        )
+        prescriptions = list(self.only("id", "start_date"))
+        for p in prescriptions:
+            p.total_duration = totals.get(p.id) or timedelta(0)
+            p.end_date = p.compute_end_date()
+        self.model.objects.bulk_update(
+            prescriptions, ["total_duration", "end_date"], batch_size=batch_size
+        )
+        return len(prescriptions)
+
+
 class Prescription(models.Model):
     """                                                                                             
     Represents a signle medication course on the main timeline
@@ -51,11 +136,61 @@ class Prescription(models.Model):
         blank=True,
         related_name="medication_entries"
     )
-    
+
+    # Materialized from the DosageSchedule rows so the database can filter
+    # and sort by end date. Kept in sync by medications.signals.
+    total_duration = models.DurationField(default=timedelta(0), editable=False)
+    end_date = models.DateField(null=True, blank=True, editable=False)
+
+    objects = PrescriptionQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["patient", "medication", "start_date"],
+                name="prescription_pat_med_start",
+            ),
+            models.Index(
+                fields=["patient", "start_date"],
+                name="prescription_pat_start",
+            ),
+        ]
 
     def __str__(self):
         return f"{self.medication.name}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remembered so moving a prescription invalidates both patients
+        # (and both medication groups)
+        instance._loaded_patient_id = instance.__dict__.get("patient_id")
+        instance._loaded_medication_id = instance.__dict__.get("medication_id")
+        instance._loaded_start_date = instance.__dict__.get("start_date")
+        return instance
+
+    def compute_end_date(self):
+        if not self.start_date:
+            return None
+        return self.start_date + self.total_duration
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or "start_date" in update_fields:
+            if not self._state.adding:
+                # Re-read the total so a stale instance can't overwrite it
+                self.total_duration = self.dosageschedule_set.aggregate(
+                    total=Sum("duration")
+                )["total"] or timedelta(0)
+            self.end_date = self.compute_end_date()
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "total_duration", "end_date"}
+        super().save(*args, **kwargs)
+        # The saved row is what a later move starts from
+        self._loaded_patient_id = self.patient_id
+        self._loaded_medication_id = self.medication_id
+        self._loaded_start_date = self.start_date
+
 
 class DosageSchedule(models.Model):
     prescription = models.ForeignKey(
@@ -70,3 +205,120 @@ class DosageSchedule(models.Model):
         blank=True
     )
     duration = models.DurationField()
+
+    # Parsed from dose / frequency on save (see medications.dosing)
+    dose_amount = models.FloatField(null=True, blank=True, editable=False)
+    dose_unit = models.CharField(max_length=20, blank=True, editable=False)
+    doses_per_day = models.FloatField(null=True, blank=True, editable=False)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remembered so a schedule moved to another prescription refreshes both
+        instance._loaded_prescription_id = instance.__dict__.get("prescription_id")
+        return instance
+
+    @property
+    def daily_amount(self):
+        if self.dose_amount is None or self.doses_per_day is None:
+            return None
+        return self.dose_amount * self.doses_per_day
+
+    def parse_dosing(self):
+        """
+        Fills the parsed dose / frequency columns. bulk_create skips save(),
+        so bulk writers call this themselves.
+        """
+        self.dose_amount, self.dose_unit = parse_dose(self.dose)
+        self.doses_per_day = parse_frequency(self.frequency)
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or {"dose", "frequency"} & set(update_fields):
+            self.parse_dosing()
+            if update_fields is not None:
+                kwargs["update_fields"] = {*update_fields, "dose_amount", "dose_unit", "doses_per_day"}
+        super().save(*args, **kwargs)
+        self._loaded_prescription_id = self.prescription_id
+
+
+class TimelineChange(models.Model):
+    """
+    Append-only log of prescription writes: the full state of a
+    prescription (with its schedules) after each change, or its deletion.
+    See medications.history.
+    """
+    class Action(models.TextChoices):
+        SAVE = 'save', 'Save'
+        DELETE = 'delete', 'Delete'
+
+    patient = models.ForeignKey(
+        Patient,
+        on_delete=models.CASCADE,
+        related_name="timeline_changes",
+    )
+    # Not a foreign key so entries outlive the prescription
+    prescription_id = models.BigIntegerField()
+    action = models.CharField(max_length=10, choices=Action.choices)
+    data = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["patient", "created_at"], name="timeline_change_pat_created"),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Timeline changes are append-only.")
+        super().save(*args, **kwargs)
+
+
+class TimelineSnapshot(models.Model):
+    """
+    A patient's full prescription state at taken_at, covering every
+    TimelineChange up to last_change_id
+    """
+    patient = models.ForeignKey(
+        Patient,
+        on_delete=models.CASCADE,
+        related_name="timeline_snapshots",
+    )
+    taken_at = models.DateTimeField(default=timezone.now)
+    last_change_id = models.BigIntegerField(default=0)
+    data = models.JSONField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["patient", "taken_at"], name="timeline_snapshot_pat_taken"),
+        ]
+
+
+class TimelineItem(models.Model):
+    """
+    Persisted timeline: one row per dated prescription with its computed
+    (truncated) dates. Rebuilt one (patient, medication) group at a time by
+    medications.projection.
+    """
+    prescription = models.OneToOneField(
+        Prescription,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="timeline_item",
+    )
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name="+")
+    medication = models.ForeignKey(Medication, on_delete=models.CASCADE, related_name="+")
+    start_date = models.DateField()
+    end_date = models.DateField()
+    natural_end_date = models.DateField()
+    is_truncated = models.BooleanField(default=False)
+    dosages = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    notes = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["patient", "medication"], name="timeline_item_pat_med"),
+            models.Index(fields=["patient", "start_date"], name="timeline_item_pat_start"),
+            # Who is on a medication on a day (see medications.cohorts)
+            models.Index(fields=["medication", "end_date", "start_date"], name="timeline_item_med_active"),
+        ]
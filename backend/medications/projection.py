@@ -0,0 +1,177 @@
+"""
+The persisted timeline: TimelineItem rows holding each dated
+prescription's computed dates, read directly by the timeline endpoints.
+
+Truncation never crosses a (patient, medication) group, so a write only
+rebuilds the groups it touched and its cost follows the size of those
+groups rather than the patient's whole history. Bulk writers rebuild
+whole patients instead (see medications.sync). Watched patients get the
+changed items published as diff events (see medications.events).
+"""
+import json
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+
+from backend.instrumentation import span
+
+from . import events
+from .models import Prescription, TimelineItem
+from .services import build_timeline_items, get_timeline_queryset
+
+
+def _build_rows(prescriptions):
+    """
+    Returns:
+        list of (TimelineItem, timeline item dict)
+    """
+    groups = defaultdict(list)
+    for p in prescriptions:
+        groups[(p.patient_id, p.medication_id)].append(p)
+
+    rows = []
+    for (patient_id, medication_id), group in groups.items():
+        for item in build_timeline_items(group):
+            rows.append((TimelineItem(
+                prescription_id=item["id"],
+                patient_id=patient_id,
+                medication_id=medication_id,
+                start_date=item["start_date"],
+                end_date=item["end_date"],
+                natural_end_date=item["natural_end_date"],
+                is_truncated=item["is_truncated"],
+                dosages=item["dosages"],
+                notes=item["notes"],
+            ), item))
+    return rows
+
+
+def _own_fields(row):
+    # What the prescription itself sets, as opposed to a neighbour's truncation
+    return (row.patient_id, row.medication_id, row.start_date, row.natural_end_date, row.notes)
+
+
+def _dosages(row):
+    # As they come back from the DB
+    return json.loads(json.dumps(row.dosages, cls=DjangoJSONEncoder))
+
+
+def _publish_diff(patient_ids, old_rows, new_rows):
+    """
+    Publishes added / removed / updated / truncated events for the rows a
+    rebuild changed
+    """
+    new_by_id = {row.pk: (row, item) for row, item in new_rows if row.patient_id in patient_ids}
+    for pk, old in old_rows.items():
+        new = new_by_id.get(pk)
+        if new is None or new[0].patient_id != old.patient_id:
+            events.publish(old.patient_id, {"type": "removed", "id": pk})
+
+    for pk, (row, item) in new_by_id.items():
+        old = old_rows.get(pk)
+        if old is None or old.patient_id != row.patient_id:
+            kind = "added"
+        elif _own_fields(old) != _own_fields(row):
+            kind = "updated"
+        elif (old.end_date, old.is_truncated) != (row.end_date, row.is_truncated):
+            # The dosage segments are clipped along with it
+            kind = "truncated"
+        elif _dosages(old) != _dosages(row):
+            kind = "updated"
+        else:
+            continue
+        events.publish(row.patient_id, {"type": kind, "item": item})
+
+
+def refresh_groups(groups=(), prescription_ids=()):
+    """
+    Rebuilds the rows of the given (patient_id, medication_id) groups and
+    of the groups the given prescriptions belong to now. Rows left behind
+    by those prescriptions elsewhere (moved or undated) are dropped.
+    """
+    prescription_ids = {pk for pk in prescription_ids if pk}
+    groups = {
+        (patient_id, medication_id)
+        for patient_id, medication_id in groups
+        if patient_id and medication_id
+    }
+    groups.update(
+        Prescription.objects.filter(pk__in=prescription_ids).values_list("patient_id", "medication_id")
+    )
+    if not groups and not prescription_ids:
+        return
+
+    in_groups = reduce(
+        or_,
+        (Q(patient_id=patient_id, medication_id=medication_id) for patient_id, medication_id in groups),
+        Q(pk__in=[]),
+    )
+    stale = TimelineItem.objects.filter(in_groups | Q(pk__in=prescription_ids))
+    watched = {patient_id for patient_id, _ in groups if events.is_watched(patient_id)}
+    with transaction.atomic():
+        old_rows = {row.pk: row for row in stale.filter(patient_id__in=watched)} if watched else {}
+        stale.delete()
+        new_rows = _build_rows(get_timeline_queryset().filter(in_groups))
+        TimelineItem.objects.bulk_create(row for row, _ in new_rows)
+        if watched:
+            _publish_diff(watched, old_rows, new_rows)
+
+
+def rebuild_patients(patient_ids, batch_size=500):
+    """
+    Rebuilds every row of the given patients, batch_size patients at a time
+    """
+    patient_ids = sorted(set(patient_ids))
+    for first in range(0, len(patient_ids), batch_size):
+        batch = patient_ids[first:first + batch_size]
+        with transaction.atomic():
+            TimelineItem.objects.filter(patient_id__in=batch).delete()
+            TimelineItem.objects.bulk_create(
+                (row for row, _ in _build_rows(get_timeline_queryset(patient_id__in=batch))),
+                batch_size=1000,
+            )
+            for patient_id in batch:
+                if events.is_watched(patient_id):
+                    events.publish(patient_id, {"type": "reset"})
+
+
+def read_timelines(patient_ids, date_from=None, date_to=None):
+    """
+    Timeline items of several patients straight from the projection, in the
+    same shape build_timeline_items() produces
+
+    Returns:
+        dict[patient_id] = timeline items
+    """
+    rows = (
+        TimelineItem.objects.filter(patient_id__in=patient_ids)
+        .select_related("medication")
+        .order_by("prescription_id")
+    )
+    if date_from:
+        rows = rows.filter(end_date__gte=date_from)
+    if date_to:
+        rows = rows.filter(start_date__lte=date_to)
+
+    timelines = {pid: [] for pid in patient_ids}
+    with span("timeline-read"):
+        for row in rows:
+            timelines[row.patient_id].append({
+                "id": row.prescription_id,
+                "medication": row.medication.name,
+                "start_date": row.start_date,
+                "end_date": row.end_date,
+                "natural_end_date": row.natural_end_date,
+                "is_truncated": row.is_truncated,
+                "dosages": row.dosages,
+                "notes": row.notes,
+            })
+    return timelines
+
+
+def read_timeline(patient_id, date_from=None, date_to=None):
+    return read_timelines([patient_id], date_from, date_to)[patient_id]
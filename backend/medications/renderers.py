@@ -0,0 +1,86 @@
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+from .columnar import encode_timeline
+
+try:
+    import msgpack
+except ImportError:  # optional, only needed for ?format=columnar-msgpack
+    msgpack = None
+
+
+class StreamRenderer(BaseRenderer):
+    """
+    Lets DRF negotiate ?format=ndjson / ?format=csv for views that stream
+    their own StreamingHttpResponse. Only error payloads (plain data) are
+    rendered here, as JSON text.
+    """
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return JSONEncoder().encode(data).encode(self.charset)
+
+
+class NDJSONRenderer(StreamRenderer):
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+
+
+class CSVRenderer(StreamRenderer):
+    media_type = "text/csv"
+    format = "csv"
+
+
+def encode_timeline_payload(data, renderer_context):
+    """
+    Timeline responses (a list of items, or {"lane_count", "items"}) in the
+    columnar encoding; anything else, such as errors, is left as it is
+    """
+    response = (renderer_context or {}).get("response")
+    if response is not None and response.exception:
+        return data
+    if isinstance(data, dict) and "items" in data:
+        return encode_timeline(data["items"], data.get("lane_count"))
+    if isinstance(data, list):
+        return encode_timeline(data)
+    return data
+
+
+class ColumnarRenderer(JSONRenderer):
+    """
+    ?format=columnar, or Accept: application/vnd.timeline.columnar+json
+    (see medications.columnar)
+    """
+    media_type = "application/vnd.timeline.columnar+json"
+    format = "columnar"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return super().render(
+            encode_timeline_payload(data, renderer_context), accepted_media_type, renderer_context
+        )
+
+
+class ColumnarMessagePackRenderer(BaseRenderer):
+    """
+    The columnar encoding packed with MessagePack; only offered when the
+    msgpack package is installed
+    """
+    media_type = "application/vnd.timeline.columnar+msgpack"
+    format = "columnar-msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        return msgpack.packb(encode_timeline_payload(data, renderer_context), use_bin_type=True)
+
+
+TIMELINE_RENDERERS = [
+    *api_settings.DEFAULT_RENDERER_CLASSES,
+    ColumnarRenderer,
+    *([ColumnarMessagePackRenderer] if msgpack else []),
+]
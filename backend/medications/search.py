@@ -0,0 +1,228 @@
+"""
+Medication typeahead search.
+
+Prefix matches come straight from the normalized_name B-tree index. When
+they don't fill the requested number of results, a trigram index of every
+normalized name, held in memory as numpy postings, adds typo-tolerant
+matches ranked by trigram similarity (shared / union, as pg_trgm does).
+
+Results of hot queries are kept in a bounded LRU. The LRU and the trigram
+index are per process. Medication writes in this process clear the LRU and
+are applied to the index in place; it is only built once, on first use.
+Other processes' writes expire from the LRU after SEARCH_CACHE_SECONDS,
+and the index picks up the medications they create (ids above the
+highest one it holds) on each fuzzy lookup. Their renames and deletes
+only reach it on restart; deleted ids are dropped when the names are
+read.
+"""
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from .models import Medication, normalize_name
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# Prefix matches ranked in Python; the rest are only reached by typing more
+PREFIX_CANDIDATES = 200
+MIN_SIMILARITY = 0.3
+SEARCH_CACHE_SIZE = 1024
+SEARCH_CACHE_SECONDS = 300
+
+
+def trigrams(text):
+    """
+    Trigrams of each word padded like pg_trgm: two spaces before, one after
+    """
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    def __init__(self, rows):
+        """
+        rows is an iterable of (id, normalized_name)
+        """
+        ids, sizes, postings = [], [], defaultdict(list)
+        for position, (pk, normalized) in enumerate(rows):
+            grams = trigrams(normalized)
+            ids.append(pk)
+            sizes.append(len(grams))
+            for gram in grams:
+                postings[gram].append(position)
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.sizes = np.asarray(sizes, dtype=np.int64)
+        self.alive = np.ones(len(ids), dtype=bool)
+        self.positions = {pk: position for position, pk in enumerate(ids)}
+        self.max_id = max(ids, default=0)
+        self.postings = {gram: np.asarray(rows, dtype=np.int32) for gram, rows in postings.items()}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def put(self, pk, normalized):
+        """
+        Adds a name, or replaces the one indexed for pk
+        """
+        self.remove(pk)
+        position = len(self.ids)
+        grams = trigrams(normalized)
+        self.ids = np.append(self.ids, pk)
+        self.sizes = np.append(self.sizes, len(grams))
+        self.alive = np.append(self.alive, True)
+        self.positions[pk] = position
+        self.max_id = max(self.max_id, pk)
+        for gram in grams:
+            self.postings[gram] = np.append(self.postings.get(gram, np.empty(0, dtype=np.int32)), np.int32(position))
+
+    def remove(self, pk):
+        # Its postings stay behind, masked out by alive
+        position = self.positions.pop(pk, None)
+        if position is not None:
+            self.alive[position] = False
+
+    def search(self, query, limit, min_similarity=MIN_SIMILARITY):
+        """
+        Returns up to limit (id, similarity) pairs, most similar first
+        """
+        grams = trigrams(query)
+        hits = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not hits:
+            return []
+        shared = np.bincount(np.concatenate(hits), minlength=len(self.ids))
+        similarity = np.where(self.alive, shared / (len(grams) + self.sizes - shared), 0)
+        candidates = np.flatnonzero(similarity >= min_similarity)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-similarity[candidates], limit - 1)[:limit]]
+        candidates = sorted(candidates, key=lambda i: (-similarity[i], self.ids[i]))
+        return [(int(self.ids[i]), float(similarity[i])) for i in candidates]
+
+
+class LRUCache:
+    def __init__(self, maxsize, timeout):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.monotonic() - entry[0] > self.timeout:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_results = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_SECONDS)
+_index_lock = threading.Lock()
+_index = None
+
+
+def _get_index():
+    """
+    The trigram index, built on first use and then kept up to date in
+    place. Call with _index_lock held.
+    """
+    global _index
+    if _index is None:
+        rows = Medication.objects.values_list("id", "normalized_name").iterator(chunk_size=5000)
+        _index = TrigramIndex(rows)
+    else:
+        # Medications created by other processes
+        for pk, normalized in Medication.objects.filter(pk__gt=_index.max_id).values_list("id", "normalized_name"):
+            _index.put(pk, normalized)
+    return _index
+
+
+def similar_medications(normalized, limit):
+    """
+    Up to limit (id, similarity) pairs from the trigram index
+    """
+    with _index_lock:
+        return _get_index().search(normalized, limit)
+
+
+def medications_saved(medications):
+    """
+    Applies created or renamed medications to the index of this process
+    """
+    with _index_lock:
+        if _index is not None:
+            for medication in medications:
+                _index.put(medication.pk, medication.normalized_name)
+    _results.clear()
+
+
+def medication_deleted(pk):
+    with _index_lock:
+        if _index is not None:
+            _index.remove(pk)
+    _results.clear()
+
+
+def invalidate():
+    """
+    Drops the cached results and the trigram index of this process
+    """
+    global _index
+    with _index_lock:
+        _index = None
+    _results.clear()
+
+
+def _prefix_matches(normalized, limit):
+    rows = (
+        Medication.objects.filter(normalized_name__startswith=normalized)
+        .order_by("normalized_name", "id")
+        .values_list("id", "name", "normalized_name")[:PREFIX_CANDIDATES]
+    )
+    # Exact match first, then the shortest names
+    ranked = sorted(rows, key=lambda row: (row[2] != normalized, len(row[2]), row[2], row[0]))
+    return [{"id": pk, "name": name} for pk, name, _ in ranked[:limit]]
+
+
+def search_medications(query, limit=DEFAULT_LIMIT, fuzzy=True):
+    """
+    Up to limit {"id", "name"} matches for query: prefix matches first,
+    then (with fuzzy) names with similar trigrams
+    """
+    normalized = normalize_name(query)
+    if not normalized:
+        return []
+    key = (normalized, limit, fuzzy)
+    results = _results.get(key)
+    if results is not None:
+        return results
+
+    results = _prefix_matches(normalized, limit)
+    if fuzzy and len(results) < limit:
+        found = {result["id"] for result in results}
+        similar = [
+            pk for pk, _ in similar_medications(normalized, limit + len(found))
+            if pk not in found
+        ][:limit - len(results)]
+        names = dict(Medication.objects.filter(pk__in=similar).values_list("id", "name"))
+        results += [{"id": pk, "name": names[pk]} for pk in similar if pk in names]
+
+    _results.set(key, results)
+    return results
@@ -1,18 +1,43 @@
+from django.db import transaction
+from django.utils.dateparse import parse_duration
 from rest_framework import serializers
+from . import sync
 from .models import Patient, Medication, Facility, Prescription, DosageSchedule
 from datetime import timedelta
 
-class PatientSerializer(serializers.ModelSerializer):
+class FieldProjectionMixin:
+    """
+    Keeps only the fields listed in context["fields"] (set from ?fields= by
+    the viewsets). Applied to the top-level serializer only, so nested
+    serializers that are kept still render in full and the ones that are
+    dropped are never evaluated.
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        requested = self.context.get('fields')
+        if requested and self._is_top_level():
+            fields = {name: field for name, field in fields.items() if name in requested}
+        return fields
+
+    def _is_top_level(self):
+        parent = self.parent
+        return parent is None or (
+            isinstance(parent, serializers.ListSerializer) and parent.parent is None
+        )
+
+
+class PatientSerializer(FieldProjectionMixin, serializers.ModelSerializer):
     class Meta:
         model = Patient
         fields = ['id', 'name']
 
-class MedicationSerializer(serializers.ModelSerializer):
+class MedicationSerializer(FieldProjectionMixin, serializers.ModelSerializer):
     class Meta:
         model = Medication
         fields = ['id', 'name']
 
-class FacilitySerializer(serializers.ModelSerializer):
+class FacilitySerializer(FieldProjectionMixin, serializers.ModelSerializer):
     class Meta:
         model = Facility
         fields = ['id', 'name', 'external_id']
@@ -35,21 +60,37 @@ class DurationFieldSerializer(serializers.Field):
                 return timedelta(days=days)
             except (ValueError, TypeError):
                 pass
+            # Also accept the "7 days, 0:00:00" form we return on reads
+            duration = parse_duration(data)
+            if duration is not None:
+                return duration
+            raise serializers.ValidationError("Expected a number of days.")
         return data
 
-class DosageScheduleSerializer(serializers.ModelSerializer):
+class DosageScheduleSerializer(FieldProjectionMixin, serializers.ModelSerializer):
     duration = DurationFieldSerializer()
     
     class Meta:
         model = DosageSchedule
-        fields = ['id', 'prescription', 'dose', 'frequency', 'route', 'duration']
+        fields = [
+            'id', 'prescription', 'dose', 'frequency', 'route', 'duration',
+            'dose_amount', 'dose_unit', 'doses_per_day',
+        ]
+
+class NestedDosageScheduleSerializer(DosageScheduleSerializer):
+    """Schedule written through PrescriptionSerializer; id is set to update"""
+    id = serializers.IntegerField(required=False)
 
-class PrescriptionSerializer(serializers.ModelSerializer):
+    class Meta(DosageScheduleSerializer.Meta):
+        read_only_fields = ['prescription']
+
+
+class PrescriptionSerializer(FieldProjectionMixin, serializers.ModelSerializer):
     patient = PatientSerializer(read_only=True)
     medication = MedicationSerializer(read_only=True)
     source_facility = FacilitySerializer(read_only=True)
-    dosage_schedules = DosageScheduleSerializer(
-        source='dosageschedule_set', many=True, read_only=True
+    dosage_schedules = NestedDosageScheduleSerializer(
+        source='dosageschedule_set', many=True, required=False
     )
 
     class Meta:
@@ -74,8 +115,71 @@ class PrescriptionSerializer(serializers.ModelSerializer):
             validated_data['medication_id'] = medication_id
         if patient_id:
             validated_data['patient_id'] = patient_id
-            
-        return super().create(validated_data)
+
+        schedules = validated_data.pop('dosageschedule_set', [])
+        if any(data.get('id') is not None for data in schedules):
+            raise serializers.ValidationError({
+                'dosage_schedules': 'A new prescription has no schedules to update; leave out their ids.'
+            })
+        with transaction.atomic(), sync.deferred():
+            prescription = super().create(validated_data)
+            new_schedules = [DosageSchedule(prescription=prescription, **data) for data in schedules]
+            for schedule in new_schedules:
+                schedule.parse_dosing()
+            DosageSchedule.objects.bulk_create(new_schedules)
+            sync.sync_prescriptions({prescription.pk})
+        prescription.refresh_from_db(fields=['total_duration', 'end_date'])
+        return prescription
+
+    def update(self, instance, validated_data):
+        schedules = validated_data.pop('dosageschedule_set', None)
+        with transaction.atomic(), sync.deferred():
+            previous_patient_id = instance.patient_id
+            prescription = super().update(instance, validated_data)
+            if schedules is not None:
+                self._replace_schedules(prescription, schedules)
+            sync.sync_prescriptions({prescription.pk}, {previous_patient_id})
+        prescription.refresh_from_db(fields=['total_duration', 'end_date'])
+        return prescription
+
+    def _replace_schedules(self, prescription, schedules):
+        """
+        Makes the prescription's schedules match the submitted list: rows
+        with an id are updated, rows without one are created and any
+        existing schedule left out is deleted
+        """
+        existing = {d.pk: d for d in prescription.dosageschedule_set.all()}
+        unknown = [data['id'] for data in schedules if data.get('id') and data['id'] not in existing]
+        if unknown:
+            raise serializers.ValidationError({
+                'dosage_schedules': f'Schedules {unknown} do not belong to this prescription.'
+            })
+
+        to_update, to_create = [], []
+        for data in schedules:
+            schedule_id = data.pop('id', None)
+            if schedule_id:
+                schedule = existing.pop(schedule_id)
+                for field, value in data.items():
+                    setattr(schedule, field, value)
+                to_update.append(schedule)
+            elif 'duration' not in data:
+                raise serializers.ValidationError({
+                    'dosage_schedules': 'New schedules need a duration.'
+                })
+            else:
+                to_create.append(DosageSchedule(prescription=prescription, **data))
+
+        for schedule in (*to_update, *to_create):
+            schedule.parse_dosing()
+        DosageSchedule.objects.filter(pk__in=list(existing)).delete()
+        DosageSchedule.objects.bulk_update(
+            to_update,
+            ['dose', 'frequency', 'route', 'duration', 'dose_amount', 'dose_unit', 'doses_per_day'],
+        )
+        DosageSchedule.objects.bulk_create(to_create)
+        # Drop any cached schedules so the response reflects the writes
+        getattr(prescription, '_prefetched_objects_cache', {}).pop('dosageschedule_set', None)
 
 class TimelineItemSerializer(serializers.Serializer):
     id = serializers.IntegerField()
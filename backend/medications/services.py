@@ -1,81 +1,246 @@
+import heapq
+from bisect import bisect_left
 from collections import defaultdict
-from django.db.models import Sum
-from datetime import timedelta
+from dataclasses import dataclass
+from datetime import date, timedelta
+from itertools import accumulate
+from backend.instrumentation import span
+from .intervals import Interval, IntervalIndex
+from .models import Prescription
 
-def get_prescription_total_duration(prescription):
-    agg = prescription.dosageschedule_set.aggregate(
-        total=Sum("duration")
-    )
-    return agg["total"] or timedelta(0)
 
+@dataclass
+class PrescriptionSpan:
+    """
+    Computed dates for a single prescription on the timeline
+    """
+    total_duration: timedelta
+    natural_end: date
+    cutoff: date = None
+
+    @property
+    def end_date(self):
+        return self.cutoff if self.cutoff else self.natural_end
 
-def get_prescription_end_date(prescription):
-    if not prescription.start_date:
-        return None
-    return prescription.start_date + get_prescription_total_duration(prescription)
 
-def get_truncated_prescriptions(prescriptions):
+def compute_prescription_spans(prescriptions):
     """
+    Computes total duration, natural end and truncation cutoff once per dated
+    prescription, reading the stored total_duration / end_date columns.
+    Prescriptions of the same medication are sorted by start date and each
+    one is cut off where the next one starts if they overlap.
+
     Returns:
-        dict[prescription_id] = cutoff_date
+        dict[prescription_id] = PrescriptionSpan
     """
-    result = {}
+    spans = {}
     by_medication = defaultdict(list)
 
     for p in prescriptions:
-        if p.start_date:
-            by_medication[p.medication_id].append(p)
+        if not p.start_date:
+            continue
+        spans[p.id] = PrescriptionSpan(
+            total_duration=p.total_duration,
+            natural_end=p.end_date,
+        )
+        by_medication[p.medication_id].append(Interval(p.start_date, p.end_date, p.id))
+
+    for intervals in by_medication.values():
+        index = IntervalIndex(intervals)
+        for interval in index:
+            following = index.successor(interval)
+            if following and following.start < interval.end:
+                spans[interval.key].cutoff = following.start
+
+    return spans
+
+
+def get_schedule_segments(prescription, span):
+    """
+    Splits a dated prescription into one [start, end) interval per dosage
+    schedule, in schedule order, clipped at the truncation cutoff. Each
+    interval carries its DosageSchedule as data.
+    """
+    schedules = sorted(prescription.dosageschedule_set.all(), key=lambda d: d.id)
+    # offsets[i] is where schedule i starts, relative to the start date
+    offsets = list(accumulate((d.duration or timedelta(0) for d in schedules), initial=timedelta(0)))
+    # Schedules starting on or after the cutoff never ran
+    active = bisect_left(offsets, span.end_date - prescription.start_date, hi=len(schedules))
+
+    return [
+        Interval(
+            prescription.start_date + offsets[n],
+            min(prescription.start_date + offsets[n + 1], span.end_date),
+            (prescription.id, schedule.id),
+            schedule,
+        )
+        for n, schedule in enumerate(schedules[:active])
+    ]
+
+
+def get_truncated_prescriptions(prescriptions):
+    """
+    Returns:
+        dict[prescription_id] = cutoff_date
+    """
+    spans = compute_prescription_spans(prescriptions)
+    return {
+        pid: span.cutoff for pid, span in spans.items() if span.cutoff
+    }
 
-    for meds in by_medication.values():
-        meds.sort(key=lambda p: p.start_date)
 
-        for i, p in enumerate(meds):
-            natural_end = get_prescription_end_date(p)
-            if not natural_end:
-                continue
+def get_timeline_queryset(**filters):
+    return (
+        Prescription.objects.filter(start_date__isnull=False, **filters)
+        .select_related("medication")
+        .prefetch_related("dosageschedule_set")
+    )
+
 
-            if i + 1 < len(meds):
-                next_p = meds[i + 1]
-                if next_p.start_date < natural_end:
-                    result[p.id] = next_p.start_date
+def load_timeline_prescriptions(queryset, date_from=None, date_to=None):
+    """
+    Loads the dated prescriptions of queryset whose natural span overlaps
+    the window, plus the same-medication neighbours that start inside one
+    of those spans. Neighbours can lie outside the window but still decide
+    where a windowed prescription gets truncated.
 
-    return result
+    Returns:
+        (prescriptions, neighbours)
+    """
+    window = queryset.filter(start_date__isnull=False)
+    if date_to:
+        window = window.filter(start_date__lte=date_to)
+    if date_from:
+        window = window.filter(end_date__gte=date_from)
+    with span("timeline-load"):
+        prescriptions = list(window)
+
+    if not prescriptions or not (date_from or date_to):
+        return prescriptions, []
+
+    loaded = {p.id for p in prescriptions}
+    candidates = (
+        queryset.select_related(None)
+        .prefetch_related(None)
+        .filter(
+            medication_id__in={p.medication_id for p in prescriptions},
+            start_date__gte=min(p.start_date for p in prescriptions),
+            start_date__lt=max(p.end_date for p in prescriptions),
+        )
+        .only("id", "patient_id", "medication_id", "start_date", "end_date", "total_duration")
+    )
+    with span("timeline-neighbours"):
+        neighbours = [p for p in candidates if p.id not in loaded]
+    return prescriptions, neighbours
+
+
+def build_timeline_items(prescriptions, date_from=None, date_to=None, neighbours=(), lanes=False):
+    """
+    Builds the timeline payload. Pass prescriptions with dosageschedule_set
+    prefetched and medication selected to keep the query count constant.
+    When a window is given, neighbours only take part in truncation and
+    items whose truncated span falls outside the window are dropped.
+    With lanes=True every item also gets a "lane" (see assign_lanes).
+    """
+    with span("timeline-load"):
+        prescriptions = list(prescriptions)
+    with span("timeline-truncate"):
+        spans = compute_prescription_spans([*prescriptions, *neighbours])
+    with span("timeline-items"):
+        items = _build_items(prescriptions, spans, date_from, date_to)
+    if lanes:
+        with span("timeline-lanes"):
+            assign_lanes(items)
+    return items
 
 
-def build_timeline_items(prescriptions):
-    cutoffs = get_truncated_prescriptions(prescriptions)
+def assign_lanes(items):
+    """
+    Packs items into as few rows ("lanes") as possible: a lane is free
+    again from the day its item ends. Items are placed in (start, id) order
+    onto the lane their medication used last if it is free, otherwise the
+    lowest free lane, so an edit only moves items that start after it.
+    Sets item["lane"] and returns the number of lanes.
+    """
+    busy = []  # (end_date, lane) heap
+    free = []  # lane heap, entries may be stale
+    is_free = set()
+    last_lane = {}
+    lane_count = 0
+
+    for item in sorted(items, key=lambda i: (i["start_date"], i["id"])):
+        while busy and busy[0][0] <= item["start_date"]:
+            _, lane = heapq.heappop(busy)
+            heapq.heappush(free, lane)
+            is_free.add(lane)
+
+        lane = last_lane.get(item["medication"])
+        if lane not in is_free:
+            while free and free[0] not in is_free:
+                heapq.heappop(free)
+            if free:
+                lane = heapq.heappop(free)
+            else:
+                lane = lane_count
+                lane_count += 1
+        is_free.discard(lane)
+
+        item["lane"] = lane
+        last_lane[item["medication"]] = lane
+        heapq.heappush(busy, (item["end_date"], lane))
+
+    return lane_count
+
+
+def _build_items(prescriptions, spans, date_from, date_to):
     items = []
 
     for p in prescriptions:
-        if not p.start_date:
+        span = spans.get(p.id)
+        if span is None:
             continue
-
-        natural_end = get_prescription_end_date(p)
-        if not natural_end:
+        if date_from and span.end_date < date_from:
+            continue
+        if date_to and p.start_date > date_to:
             continue
 
-        cutoff = cutoffs.get(p.id)
-        end_date = cutoff if cutoff else natural_end
-
-        dosages = [
-            {
+        segments = {s.data.id: s for s in get_schedule_segments(p, span)}
+        dosages = []
+        for d in sorted(p.dosageschedule_set.all(), key=lambda d: d.id):
+            segment = segments.get(d.id)
+            dosages.append({
                 "dose": d.dose,
                 "frequency": d.frequency,
                 "route": d.route,
-                "duration": str(d.duration) if d.duration else None
-            }
-            for d in p.dosageschedule_set.all()
-        ]
+                "duration": str(d.duration) if d.duration else None,
+                "start_date": segment.start if segment else None,
+                "end_date": segment.end if segment else None,
+                "dose_amount": d.dose_amount,
+                "dose_unit": d.dose_unit,
+                "doses_per_day": d.doses_per_day,
+                "daily_amount": d.daily_amount,
+            })
 
         items.append({
             "id": p.id,
             "medication": p.medication.name,
             "start_date": p.start_date,
-            "end_date": end_date,
-            "natural_end_date": natural_end,
-            "is_truncated": cutoff is not None,
+            "end_date": span.end_date,
+            "natural_end_date": span.natural_end,
+            "is_truncated": span.cutoff is not None,
             "dosages": dosages,
             "notes": p.notes,
         })
 
     return items
+
+
+def build_medication_group_items(patient_id, medication_id):
+    """
+    Timeline items for one patient's prescriptions of one medication.
+    Truncation never crosses medications, so this is everything a write
+    to one of those prescriptions can change.
+    """
+    return build_timeline_items(
+        get_timeline_queryset(patient_id=patient_id, medication_id=medication_id)
+    )
@@ -0,0 +1,83 @@
+from django.db.models import QuerySet
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.dispatch import receiver
+from . import search, sync
+from .models import Patient, Medication, Facility, Prescription, DosageSchedule
+
+
+def _deleted_by_cascade(origin):
+    """
+    True when a delete started from another model (e.g. the prescription
+    itself), in which case there is nothing left to keep in sync
+    """
+    if origin is None:
+        return False
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return model is not DosageSchedule
+
+
+def _deleted_with_patient(origin):
+    """
+    True when the patient itself is being deleted, taking its history along
+    """
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    return model is Patient
+
+
+@receiver([post_save, post_delete], sender=DosageSchedule)
+def schedule_changed(sender, instance, **kwargs):
+    """
+    Keeps Prescription.total_duration / end_date in sync with its schedules
+    and invalidates the patient's cached timeline
+    """
+    if sync.is_deferred() or _deleted_by_cascade(kwargs.get("origin")):
+        return
+
+    sync.sync_prescriptions({
+        instance.prescription_id,
+        getattr(instance, "_loaded_prescription_id", None),
+    })
+
+
+@receiver([post_save, post_delete], sender=Prescription)
+def prescription_changed(sender, instance, **kwargs):
+    if sync.is_deferred():
+        return
+
+    if kwargs["signal"] is post_save:
+        sync.prescription_saved(instance)
+    else:
+        sync.prescription_deleted(instance, _deleted_with_patient(kwargs.get("origin")))
+
+
+@receiver([post_save, post_delete], sender=Medication)
+def medication_changed(sender, instance, **kwargs):
+    if kwargs["signal"] is post_delete:
+        # Its prescriptions were deleted with it and followed their own deletes
+        search.medication_deleted(instance.pk)
+        return
+    search.medications_saved([instance])
+    if not kwargs["created"]:
+        sync.references_changed(Prescription.objects.filter(medication=instance))
+
+
+@receiver(post_save, sender=Patient)
+def patient_changed(sender, instance, created, **kwargs):
+    if not created:
+        sync.patient_saved(instance)
+
+
+@receiver([post_save, pre_delete], sender=Facility)
+def facility_changed(sender, instance, **kwargs):
+    # Before a delete, while its prescriptions still point at it
+    if not kwargs.get("created"):
+        sync.references_changed(Prescription.objects.filter(source_facility=instance))
+
+
+@receiver([post_save, pre_delete], sender=User)
+def contributor_changed(sender, instance, update_fields=None, **kwargs):
+    # Logins save last_login only; payloads show the username
+    if kwargs.get("created") or (update_fields is not None and "username" not in update_fields):
+        return
+    sync.references_changed(Prescription.objects.filter(contributor=instance))
@@ -0,0 +1,132 @@
+"""
+Bookkeeping that has to follow every Prescription / DosageSchedule write:
+the stored schedule totals, the per-patient timeline version, the
+persisted timeline (medications.projection), the change log
+(medications.history) and the change feed (medications.events). Writes
+to the patients, medications, facilities and users the cached payloads
+embed only bump the timeline version.
+
+medications.signals calls into this module for single-row writes. Bulk
+writes (bulk_create, nested serializer writes, imports) skip the signals,
+so they run inside deferred() and call sync_prescriptions() once at the end.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import transaction
+
+from . import events, history, projection
+from .cache import bump_timeline_version
+from .models import Prescription
+
+_state = threading.local()
+
+
+@contextmanager
+def deferred():
+    """
+    Suspends the per-row signal bookkeeping on this thread. The caller is
+    responsible for calling sync_prescriptions() for what it wrote.
+    """
+    previous = getattr(_state, "deferred", False)
+    _state.deferred = True
+    try:
+        yield
+    finally:
+        _state.deferred = previous
+
+
+def is_deferred():
+    return getattr(_state, "deferred", False)
+
+
+def _undated_changed(patient_ids):
+    # Undated prescriptions aren't in the projection, so the feed only says
+    # the list changed
+    for patient_id in patient_ids:
+        if patient_id and events.is_watched(patient_id):
+            events.publish(patient_id, {"type": "undated_changed"})
+
+
+def sync_prescriptions(prescription_ids, patient_ids=()):
+    """
+    Recomputes stored totals for the given prescriptions and invalidates
+    the timelines of their patients (plus any extra patient_ids, e.g. the
+    owner of a deleted prescription)
+    """
+    prescription_ids = {pid for pid in prescription_ids if pid}
+    prescriptions = Prescription.objects.filter(pk__in=prescription_ids)
+    with transaction.atomic():
+        prescriptions.refresh_schedule_totals()
+        projection.refresh_groups(prescription_ids=prescription_ids)
+        history.record_changes(saved_ids=prescription_ids)
+        _undated_changed(set(prescriptions.filter(start_date__isnull=True).values_list("patient_id", flat=True)))
+        # Last, so a read racing this write can't cache the old projection
+        # under the new version
+        bump_timeline_version(
+            {*patient_ids, *prescriptions.values_list("patient_id", flat=True)}
+        )
+
+
+def prescription_saved(prescription):
+    """
+    Follows a single Prescription save, including one that moved it to
+    another patient or medication
+    """
+    previous_patient_id = getattr(prescription, "_loaded_patient_id", None)
+    previous_group = (previous_patient_id, getattr(prescription, "_loaded_medication_id", None))
+    moved = previous_patient_id not in (None, prescription.patient_id)
+
+    was_undated = previous_patient_id is not None and getattr(prescription, "_loaded_start_date", None) is None
+    with transaction.atomic():
+        projection.refresh_groups({previous_group}, {prescription.pk})
+        history.record_changes(
+            saved_ids={prescription.pk},
+            deleted=[(prescription.pk, previous_patient_id)] if moved else (),
+        )
+        if prescription.start_date is None or was_undated:
+            _undated_changed({prescription.patient_id, previous_patient_id})
+        bump_timeline_version({prescription.patient_id, previous_patient_id})
+
+
+def prescription_deleted(prescription, with_patient=False):
+    """
+    Follows a single Prescription delete. When the patient itself is being
+    deleted its timeline and history go with it.
+    """
+    if with_patient:
+        bump_timeline_version({prescription.patient_id})
+        return
+    with transaction.atomic():
+        if prescription.start_date is None:
+            _undated_changed({prescription.patient_id})
+        elif events.is_watched(prescription.patient_id):
+            # Its projection row went with it, so refresh_groups() can't see it
+            events.publish(prescription.patient_id, {"type": "removed", "id": prescription.pk})
+        projection.refresh_groups({(prescription.patient_id, prescription.medication_id)})
+        history.record_changes(deleted=[(prescription.pk, prescription.patient_id)])
+        bump_timeline_version({prescription.patient_id})
+
+
+def sync_patients(patient_ids):
+    """
+    Invalidates and rebuilds the timelines of patients whose prescriptions
+    were written in bulk with their totals already set (imports, generated data)
+    """
+    patient_ids = set(patient_ids)
+    projection.rebuild_patients(patient_ids)
+    history.record_bulk_write(patient_ids)
+    bump_timeline_version(patient_ids)
+
+
+def patient_saved(patient):
+    bump_timeline_version({patient.pk})
+
+
+def references_changed(prescriptions):
+    """
+    Follows a write to a medication, facility or user the given
+    prescriptions point at. The projection only stores their ids, so only
+    the cached payloads of the prescriptions' patients go stale.
+    """
+    bump_timeline_version(prescriptions.values("patient_id"))
@@ -0,0 +1,166 @@
+"""
+Synthetic prescription histories for benchmarks and load tests.
+
+Everything is written with bulk_create and the stored totals filled in
+directly, so no per-row signal work runs while generating.
+"""
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import date, timedelta
+
+from django.db import transaction
+
+from . import search, sync
+from .choices import Route
+from .models import Patient, Medication, Prescription, DosageSchedule
+
+MEDICATION_NAMES = (
+    "Aspirin", "Ibuprofen", "Paracetamol", "Amoxicillin", "Metformin",
+    "Lisinopril", "Atorvastatin", "Omeprazole", "Amlodipine", "Metoprolol",
+    "Simvastatin", "Losartan", "Albuterol", "Gabapentin", "Sertraline",
+    "Prednisone", "Levothyroxine", "Warfarin", "Furosemide", "Insulin glargine",
+)
+DOSES = ("5mg", "10mg", "20mg", "50mg", "100mg", "200mg", "500mg", "1g")
+FREQUENCIES = ("once daily", "twice daily", "three times daily", "every 6 hours", "as needed")
+
+
+def get_medications(count):
+    """
+    Returns count Medication ids, creating the missing ones
+    """
+    names = [
+        MEDICATION_NAMES[i] if i < len(MEDICATION_NAMES) else f"Synthetic medication {i}"
+        for i in range(count)
+    ]
+    existing = dict(Medication.objects.filter(name__in=names).values_list("name", "id"))
+    new = [Medication(name=name) for name in names if name not in existing]
+    for medication in new:
+        medication.normalize()
+    search.medications_saved(Medication.objects.bulk_create(new))
+    existing = dict(Medication.objects.filter(name__in=names).values_list("name", "id"))
+    return [existing[name] for name in names]
+
+
+@dataclass
+class GenerationResult:
+    patient_ids: list = field(default_factory=list)
+    prescriptions: int = 0
+    schedules: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows(self):
+        return len(self.patient_ids) + self.prescriptions + self.schedules
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+
+class _PatientHistory:
+    """
+    Lays out one patient's prescriptions along a moving cursor date
+    """
+
+    def __init__(self, rng, options):
+        self.rng = rng
+        self.options = options
+        self.cursor = date(2000, 1, 1) + timedelta(days=rng.randrange(3650))
+        self.last = {}  # medication id -> (start, duration) of its latest course
+
+    def next_start(self, medication_id, duration):
+        rng = self.rng
+        if rng.random() < self.options["undated_fraction"]:
+            return None
+
+        previous = self.last.get(medication_id)
+        if previous and rng.random() < self.options["overlap_rate"]:
+            # Restarted before the previous course ended, so it gets truncated
+            prev_start, prev_duration = previous
+            start = prev_start + timedelta(days=rng.randint(1, max(1, prev_duration.days - 1)))
+        else:
+            start = self.cursor + timedelta(days=rng.randint(0, 30))
+            if previous:
+                start = max(start, previous[0] + previous[1])
+
+        self.last[medication_id] = (start, duration)
+        self.cursor = max(self.cursor, start)
+        return start
+
+
+def generate_dataset(
+    patients,
+    prescriptions_per_patient,
+    medications=20,
+    medications_per_patient=5,
+    overlap_rate=0.1,
+    undated_fraction=0.05,
+    schedules_per_prescription=1,
+    seed=0,
+    batch_size=5000,
+):
+    """
+    Creates patients with prescriptions_per_patient prescriptions each,
+    drawn from medications_per_patient of a pool of medications. Roughly
+    overlap_rate of the dated courses restart a medication before its
+    previous course ended (so that course is truncated) and
+    undated_fraction have no start date. Output is deterministic for a seed.
+    """
+    started = time.perf_counter()
+    rng = random.Random(seed)
+    medication_ids = get_medications(medications)
+    routes = [route for route in Route.values if route != Route.OTHER]
+    options = {"overlap_rate": overlap_rate, "undated_fraction": undated_fraction}
+    result = GenerationResult()
+
+    patients_per_batch = max(1, batch_size // max(1, prescriptions_per_patient))
+    for first in range(0, patients, patients_per_batch):
+        count = min(patients_per_batch, patients - first)
+        prescriptions, schedules = [], []
+
+        with transaction.atomic():
+            new_patients = Patient.objects.bulk_create(
+                Patient(name=f"Synthetic patient {first + i}") for i in range(count)
+            )
+            for patient in new_patients:
+                own_medications = rng.sample(medication_ids, min(medications_per_patient, len(medication_ids)))
+                history = _PatientHistory(rng, options)
+
+                for _ in range(prescriptions_per_patient):
+                    medication_id = rng.choice(own_medications)
+                    durations = [
+                        timedelta(days=rng.randint(3, 30)) for _ in range(schedules_per_prescription)
+                    ]
+                    total = sum(durations, timedelta(0))
+                    start = history.next_start(medication_id, total)
+
+                    prescription = Prescription(
+                        patient=patient,
+                        medication_id=medication_id,
+                        start_date=start,
+                        total_duration=total,
+                        end_date=start + total if start else None,
+                    )
+                    prescriptions.append(prescription)
+                    for duration in durations:
+                        schedule = DosageSchedule(
+                            prescription=prescription,
+                            dose=rng.choice(DOSES),
+                            frequency=rng.choice(FREQUENCIES),
+                            route=rng.choice(routes),
+                            duration=duration,
+                        )
+                        schedule.parse_dosing()
+                        schedules.append(schedule)
+
+            Prescription.objects.bulk_create(prescriptions, batch_size=batch_size)
+            DosageSchedule.objects.bulk_create(schedules, batch_size=batch_size)
+            sync.sync_patients(p.pk for p in new_patients)
+
+        result.patient_ids.extend(p.pk for p in new_patients)
+        result.prescriptions += len(prescriptions)
+        result.schedules += len(schedules)
+
+    result.elapsed = time.perf_counter() - started
+    return result
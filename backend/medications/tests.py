@@ -1,3 +1,1516 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import unittest
+from unittest import mock
+import random
+import tempfile
+from datetime import date, timedelta
+from io import StringIO
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from backend.instrumentation import normalize_sql
+
+from . import benchmarks, events, projection, renderers, search, views
+from .cache import bump_timeline_version
+from .columnar import decode_timeline
+from .exporters import iter_prescription_rows
+from .dosing import parse_dose, parse_frequency
+from .importers import import_prescriptions
+from .lean import prescription_rows, render_prescriptions
+from .intervals import Interval, IntervalIndex
+from .models import (
+    Patient, Medication, Facility, Prescription, DosageSchedule, TimelineChange, TimelineItem,
+    normalize_name,
+)
+from .projection import read_timeline
+from .serializer import PrescriptionSerializer
+from .services import assign_lanes, build_timeline_items, get_timeline_queryset, get_truncated_prescriptions
+from .synthetic import generate_dataset
+
+
+def make_prescription(patient, medication, start_date, *durations, **kwargs):
+    prescription = Prescription.objects.create(
+        patient=patient,
+        medication=medication,
+        start_date=start_date,
+        **kwargs
+    )
+    for days in durations:
+        DosageSchedule.objects.create(
+            prescription=prescription,
+            dose="100mg",
+            frequency="twice daily",
+            route="oral",
+            duration=timedelta(days=days),
+        )
+    return prescription
+
+
+class MedicationsTestCase(TestCase):
+    def setUp(self):
+        caches["timeline"].clear()
+
+
+class TimelineServiceTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.ibuprofen = Medication.objects.create(name="Ibuprofen")
+
+    def prescriptions(self):
+        return (
+            Prescription.objects.filter(patient=self.patient)
+            .select_related("medication")
+            .prefetch_related("dosageschedule_set")
+        )
+
+    def test_overlapping_same_medication_is_truncated(self):
+        first = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 7, 7)
+        second = make_prescription(self.patient, self.aspirin, date(2025, 1, 10), 5)
+        make_prescription(self.patient, self.ibuprofen, date(2025, 1, 5), 30)
+
+        cutoffs = get_truncated_prescriptions(self.prescriptions())
+        self.assertEqual(cutoffs, {first.id: date(2025, 1, 10)})
+
+        items = {i["id"]: i for i in build_timeline_items(self.prescriptions())}
+        self.assertEqual(items[first.id]["natural_end_date"], date(2025, 1, 15))
+        self.assertEqual(items[first.id]["end_date"], date(2025, 1, 10))
+        self.assertTrue(items[first.id]["is_truncated"])
+        self.assertEqual(items[second.id]["end_date"], date(2025, 1, 15))
+        self.assertFalse(items[second.id]["is_truncated"])
+
+    def test_undated_prescriptions_are_skipped(self):
+        make_prescription(self.patient, self.aspirin, None, 3)
+        self.assertEqual(build_timeline_items(self.prescriptions()), [])
+
+    def test_timeline_query_count_is_constant(self):
+        client = APIClient()
+        url = f"/api/patients/{self.patient.id}/timeline/"
+
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 7, 3)
+        with CaptureQueriesContext(connection) as small:
+            client.get(url)
+
+        for i in range(40):
+            medication = self.aspirin if i % 2 else self.ibuprofen
+            make_prescription(self.patient, medication, date(2025, 2, 1) + timedelta(days=i), 7, 3)
+        with self.assertNumQueries(len(small)):
+            response = client.get(url)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 41)
+
+
+class PrescriptionTotalsTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.prescription = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 7)
+
+    def assertTotals(self, days, end_date):
+        self.prescription.refresh_from_db()
+        self.assertEqual(self.prescription.total_duration, timedelta(days=days))
+        self.assertEqual(self.prescription.end_date, end_date)
+
+    def test_schedule_writes_through_api_keep_totals_in_sync(self):
+        self.assertTotals(7, date(2025, 1, 8))
+
+        response = self.client.post("/api/dosageschedules/", {
+            "prescription": self.prescription.id,
+            "dose": "50mg",
+            "duration": 3,
+        }, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertTotals(10, date(2025, 1, 11))
+
+        schedule_id = response.data["id"]
+        self.client.patch(f"/api/dosageschedules/{schedule_id}/", {"duration": 5}, format="json")
+        self.assertTotals(12, date(2025, 1, 13))
+
+        self.client.delete(f"/api/dosageschedules/{schedule_id}/")
+        self.assertTotals(7, date(2025, 1, 8))
+
+    def test_start_date_change_moves_end_date(self):
+        self.client.patch(f"/api/prescriptions/{self.prescription.id}/", {"start_date": "2025-02-01"}, format="json")
+        self.assertTotals(7, date(2025, 2, 8))
+
+    def test_moving_schedule_refreshes_both_prescriptions(self):
+        other = make_prescription(self.patient, self.aspirin, date(2025, 3, 1))
+        schedule = DosageSchedule.objects.get(prescription=self.prescription)
+        schedule.prescription = other
+        schedule.save()
+
+        self.assertTotals(0, date(2025, 1, 1))
+        other.refresh_from_db()
+        self.assertEqual(other.end_date, date(2025, 3, 8))
+
+    def test_backfill_command(self):
+        other = Patient.objects.create(name="Other Patient")
+        make_prescription(other, self.aspirin, date(2025, 1, 1), 7)
+        Prescription.objects.filter(patient=self.patient).update(total_duration=timedelta(0), end_date=None)
+        TimelineItem.objects.filter(patient=self.patient).update(end_date=date(2025, 1, 1))
+        versions = dict(Patient.objects.values_list("id", "timeline_version"))
+
+        call_command("backfill_prescription_totals", stdout=StringIO())
+        self.assertTotals(7, date(2025, 1, 8))
+        self.assertEqual(read_timeline(self.patient.id)[0]["end_date"], date(2025, 1, 8))
+        # Only the patient whose totals changed is rebuilt
+        self.assertEqual(dict(Patient.objects.values_list("id", "timeline_version")), {
+            self.patient.id: versions[self.patient.id] + 1, other.id: versions[other.id],
+        })
+
+
+class TimelineWindowTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.ibuprofen = Medication.objects.create(name="Ibuprofen")
+        self.url = f"/api/patients/{self.patient.id}/timeline/"
+
+    def get_items(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return {item["id"]: item for item in response.data}
+
+    def test_window_returns_only_overlapping_prescriptions(self):
+        old = make_prescription(self.patient, self.aspirin, date(2020, 1, 1), 10)
+        current = make_prescription(self.patient, self.ibuprofen, date(2025, 1, 1), 30)
+        future = make_prescription(self.patient, self.aspirin, date(2026, 1, 1), 10)
+
+        items = self.get_items(**{"from": "2025-01-10", "to": "2025-06-01"})
+        self.assertEqual(set(items), {current.id})
+        self.assertNotIn(old.id, items)
+        self.assertNotIn(future.id, items)
+
+    def test_truncation_uses_neighbours_outside_the_window(self):
+        # Truncated by a course that starts after the window ends
+        long_course = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 60)
+        make_prescription(self.patient, self.aspirin, date(2025, 2, 10), 5)
+
+        items = self.get_items(**{"from": "2025-01-01", "to": "2025-01-31"})
+        self.assertEqual(items[long_course.id]["end_date"], date(2025, 2, 10))
+        self.assertTrue(items[long_course.id]["is_truncated"])
+
+        # Superseded by a course that ends before the window starts
+        make_prescription(self.patient, self.ibuprofen, date(2024, 1, 1), 365)
+        make_prescription(self.patient, self.ibuprofen, date(2024, 2, 1), 10)
+        items = self.get_items(**{"from": "2024-06-01", "to": "2024-06-30"})
+        self.assertEqual(items, {})
+
+    def test_invalid_window_is_rejected(self):
+        self.assertEqual(self.client.get(self.url, {"from": "yesterday"}).status_code, 400)
+        self.assertEqual(
+            self.client.get(self.url, {"from": "2025-02-01", "to": "2025-01-01"}).status_code,
+            400,
+        )
+
+
+class TimelineCacheTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.prescription = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 7)
+        self.url = f"/api/patients/{self.patient.id}/timeline/"
+
+    def test_repeat_reads_are_served_from_cache(self):
+        self.client.get(self.url)
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.data), 1)
+
+        stats = self.client.get("/api/timeline-cache/").data
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+    def test_writes_bump_the_patient_version(self):
+        self.client.get(self.url)
+        version = Patient.objects.get(pk=self.patient.pk).timeline_version
+
+        schedule = DosageSchedule.objects.get(prescription=self.prescription)
+        self.client.patch(f"/api/dosageschedules/{schedule.id}/", {"duration": 3}, format="json")
+        self.assertGreater(Patient.objects.get(pk=self.patient.pk).timeline_version, version)
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.data[0]["end_date"], date(2025, 1, 4))
+
+        self.client.delete(f"/api/prescriptions/{self.prescription.id}/")
+        self.assertEqual(self.client.get(self.url).data, [])
+
+    def test_stats_reset(self):
+        self.client.get(self.url)
+        self.assertEqual(self.client.delete("/api/timeline-cache/reset/").status_code, 204)
+        self.assertEqual(self.client.get("/api/timeline-cache/").data["misses"], 0)
+
+
+class ConditionalTimelineTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.prescription = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 7)
+
+    def test_matching_etag_returns_304_without_computing(self):
+        for action in ("timeline", "undated_medications"):
+            url = f"/api/patients/{self.patient.id}/{action}/"
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("Last-Modified", response)
+
+            with self.assertNumQueries(1):
+                cached = self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+            self.assertEqual(cached.status_code, 304)
+            self.assertEqual(cached["ETag"], response["ETag"])
+
+    def test_writes_and_windows_change_the_etag(self):
+        url = f"/api/patients/{self.patient.id}/timeline/"
+        etag = self.client.get(url)["ETag"]
+        self.assertNotEqual(self.client.get(url, {"to": "2025-01-02"})["ETag"], etag)
+
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 3), 7)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 2)
+
+    def test_renaming_what_the_payloads_show_changes_the_etag(self):
+        facility = Facility.objects.create(name="Ward A")
+        contributor = User.objects.create(username="nurse")
+        Prescription.objects.filter(pk=self.prescription.pk).update(
+            source_facility=facility, contributor=contributor
+        )
+        url = f"/api/patients/{self.patient.id}/timeline/"
+
+        for instance, field in [(self.aspirin, "name"), (facility, "name"), (self.patient, "name"),
+                                (contributor, "username")]:
+            etag = self.client.get(url)["ETag"]
+            setattr(instance, field, "Renamed")
+            instance.save()
+            self.assertNotEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(url).data[0]["medication"], "Renamed")
+
+        etag = self.client.get(url)["ETag"]
+        contributor.save(update_fields=["last_login"])
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_saving_a_stale_patient_keeps_the_version(self):
+        stale = Patient.objects.get(pk=self.patient.pk)
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 3), 7)
+        version = Patient.objects.get(pk=self.patient.pk).timeline_version
+
+        stale.save()
+        self.assertGreater(Patient.objects.get(pk=self.patient.pk).timeline_version, version)
+
+
+class BatchTimelineTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.aspirin = Medication.objects.create(name="Aspirin")
+
+    def make_patients(self, count):
+        patients = []
+        for i in range(count):
+            patient = Patient.objects.create(name=f"Patient {i}")
+            make_prescription(patient, self.aspirin, date(2025, 1, 1), 10)
+            make_prescription(patient, self.aspirin, date(2025, 1, 5), 3)
+            patients.append(patient)
+        return patients
+
+    def get_timelines(self, patients, **params):
+        params["ids"] = ",".join(str(p.id) for p in patients)
+        response = self.client.get("/api/patients/timelines/", params)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(b"".join(response.streaming_content))
+
+    def test_timelines_are_grouped_per_patient(self):
+        patients = self.make_patients(3)
+        rows = self.get_timelines(list(reversed(patients)))
+
+        self.assertEqual([row["patient"] for row in rows], [p.id for p in reversed(patients)])
+        for row in rows:
+            items = sorted(row["timeline"], key=lambda item: item["start_date"])
+            self.assertEqual([item["is_truncated"] for item in items], [True, False])
+            self.assertEqual(items[0]["end_date"], "2025-01-05")
+
+    def test_query_count_does_not_grow_with_patients(self):
+        small = self.make_patients(2)
+        with CaptureQueriesContext(connection) as queries:
+            self.get_timelines(small, **{"from": "2025-01-01"})
+
+        patients = small + self.make_patients(8)
+        caches["timeline"].clear()
+        with self.assertNumQueries(len(queries)):
+            rows = self.get_timelines(patients, **{"from": "2025-01-01"})
+        self.assertEqual(len(rows), 10)
+
+    def test_patients_are_read_in_chunks(self):
+        patients = self.make_patients(5)
+        get_many_cached = mock.Mock(wraps=views.timeline_cache.get_many_cached)
+        with (
+            mock.patch.object(views, "TIMELINES_CHUNK_SIZE", 2),
+            mock.patch.object(views.timeline_cache, "get_many_cached", get_many_cached),
+        ):
+            rows = self.get_timelines(list(reversed(patients)))
+        self.assertEqual([row["patient"] for row in rows], [p.id for p in reversed(patients)])
+        self.assertEqual([len(call.args[0]) for call in get_many_cached.call_args_list], [2, 2, 1])
+
+    async def test_timelines_stream_under_asgi(self):
+        patients = await sync_to_async(self.make_patients)(2)
+        ids = ",".join(str(p.id) for p in patients)
+        response = await self.async_client.get("/api/patients/timelines/", {"ids": ids})
+        self.assertTrue(response.is_async)
+        rows = json.loads(b"".join([chunk async for chunk in response.streaming_content]))
+        self.assertEqual([row["patient"] for row in rows], [p.id for p in patients])
+
+    def test_invalid_ids_are_rejected(self):
+        self.assertEqual(self.client.get("/api/patients/timelines/", {"ids": "1,x"}).status_code, 400)
+        self.assertEqual(self.client.get("/api/patients/timelines/").status_code, 400)
+
+
+class NestedPrescriptionWriteTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+
+    def create(self, **extra):
+        payload = {
+            "patient": self.patient.id,
+            "medication": self.aspirin.id,
+            "start_date": "2025-01-01",
+            "notes": "",
+            "dosage_schedules": [
+                {"dose": "100mg", "frequency": "daily", "route": "oral", "duration": 7},
+                {"dose": "50mg", "frequency": "daily", "route": "oral", "duration": 3},
+            ],
+            **extra,
+        }
+        return self.client.post("/api/prescriptions/", payload, format="json")
+
+    def test_create_writes_schedules_and_returns_timeline_items(self):
+        earlier = make_prescription(self.patient, self.aspirin, date(2024, 12, 28), 30)
+        response = self.create()
+        self.assertEqual(response.status_code, 201)
+
+        prescription = Prescription.objects.get(pk=response.data["id"])
+        self.assertEqual(prescription.dosageschedule_set.count(), 2)
+        self.assertEqual(prescription.end_date, date(2025, 1, 11))
+        self.assertEqual(len(response.data["dosage_schedules"]), 2)
+
+        items = {item["id"]: item for item in response.data["timeline_items"]}
+        self.assertEqual(items[earlier.id]["end_date"], date(2025, 1, 1))
+        self.assertEqual(items[prescription.id]["end_date"], date(2025, 1, 11))
+
+    def test_query_count_does_not_depend_on_schedule_count(self):
+        self.create(start_date="2024-01-01")  # starts the patient's history
+        with CaptureQueriesContext(connection) as queries:
+            self.create()
+        schedules = [{"dose": "1mg", "duration": 1}] * 20
+        with self.assertNumQueries(len(queries)):
+            self.create(start_date="2025-03-01", dosage_schedules=schedules)
+
+    def test_invalid_schedule_leaves_nothing_behind(self):
+        response = self.create(dosage_schedules=[{"dose": "1mg", "duration": "soon"}])
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Prescription.objects.exists())
+
+    def test_create_rejects_schedule_ids(self):
+        existing = DosageSchedule.objects.get(prescription=make_prescription(self.patient, self.aspirin, None, 1))
+        for schedule_id in (existing.id, existing.id + 100):
+            response = self.create(dosage_schedules=[{"id": schedule_id, "dose": "1mg", "duration": 1}])
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(Prescription.objects.count(), 1)
+
+    def test_update_replaces_schedules(self):
+        created = self.create().data
+        keep, drop = created["dosage_schedules"]
+        response = self.client.patch(f"/api/prescriptions/{created['id']}/", {
+            "dosage_schedules": [
+                {"id": keep["id"], "duration": 10},
+                {"dose": "25mg", "duration": 2},
+            ],
+        }, format="json")
+        self.assertEqual(response.status_code, 200)
+
+        schedules = DosageSchedule.objects.filter(prescription_id=created["id"])
+        self.assertEqual(schedules.count(), 2)
+        self.assertFalse(schedules.filter(pk=drop["id"]).exists())
+        self.assertEqual(response.data["timeline_items"][0]["end_date"], date(2025, 1, 13))
+
+    def test_update_rejects_foreign_schedule_ids(self):
+        created = self.create().data
+        other = make_prescription(self.patient, self.aspirin, None, 1)
+        foreign = DosageSchedule.objects.get(prescription=other)
+        response = self.client.patch(f"/api/prescriptions/{created['id']}/", {
+            "dosage_schedules": [{"id": foreign.id, "duration": 1}],
+        }, format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(DosageSchedule.objects.filter(prescription_id=created["id"]).count(), 2)
+
+
+class ImportPrescriptionsTests(MedicationsTestCase):
+    CSV = (
+        "prescription_ref,patient,medication,facility,facility_external_id,start_date,notes,dose,frequency,route,duration_days\n"
+        "a,Jane Doe,Aspirin,General Hospital,GH001,2025-01-01,pain,100mg,daily,oral,7\n"
+        "a,Jane Doe,Aspirin,General Hospital,GH001,2025-01-01,pain,50mg,daily,oral,3\n"
+        "b,Jane Doe,Ibuprofen,,,2025-02-01,,200mg,daily,oral,5\n"
+        "c,Jane Doe,Ibuprofen,,,not-a-date,,200mg,daily,oral,5\n"
+        "d,Jane Doe,Ibuprofen,,,,,200mg,daily,by-mail,5\n"
+    )
+
+    def test_csv_rows_are_grouped_into_prescriptions(self):
+        result = import_prescriptions(StringIO(self.CSV), "csv", batch_size=2)
+
+        self.assertEqual((result.rows, result.prescriptions, result.schedules), (4, 2, 3))
+        self.assertEqual([line for line, _ in result.errors], [5, 6])
+
+        aspirin = Prescription.objects.get(medication__name="Aspirin")
+        self.assertEqual(aspirin.end_date, date(2025, 1, 11))
+        self.assertEqual(aspirin.source_facility.external_id, "GH001")
+        self.assertEqual(Patient.objects.filter(name="Jane Doe").count(), 1)
+
+    def test_existing_rows_are_reused_and_timelines_invalidated(self):
+        patient = Patient.objects.create(name="Jane Doe")
+        aspirin = Medication.objects.create(name="Aspirin")
+        line = json.dumps({
+            "patient": "Jane Doe",
+            "medication": "Aspirin",
+            "start_date": "2025-01-01",
+            "dosage_schedules": [{"dose": "1mg", "duration_days": 4}],
+        })
+
+        result = import_prescriptions(StringIO(line + "\n\n{broken\n"), "ndjson")
+        self.assertEqual(result.prescriptions, 1)
+        self.assertEqual(len(result.errors), 1)
+
+        prescription = Prescription.objects.get()
+        self.assertEqual((prescription.patient_id, prescription.medication_id), (patient.id, aspirin.id))
+        patient.refresh_from_db()
+        self.assertEqual(patient.timeline_version, 1)
+
+    def test_unknown_references_are_errors_without_create(self):
+        line = json.dumps({"patient": "Nobody", "medication": "Aspirin", "dosage_schedules": []})
+        result = import_prescriptions(StringIO(line), "ndjson", create_missing=False)
+        self.assertEqual(result.prescriptions, 0)
+        self.assertIn("Unknown patient", result.errors[0][1])
+
+    def test_each_patient_is_rebuilt_once_per_import(self):
+        lines = [
+            json.dumps({"patient": patient, "medication": "Aspirin", "start_date": f"2025-01-0{day}",
+                        "dosage_schedules": [{"dose": "1mg", "duration_days": 1}]})
+            for day in (1, 2, 3) for patient in ("Jane Doe", "John Roe")
+        ]
+        with mock.patch.object(projection, "rebuild_patients", wraps=projection.rebuild_patients) as rebuild:
+            result = import_prescriptions(StringIO("\n".join(lines)), "ndjson", batch_size=1)
+        self.assertEqual(result.prescriptions, 6)
+        rebuild.assert_called_once_with(set(Patient.objects.values_list("id", flat=True)))
+        self.assertEqual(TimelineItem.objects.count(), 6)
+        self.assertEqual(set(Patient.objects.values_list("timeline_version", flat=True)), {1})
+
+    def test_out_of_range_rows_are_row_errors(self):
+        lines = [
+            json.dumps({"patient": "Jane Doe", "medication": "Aspirin", "start_date": start_date,
+                        "dosage_schedules": [{"dose": "1mg", "duration_days": days}]})
+            for start_date, days in (("9999-12-01", 90), ("2025-01-01", 10 ** 12), ("2025-01-01", 7))
+        ]
+        result = import_prescriptions(StringIO("\n".join(lines)), "ndjson")
+        self.assertEqual(result.prescriptions, 1)
+        errors = dict(result.errors)
+        self.assertEqual(sorted(errors), [1, 2])
+        self.assertIn("out of range", errors[2])
+
+    def test_malformed_schedules_are_row_errors(self):
+        lines = [
+            json.dumps({"patient": "Jane Doe", "medication": "Aspirin", "dosage_schedules": schedules})
+            for schedules in (["oops"], {"dose": "1mg"}, "1mg daily")
+        ]
+        result = import_prescriptions(StringIO("\n".join(lines)), "ndjson")
+        self.assertEqual(result.prescriptions, 0)
+        self.assertEqual([line for line, _ in result.errors], [1, 2, 3])
+        self.assertIn("dosage_schedules", result.errors[0][1])
+
+    def test_fhir_medication_statement(self):
+        statement = {
+            "resourceType": "MedicationStatement",
+            "subject": {"reference": "Patient/p-42", "display": "John Roe"},
+            "medicationCodeableConcept": {"coding": [{"code": "1191", "display": "Aspirin"}]},
+            "effectivePeriod": {"start": "2025-03-01T08:00:00Z"},
+            "informationSource": {"reference": "Organization/GH001", "display": "General Hospital"},
+            "note": [{"text": "after meals"}],
+            "dosage": [{
+                "route": {"text": "Oral"},
+                "doseAndRate": [{"doseQuantity": {"value": 100, "unit": "mg"}}],
+                "timing": {"repeat": {"frequency": 2, "period": 1, "periodUnit": "d",
+                                      "boundsDuration": {"value": 2, "code": "wk"}}},
+            }],
+        }
+        result = import_prescriptions(StringIO(json.dumps(statement)), "fhir")
+        self.assertEqual(result.errors, [])
+
+        prescription = Prescription.objects.select_related("patient", "medication").get()
+        self.assertEqual(prescription.patient.external_id, "p-42")
+        self.assertEqual(prescription.medication.name, "Aspirin")
+        self.assertEqual(prescription.end_date, date(2025, 3, 15))
+        schedule = prescription.dosageschedule_set.get()
+        self.assertEqual((schedule.dose, schedule.frequency, schedule.route), ("100mg", "twice daily", "oral"))
+
+    def test_import_endpoint_and_command(self):
+        upload = SimpleUploadedFile("history.csv", self.CSV.encode())
+        response = APIClient().post("/api/prescriptions/import/", {"file": upload}, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["prescriptions"], 2)
+        self.assertEqual(response.data["error_count"], 2)
+
+        with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False) as f:
+            f.write(self.CSV)
+        self.addCleanup(os.remove, f.name)
+        out = StringIO()
+        call_command("import_prescriptions", f.name, stdout=out, stderr=StringIO())
+        self.assertIn("Imported 2 prescriptions", out.getvalue())
+        self.assertEqual(Prescription.objects.count(), 4)
+
+
+class ExportPrescriptionsTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.patients = [Patient.objects.create(name=f"Patient {i}") for i in range(3)]
+        for patient in self.patients:
+            make_prescription(patient, self.aspirin, date(2025, 1, 1), 7, 3)
+            make_prescription(patient, self.aspirin, date(2025, 1, 5), 2)
+            make_prescription(patient, self.aspirin, None, 1)
+
+    def export(self, **params):
+        response = self.client.get("/api/prescriptions/export/", params)
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode()
+
+    def test_ndjson_export_with_timeline_fields(self):
+        rows = [json.loads(line) for line in self.export(include_timeline="1").splitlines()]
+        self.assertEqual(len(rows), 9)
+
+        first = next(row for row in rows if row["start_date"] == "2025-01-01")
+        self.assertEqual(first["natural_end_date"], "2025-01-11")
+        self.assertEqual(first["end_date"], "2025-01-05")
+        self.assertTrue(first["is_truncated"])
+        self.assertEqual([s["duration_days"] for s in first["dosage_schedules"]], [7, 3])
+
+        undated = next(row for row in rows if row["start_date"] is None)
+        self.assertEqual((undated["end_date"], undated["is_truncated"]), (None, False))
+
+    def test_query_count_depends_on_batches_not_rows(self):
+        # Whole patients per batch: 6 + 3 rows, one schedule query each
+        with self.assertNumQueries(3):
+            rows = list(iter_prescription_rows(include_timeline=True, batch_size=4))
+        self.assertEqual(len(rows), 9)
+
+    def test_csv_export_can_be_imported_again(self):
+        content = self.export(format="csv", patients=str(self.patients[0].id))
+        self.assertEqual(len(content.splitlines()), 5)
+
+        Prescription.objects.all().delete()
+        result = import_prescriptions(StringIO(content), "csv")
+        self.assertEqual((result.prescriptions, result.schedules, result.errors), (3, 4, []))
+        self.assertEqual(
+            sorted(Prescription.objects.values_list("end_date", flat=True), key=str),
+            [date(2025, 1, 7), date(2025, 1, 11), None],
+        )
+
+    async def test_export_streams_under_asgi(self):
+        expected = await sync_to_async(self.export)(format="csv")
+        response = await self.async_client.get("/api/prescriptions/export/", {"format": "csv"})
+        self.assertTrue(response.is_async)
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(content.decode(), expected)
+
+    def test_export_round_trips_without_schedules_and_sub_day_durations(self):
+        patient = Patient.objects.create(name="Round Trip")
+        make_prescription(patient, self.aspirin, date(2025, 2, 1))
+        make_prescription(patient, self.aspirin, date(2025, 3, 1), 1.5, 2)
+        expected = [
+            (p.start_date, p.end_date, [s.duration for s in p.dosageschedule_set.order_by("id")])
+            for p in Prescription.objects.filter(patient=patient).order_by("start_date")
+        ]
+
+        for output_format in ("csv", "ndjson"):
+            content = self.export(format=output_format, patients=str(patient.id))
+            Prescription.objects.filter(patient=patient).delete()
+            result = import_prescriptions(StringIO(content), output_format)
+            self.assertEqual(result.errors, [])
+            imported = [
+                (p.start_date, p.end_date, [s.duration for s in p.dosageschedule_set.order_by("id")])
+                for p in Prescription.objects.filter(patient=patient).order_by("start_date")
+            ]
+            self.assertEqual(imported, expected)
+
+    def test_export_command(self):
+        out = StringIO()
+        call_command("export_prescriptions", "--include-timeline", stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 9)
+
+
+class PaginationAndProjectionTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.medications = [Medication.objects.create(name=f"Med {i}") for i in range(5)]
+        for medication in self.medications:
+            make_prescription(self.patient, medication, date(2025, 1, 1), 7, 3)
+
+    def test_list_endpoints_use_cursor_pagination(self):
+        response = self.client.get("/api/medications/", {"page_size": 2})
+        self.assertEqual([m["name"] for m in response.data["results"]], ["Med 0", "Med 1"])
+
+        names = []
+        url = "/api/medications/?page_size=2"
+        while url:
+            response = self.client.get(url)
+            names += [m["name"] for m in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(names, [m.name for m in self.medications])
+
+    def test_prescription_list_query_count_is_bounded(self):
+        with self.assertNumQueries(2):
+            response = self.client.get("/api/prescriptions/")
+        result = response.data["results"][0]
+        self.assertEqual(result["medication"]["name"], "Med 0")
+        self.assertEqual(len(result["dosage_schedules"]), 2)
+
+    def test_fields_projection_skips_nested_serializers(self):
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/prescriptions/", {"fields": "id,start_date"})
+        self.assertEqual(set(response.data["results"][0]), {"id", "start_date"})
+
+        response = self.client.get("/api/prescriptions/", {"fields": "id,medication"})
+        self.assertEqual(response.data["results"][0]["medication"], {"id": self.medications[0].id, "name": "Med 0"})
+
+
+class BenchmarkTests(MedicationsTestCase):
+    def test_tiny_run_and_baseline_comparison(self):
+        results = benchmarks.run_benchmarks(["tiny"], repeat=1)
+        cases = results["results"]["tiny"]
+        self.assertEqual(set(cases), {
+            "get_truncated_prescriptions",
+            "build_timeline_items",
+            "timeline_endpoint",
+            "undated_medications_endpoint",
+            "prescription_serializer",
+            "lean_prescriptions",
+        })
+        self.assertEqual(cases["build_timeline_items"]["queries"], 2)
+        self.assertFalse(Prescription.objects.exists())
+
+        self.assertEqual(benchmarks.compare(results, results), [])
+        slower = json.loads(json.dumps(results))
+        slower["results"]["tiny"]["timeline_endpoint"]["wall_ms"] *= 2
+        slower["results"]["tiny"]["timeline_endpoint"]["queries"] += 1
+        self.assertEqual(len(benchmarks.compare(slower, results)), 2)
+
+
+class SyntheticDataTests(MedicationsTestCase):
+    def layout(self, patient_ids):
+        return list(
+            Prescription.objects.filter(patient_id__in=patient_ids)
+            .order_by("id")
+            .values_list("medication__name", "start_date", "total_duration")
+        )
+
+    def test_generator_knobs_and_seed(self):
+        result = generate_dataset(
+            20, 10, medications=8, medications_per_patient=3, overlap_rate=0.5,
+            undated_fraction=0.2, schedules_per_prescription=2, seed=7, batch_size=25,
+        )
+        self.assertEqual(len(result.patient_ids), 20)
+        self.assertEqual((result.prescriptions, result.schedules), (200, 400))
+        self.assertEqual(DosageSchedule.objects.count(), 400)
+
+        prescriptions = Prescription.objects.filter(patient_id__in=result.patient_ids)
+        undated = prescriptions.filter(start_date__isnull=True).count()
+        self.assertTrue(0 < undated < 100)
+        for patient_id in result.patient_ids:
+            self.assertLessEqual(
+                prescriptions.filter(patient_id=patient_id).values("medication").distinct().count(), 3
+            )
+        truncated = get_truncated_prescriptions(prescriptions.filter(patient_id=result.patient_ids[0]))
+        self.assertTrue(truncated)
+
+        # Stored totals match what the schedules add up to
+        p = prescriptions.filter(start_date__isnull=False).first()
+        self.assertEqual(p.total_duration, sum((d.duration for d in p.dosageschedule_set.all()), timedelta(0)))
+        self.assertEqual(p.end_date, p.start_date + p.total_duration)
+
+        again = generate_dataset(
+            20, 10, medications=8, medications_per_patient=3, overlap_rate=0.5,
+            undated_fraction=0.2, schedules_per_prescription=2, seed=7, batch_size=25,
+        )
+        self.assertEqual(self.layout(result.patient_ids), self.layout(again.patient_ids))
+
+    def test_command_reports_throughput(self):
+        out = StringIO()
+        call_command("generate_synthetic_data", patients=3, prescriptions_per_patient=4, stdout=out)
+        self.assertIn("Created 3 patients, 12 prescriptions and 12 schedules", out.getvalue())
+        self.assertIn("rows/s", out.getvalue())
+
+
+class PerformanceInstrumentationTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = Patient.objects.create(name="Test Patient")
+        aspirin = Medication.objects.create(name="Aspirin")
+        make_prescription(self.patient, aspirin, date(2025, 1, 1), 7)
+        make_prescription(self.patient, aspirin, date(2025, 1, 5), 7)
+
+    def test_disabled_by_default(self):
+        response = APIClient().get(f"/api/patients/{self.patient.id}/timeline/")
+        self.assertNotIn("Server-Timing", response)
+
+    def test_server_timing_and_log_line(self):
+        with override_settings(PERF_INSTRUMENTATION=True):
+            with self.assertLogs("backend.performance", "INFO") as logs:
+                response = APIClient().get(f"/api/patients/{self.patient.id}/timeline/")
+
+        timing = response["Server-Timing"]
+        for name in ("total;dur=", "db;dur=", "serialize;dur=", "timeline-read;dur="):
+            self.assertIn(name, timing)
+
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["view"], "patient-timeline")
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["response_bytes"], len(response.content))
+        self.assertGreater(record["queries"], 0)
+
+    def test_n_plus_one_warning_and_profile_dump(self):
+        with tempfile.TemporaryDirectory() as profile_dir, override_settings(
+            PERF_INSTRUMENTATION=True,
+            PERF_N_PLUS_ONE_THRESHOLD=0,
+            PERF_PROFILE_SAMPLE_RATE=1,
+            PERF_SLOW_REQUEST_MS=0,
+            PERF_PROFILE_DIR=profile_dir,
+        ):
+            with self.assertLogs("backend.performance", "INFO") as logs:
+                APIClient().get(f"/api/patients/{self.patient.id}/timeline/")
+            self.assertEqual(len(os.listdir(profile_dir)), 1)
+
+        warnings = [json.loads(r.getMessage()) for r in logs.records if r.levelname == "WARNING"]
+        self.assertTrue(warnings)
+        self.assertEqual(warnings[0]["view"], "patient-timeline")
+
+    def test_sql_shapes_ignore_literals(self):
+        self.assertEqual(
+            normalize_sql('SELECT * FROM "t" WHERE "id" IN (1, 2, 3) AND "name" = \'x\''),
+            normalize_sql('SELECT * FROM "t" WHERE "id" IN (%s) AND "name" = %s'),
+        )
+
+
+class IntervalIndexTests(TestCase):
+    def test_queries_match_a_linear_scan(self):
+        rng = random.Random(3)
+        base = date(2025, 1, 1)
+        intervals = []
+        for key in range(300):
+            start = base + timedelta(days=rng.randrange(365))
+            intervals.append(Interval(start, start + timedelta(days=rng.randrange(0, 40)), key))
+        index = IntervalIndex(intervals)
+
+        for _ in range(100):
+            start = base + timedelta(days=rng.randrange(-20, 400))
+            end = start + timedelta(days=rng.randrange(1, 30))
+            expected = sorted(
+                (i for i in intervals if i.overlaps(start, end)), key=lambda i: (i.start, i.key)
+            )
+            self.assertEqual(index.overlapping(start, end), expected)
+            self.assertEqual(
+                {i.key for i in index.stabbing(start)},
+                {i.key for i in intervals if i.start <= start < i.end},
+            )
+            following = index.next_starting(start)
+            self.assertEqual(following.start if following else None,
+                             min((i.start for i in intervals if i.start >= start), default=None))
+            ended = index.last_ending(start)
+            self.assertEqual(ended.end if ended else None,
+                             max((i.end for i in intervals if i.end <= start), default=None))
+
+
+class ConflictTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.morphine = Medication.objects.create(name="Morphine")
+        self.saline = Medication.objects.create(name="Saline")
+
+    def test_conflicts_endpoint(self):
+        first = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        second = make_prescription(self.patient, self.aspirin, date(2025, 1, 5), 10)
+        morphine = make_prescription(self.patient, self.morphine, date(2025, 3, 1), 5, 5)
+        saline = make_prescription(self.patient, self.saline, date(2025, 3, 8), 10)
+        DosageSchedule.objects.filter(prescription=morphine).order_by("id").update(route="oral")
+        last_morphine = DosageSchedule.objects.filter(prescription=morphine).order_by("id").last()
+        last_morphine.route = "intravenous"
+        last_morphine.save()
+        DosageSchedule.objects.filter(prescription=saline).update(route="intravenous")
+
+        response = APIClient().get(f"/api/patients/{self.patient.id}/conflicts/", {"max_concurrent": 1})
+        self.assertEqual(response.status_code, 200)
+        by_type = {}
+        for conflict in response.data:
+            by_type.setdefault(conflict["type"], []).append(conflict)
+
+        [overlap] = by_type["same_medication_overlap"]
+        self.assertEqual(overlap["prescriptions"], [first.id, second.id])
+        self.assertEqual((overlap["start_date"], overlap["end_date"]), (date(2025, 1, 5), date(2025, 1, 11)))
+
+        # Only morphine's second (intravenous) segment shares a route with saline
+        [route] = by_type["duplicate_route_overlap"]
+        self.assertEqual(route["prescriptions"], [morphine.id, saline.id])
+        self.assertEqual((route["start_date"], route["end_date"]), (date(2025, 3, 8), date(2025, 3, 11)))
+
+        [crowded] = by_type["multi_segment_overlap"]
+        self.assertEqual(crowded["date"], date(2025, 3, 8))
+        self.assertEqual(crowded["prescriptions"], [morphine.id, saline.id])
+
+        self.assertEqual(
+            APIClient().get(f"/api/patients/{self.patient.id}/conflicts/", {"max_concurrent": "x"}).status_code, 400
+        )
+
+
+class LaneTests(MedicationsTestCase):
+    def item(self, id, medication, start, days):
+        start = date(2025, 1, 1) + timedelta(days=start)
+        return {"id": id, "medication": medication, "start_date": start, "end_date": start + timedelta(days=days)}
+
+    def test_lanes_are_reused_once_free(self):
+        items = [
+            self.item(1, "A", 0, 10),
+            self.item(2, "B", 2, 5),
+            self.item(3, "C", 7, 10),   # B's lane is free again
+            self.item(4, "D", 8, 2),    # needs a third lane
+            self.item(5, "A", 10, 3),   # back onto A's lane
+        ]
+        self.assertEqual(assign_lanes(items), 3)
+        self.assertEqual([i["lane"] for i in items], [0, 1, 1, 2, 0])
+
+    def test_lanes_stay_put_after_a_later_insert(self):
+        items = [self.item(n, f"M{n % 4}", n * 3, 7) for n in range(20)]
+        assign_lanes(items)
+        before = {i["id"]: i["lane"] for i in items}
+
+        items.append(self.item(99, "New", 50, 30))
+        assign_lanes(items)
+        for i in items:
+            if i["start_date"] < date(2025, 1, 1) + timedelta(days=50):
+                self.assertEqual(i["lane"], before[i["id"]])
+
+    def test_timeline_endpoint_with_lanes(self):
+        patient = Patient.objects.create(name="Test Patient")
+        aspirin = Medication.objects.create(name="Aspirin")
+        ibuprofen = Medication.objects.create(name="Ibuprofen")
+        make_prescription(patient, aspirin, date(2025, 1, 1), 10)
+        make_prescription(patient, ibuprofen, date(2025, 1, 3), 3)
+        make_prescription(patient, ibuprofen, date(2025, 1, 20), 3)
+
+        client = APIClient()
+        url = f"/api/patients/{patient.id}/timeline/"
+        response = client.get(url, {"lanes": 1})
+        self.assertEqual(response.data["lane_count"], 2)
+        self.assertEqual([i["lane"] for i in response.data["items"]], [0, 1, 1])
+        self.assertNotEqual(response["ETag"], client.get(url)["ETag"])
+        self.assertIsInstance(client.get(url).data, list)
+
+
+class DosingTests(MedicationsTestCase):
+    def test_parse_dose_and_frequency(self):
+        self.assertEqual(parse_dose("100mg"), (100.0, "mg"))
+        self.assertEqual(parse_dose("1 g"), (1000.0, "mg"))
+        self.assertEqual(parse_dose("250 mcg"), (0.25, "mg"))
+        self.assertEqual(parse_dose("2 tablets"), (2.0, "tablet"))
+        self.assertEqual(parse_dose("a little"), (None, ""))
+        self.assertEqual(parse_frequency("twice daily"), 2.0)
+        self.assertEqual(parse_frequency("3 times a day"), 3.0)
+        self.assertEqual(parse_frequency("every 6 hours"), 4.0)
+        self.assertEqual(parse_frequency("TID"), 3.0)
+        self.assertAlmostEqual(parse_frequency("once weekly"), 1 / 7)
+        self.assertIsNone(parse_frequency("as needed"))
+
+    def test_schedules_store_parsed_values(self):
+        patient = Patient.objects.create(name="Test Patient")
+        aspirin = Medication.objects.create(name="Aspirin")
+        response = APIClient().post("/api/prescriptions/", {
+            "patient": patient.id,
+            "medication": aspirin.id,
+            "start_date": "2025-01-01",
+            "dosage_schedules": [{"dose": "0.5g", "frequency": "every 8 hours", "route": "oral", "duration": 5}],
+        }, format="json")
+        self.assertEqual(response.status_code, 201)
+        schedule = DosageSchedule.objects.get()
+        self.assertEqual((schedule.dose_amount, schedule.dose_unit, schedule.doses_per_day), (500.0, "mg", 3.0))
+
+        schedule.frequency = "once daily"
+        schedule.save(update_fields=["frequency"])
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.doses_per_day, 1.0)
+
+    def test_timeline_segments_are_clipped_at_the_cutoff(self):
+        patient = Patient.objects.create(name="Test Patient")
+        aspirin = Medication.objects.create(name="Aspirin")
+        make_prescription(patient, aspirin, date(2025, 1, 1), 3, 4, 5)
+        make_prescription(patient, aspirin, date(2025, 1, 6), 2)
+
+        first = build_timeline_items(get_timeline_queryset(patient=patient))[0]
+        self.assertEqual(
+            [(d["start_date"], d["end_date"]) for d in first["dosages"]],
+            [(date(2025, 1, 1), date(2025, 1, 4)), (date(2025, 1, 4), date(2025, 1, 6)), (None, None)],
+        )
+        self.assertEqual(first["dosages"][0]["daily_amount"], 200.0)
+
+
+class DoseCalendarTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.ward = Facility.objects.create(name="Ward A")
+        self.alice = Patient.objects.create(name="Alice")
+        self.bob = Patient.objects.create(name="Bob")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.ibuprofen = Medication.objects.create(name="Ibuprofen")
+
+    def test_patient_calendar(self):
+        # 100mg twice daily, truncated on day 3 by a new course
+        make_prescription(self.alice, self.aspirin, date(2025, 1, 1), 5, source_facility=self.ward)
+        later = make_prescription(self.alice, self.aspirin, date(2025, 1, 3), 2)
+        schedule = later.dosageschedule_set.get()
+        schedule.dose, schedule.frequency = "1g", "once daily"
+        schedule.save()
+        make_prescription(self.alice, self.ibuprofen, date(2025, 1, 2), 1)
+
+        response = self.client.get(
+            f"/api/patients/{self.alice.id}/calendar/", {"from": "2025-01-01", "to": "2025-01-06"}
+        )
+        self.assertEqual(response.status_code, 200)
+        rows = {row["medication"]: row for row in response.data["medications"]}
+        self.assertEqual(rows["Aspirin"]["unit"], "mg")
+        self.assertEqual(rows["Aspirin"]["daily_total"], [200, 200, 1000, 1000, 0, 0])
+        self.assertEqual(rows["Aspirin"]["active"], [1, 1, 1, 1, 0, 0])
+        self.assertEqual(rows["Ibuprofen"]["daily_total"], [0, 200, 0, 0, 0, 0])
+        self.assertEqual(response.data["active_medications"], [1, 2, 1, 1, 0, 0])
+
+        cached = self.client.get(
+            f"/api/patients/{self.alice.id}/calendar/",
+            {"from": "2025-01-01", "to": "2025-01-06"},
+            HTTP_IF_NONE_MATCH=response["ETag"],
+        )
+        self.assertEqual(cached.status_code, 304)
+
+    def test_ward_calendar_adds_up_patients(self):
+        make_prescription(self.alice, self.aspirin, date(2025, 1, 1), 3, source_facility=self.ward)
+        make_prescription(self.bob, self.aspirin, date(2025, 1, 2), 3, source_facility=self.ward)
+        make_prescription(self.bob, self.ibuprofen, date(2025, 1, 1), 3)  # another facility
+
+        response = self.client.get(
+            f"/api/facilities/{self.ward.id}/calendar/", {"from": "2025-01-01", "to": "2025-01-05"}
+        )
+        [row] = response.data["medications"]
+        self.assertEqual(row["daily_total"], [200, 400, 400, 200, 0])
+        self.assertEqual(row["active"], [1, 2, 2, 1, 0])
+        self.assertEqual(response.data["active_medications"], [1, 1, 1, 1, 0])
+
+    def test_window_is_bounded(self):
+        response = self.client.get(
+            f"/api/patients/{self.alice.id}/calendar/", {"from": "2000-01-01", "to": "2025-01-01"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+
+class TimelineHistoryTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.url = f"/api/patients/{self.patient.id}/timeline/"
+
+    def as_of(self, moment):
+        return self.client.get(self.url, {"as_of": moment.isoformat()})
+
+    @override_settings(TIMELINE_SNAPSHOT_INTERVAL=2)
+    def test_rebuilds_past_timelines(self):
+        before_history = timezone.now()
+        first = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        after_first = timezone.now()
+
+        second = make_prescription(self.patient, self.aspirin, date(2025, 1, 5), 3)
+        after_second = timezone.now()
+
+        schedule = first.dosageschedule_set.get()
+        schedule.duration = timedelta(days=2)
+        schedule.save()
+        second_id = second.id
+        second.delete()
+        after_edits = timezone.now()
+
+        self.assertEqual(self.as_of(before_history).status_code, 400)
+        self.assertEqual(
+            [(i["id"], i["end_date"]) for i in self.as_of(after_first).data],
+            [(first.id, date(2025, 1, 11))],
+        )
+        self.assertEqual(
+            [(i["id"], i["end_date"], i["is_truncated"]) for i in self.as_of(after_second).data],
+            [(first.id, date(2025, 1, 5), True), (second_id, date(2025, 1, 8), False)],
+        )
+        self.assertEqual(
+            [(i["id"], i["end_date"]) for i in self.as_of(after_edits).data],
+            [(first.id, date(2025, 1, 3))],
+        )
+        self.assertEqual(
+            json.loads(self.as_of(after_edits).content), json.loads(self.client.get(self.url).content)
+        )
+
+        # Replays stay short: snapshots keep being taken as changes pile up
+        self.assertGreater(self.patient.timeline_snapshots.count(), 1)
+
+    def test_change_log_is_append_only(self):
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        make_prescription(self.patient, self.aspirin, date(2025, 2, 1), 10)
+        change = TimelineChange.objects.first()
+        with self.assertRaises(ValueError):
+            change.save()
+
+    def test_bad_as_of(self):
+        self.assertEqual(self.client.get(self.url, {"as_of": "yesterday"}).status_code, 400)
+
+
+class TimelineProjectionTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.ibuprofen = Medication.objects.create(name="Ibuprofen")
+
+    def assertProjectionIsFresh(self):
+        stored = json.loads(json.dumps(read_timeline(self.patient.id), cls=DjangoJSONEncoder))
+        computed = json.loads(json.dumps(
+            build_timeline_items(get_timeline_queryset(patient=self.patient).order_by("id")),
+            cls=DjangoJSONEncoder,
+        ))
+        self.assertEqual(stored, computed)
+
+    def test_writes_keep_the_projection_fresh(self):
+        first = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        second = make_prescription(self.patient, self.aspirin, date(2025, 1, 5), 10)
+        make_prescription(self.patient, self.ibuprofen, date(2025, 1, 2), 3)
+        self.assertProjectionIsFresh()
+        self.assertTrue(TimelineItem.objects.get(pk=first.pk).is_truncated)
+
+        second.medication = self.ibuprofen
+        second.save()
+        self.assertProjectionIsFresh()
+        self.assertFalse(TimelineItem.objects.get(pk=first.pk).is_truncated)
+
+        second.start_date = None
+        second.save()
+        self.assertProjectionIsFresh()
+        self.assertFalse(TimelineItem.objects.filter(pk=second.pk).exists())
+
+        first.dosageschedule_set.get().delete()
+        first.delete()
+        self.assertProjectionIsFresh()
+
+    def test_version_is_bumped_after_the_projection_is_refreshed(self):
+        prescription = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        seen = []
+
+        def bump(patient_ids):
+            seen.append(TimelineItem.objects.get(pk=prescription.pk).notes)
+            return bump_timeline_version(patient_ids)
+
+        with mock.patch("medications.sync.bump_timeline_version", side_effect=bump):
+            prescription.notes = "Changed"
+            prescription.save()
+            prescription.dosageschedule_set.get().delete()
+        self.assertEqual(seen, ["Changed", "Changed"])
+
+    def test_a_write_only_rebuilds_its_group(self):
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        other = make_prescription(self.patient, self.ibuprofen, date(2025, 1, 1), 10)
+        TimelineItem.objects.filter(pk=other.pk).update(notes="untouched")
+
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 5), 10)
+        self.assertEqual(TimelineItem.objects.get(pk=other.pk).notes, "untouched")
+
+    def test_rebuild_command(self):
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        TimelineItem.objects.all().delete()
+        call_command("rebuild_timeline_projection", stdout=StringIO())
+        self.assertProjectionIsFresh()
+
+    def test_rebuild_command_fills_missing_patients_only(self):
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        other = Patient.objects.create(name="Other Patient")
+        make_prescription(other, self.aspirin, date(2025, 1, 1), 10)
+        TimelineItem.objects.filter(patient=self.patient).delete()
+        self.assertEqual(read_timeline(self.patient.id), [])
+        versions = dict(Patient.objects.values_list("id", "timeline_version"))
+
+        call_command("rebuild_timeline_projection", "--missing", stdout=StringIO())
+        self.assertProjectionIsFresh()
+        self.assertEqual(len(read_timeline(self.patient.id)), 1)
+        self.assertEqual(dict(Patient.objects.values_list("id", "timeline_version")), {
+            self.patient.id: versions[self.patient.id] + 1, other.id: versions[other.id],
+        })
+
+
+class RecordingBroker(events.Broker):
+    published = []
+
+    def publish(self, patient_id, event):
+        self.published.append((patient_id, event))
+
+
+@override_settings(TIMELINE_EVENTS_BACKEND="medications.tests.RecordingBroker")
+class TimelineEventTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        RecordingBroker.published.clear()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+
+    def published(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            pass
+        events, RecordingBroker.published[:] = list(RecordingBroker.published), []
+        return [(event["type"], event.get("item", {}).get("id", event.get("id"))) for _, event in events]
+
+    def test_writes_publish_diffs(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            first = make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        # Created, then updated by its schedule
+        self.assertEqual(self.published(), [("added", first.id), ("updated", first.id)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second = Prescription.objects.create(
+                patient=self.patient, medication=self.aspirin, start_date=date(2025, 1, 5)
+            )
+        self.assertEqual(self.published(), [("truncated", first.id), ("added", second.id)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.notes = "Changed"
+            first.save()
+        self.assertEqual(self.published(), [("updated", first.id)])
+
+        second_id = second.id
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.published(), [("removed", second_id), ("truncated", first.id)])
+
+    def test_undated_writes_and_bulk_writes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            undated = make_prescription(self.patient, self.aspirin, None, 10)
+        self.assertEqual(set(self.published()), {("undated_changed", None)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            undated.start_date = date(2025, 1, 1)
+            undated.save()
+        self.assertEqual(self.published(), [("added", undated.id), ("undated_changed", None)])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("rebuild_timeline_projection", stdout=StringIO())
+        self.assertEqual(self.published(), [("reset", None)])
+
+    @override_settings(TIMELINE_EVENTS_BACKEND="medications.events.InProcessBroker")
+    def test_unwatched_patients_publish_nothing(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10)
+        self.assertEqual(callbacks, [])
+
+    @override_settings(TIMELINE_EVENTS_BACKEND="medications.events.InProcessBroker")
+    async def test_stream_sends_published_events(self):
+        response = await self.async_client.get(f"/api/patients/{self.patient.id}/events/")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        chunks = aiter(response.streaming_content)
+        self.assertTrue((await anext(chunks)).startswith(b"retry:"))
+
+        self.assertTrue(events.is_watched(self.patient.id))
+        events.get_broker().publish(self.patient.id, {"type": "removed", "id": 7})
+        chunk = await asyncio.wait_for(anext(chunks), 1)
+        self.assertEqual(chunk, b'event: removed\ndata: {"type": "removed", "id": 7}\n\n')
+
+        # A disconnecting client cancels the pending read, which unsubscribes
+        pending = asyncio.ensure_future(anext(chunks))
+        await asyncio.sleep(0)
+        pending.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await pending
+        self.assertFalse(events.is_watched(self.patient.id))
+
+    @override_settings(TIMELINE_EVENTS_BACKEND="medications.events.InProcessBroker")
+    def test_stream_needs_an_asgi_server(self):
+        response = self.client.get(f"/api/patients/{self.patient.id}/events/")
+        self.assertEqual(response.status_code, 501)
+        self.assertFalse(events.is_watched(self.patient.id))
+
+    async def test_stream_of_missing_patient(self):
+        response = await self.async_client.get("/api/patients/0/events/")
+        self.assertEqual(response.status_code, 404)
+
+
+class MedicationSearchTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        search.invalidate()
+        for name in ["Amoxicillin", "Amoxicillin/Clavulanate", "Amlodipine", "Aspirin", "Ibuprofen"]:
+            Medication.objects.create(name=name)
+        self.client = APIClient()
+
+    def names(self, q, **params):
+        response = self.client.get("/api/medications/search/", {"q": q, **params})
+        self.assertEqual(response.status_code, 200)
+        return [row["name"] for row in response.json()]
+
+    def test_normalize_name(self):
+        self.assertEqual(normalize_name("  Amoxicillin/Clavulanate  500mg "), "amoxicillin clavulanate 500mg")
+        self.assertEqual(normalize_name("Café-Crème"), "cafe creme")
+        self.assertEqual(Medication.objects.get(name="Aspirin").normalized_name, "aspirin")
+
+    def test_prefix_matches_rank_shortest_first(self):
+        self.assertEqual(self.names("AMOX"), ["Amoxicillin", "Amoxicillin/Clavulanate"])
+        self.assertEqual(self.names("am", limit=2, fuzzy=0), ["Amlodipine", "Amoxicillin"])
+
+    def test_fuzzy_matches_fill_in_after_prefix_matches(self):
+        self.assertEqual(self.names("ibuprofin"), ["Ibuprofen"])
+        self.assertEqual(self.names("amoxicilin")[0], "Amoxicillin")
+        self.assertEqual(self.names("ibuprofin", fuzzy=0), [])
+
+    def test_writes_invalidate_cached_results(self):
+        self.assertEqual(self.names("parace"), [])
+        Medication.objects.create(name="Paracetamol")
+        self.assertEqual(self.names("parace"), ["Paracetamol"])
+        self.assertEqual(self.names("paracetamoll"), ["Paracetamol"])
+
+    def test_writes_are_applied_to_the_index_without_rebuilding_it(self):
+        self.names("ibuprofin")
+        with mock.patch.object(search, "TrigramIndex", side_effect=AssertionError("rebuilt")):
+            ibuprofen = Medication.objects.get(name="Ibuprofen")
+            ibuprofen.name = "Naproxen"
+            ibuprofen.save()
+            self.assertEqual(self.names("ibuprofin"), [])
+            self.assertEqual(self.names("naproxin"), ["Naproxen"])
+
+            ibuprofen.delete()
+            self.assertEqual(self.names("naproxin"), [])
+
+            # Created elsewhere, without this process's signals
+            Medication.objects.bulk_create([Medication(name="Ketoprofen", normalized_name="ketoprofen")])
+            self.assertEqual(self.names("ketoprofin"), ["Ketoprofen"])
+
+    def test_index_search_skips_removed_names(self):
+        index = search.TrigramIndex([(1, "aspirin"), (2, "ibuprofen")])
+        index.put(1, "paracetamol")
+        index.remove(2)
+        index.put(3, "aspirine")
+        self.assertEqual(len(index), 2)
+        self.assertEqual([pk for pk, _ in index.search("aspirin", 5)], [3])
+        self.assertEqual([pk for pk, _ in index.search("paracetamol", 5)], [1])
+
+    def test_limit_is_validated(self):
+        response = self.client.get("/api/medications/search/", {"q": "a", "limit": 500})
+        self.assertEqual(response.status_code, 400)
+
+
+class PatientChartTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = Patient.objects.create(name="Test Patient")
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        self.clinic = Facility.objects.create(name="Clinic")
+        self.user = User.objects.create(username="doctor")
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 1), 10, source_facility=self.clinic)
+        make_prescription(self.patient, self.aspirin, date(2025, 1, 5), 10, contributor=self.user)
+        make_prescription(self.patient, self.aspirin, None, 3, notes="Undated")
+        self.url = f"/api/patients/{self.patient.id}/chart/"
+
+    async def test_chart_combines_timeline_and_undated(self):
+        response = await self.async_client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        chart = json.loads(response.content)
+
+        timeline = json.loads((await self.async_client.get(
+            f"/api/patients/{self.patient.id}/timeline/", {"lanes": "1"}
+        )).content)
+        undated = json.loads((await self.async_client.get(
+            f"/api/patients/{self.patient.id}/undated_medications/"
+        )).content)
+        self.assertEqual(chart["items"], timeline["items"])
+        self.assertEqual(chart["lane_count"], timeline["lane_count"])
+        self.assertEqual(chart["undated"], undated)
+        self.assertEqual(chart["patient"], {"id": self.patient.id, "name": "Test Patient"})
+        self.assertEqual(chart["facilities"], [{"id": self.clinic.id, "name": "Clinic", "external_id": ""}])
+        self.assertEqual(chart["contributors"], [{"id": self.user.id, "username": "doctor"}])
+
+    async def test_chart_is_cached_and_validated(self):
+        response = await self.async_client.get(self.url)
+        etag = response["ETag"]
+        response = await self.async_client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+        await Prescription.objects.filter(start_date__isnull=True).aupdate(notes="Changed")
+        await sync_to_async(bump_timeline_version)({self.patient.id})
+        response = await self.async_client.get(self.url, headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["undated"][0]["notes"], "Changed")
+
+    async def test_chart_of_missing_patient(self):
+        response = await self.async_client.get("/api/patients/0/chart/")
+        self.assertEqual(response.status_code, 404)
+
+
+class LeanSerializerTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = Patient.objects.create(name="Test Patient")
+        clinic = Facility.objects.create(name="Clinic", external_id="F1")
+        user = User.objects.create(username="doctor")
+        aspirin = Medication.objects.create(name="Aspirin")
+        ibuprofen = Medication.objects.create(name="Ibuprofen")
+        make_prescription(self.patient, aspirin, date(2025, 1, 1), 10, 5, source_facility=clinic)
+        make_prescription(self.patient, ibuprofen, None, 3, contributor=user, notes="Undated")
+        make_prescription(self.patient, aspirin, date(2025, 2, 1))
+        DosageSchedule.objects.filter(duration=timedelta(days=5)).update(dose="100mg", frequency="twice daily")
+        for schedule in DosageSchedule.objects.all():
+            schedule.save()
+
+    def test_renders_byte_identical_json(self):
+        queryset = Prescription.objects.order_by("id")
+        expected = JSONRenderer().render(PrescriptionSerializer(queryset, many=True).data)
+        self.assertEqual(JSONRenderer().render(render_prescriptions(prescription_rows(queryset))), expected)
+
+        fields = {"id", "medication", "source_facility"}
+        projected = render_prescriptions(prescription_rows(queryset, fields), fields)
+        self.assertEqual(
+            JSONRenderer().render(projected),
+            JSONRenderer().render(PrescriptionSerializer(queryset, many=True, context={"fields": fields}).data),
+        )
+
+    def test_endpoints_match_the_serializer(self):
+        undated = Prescription.objects.filter(start_date__isnull=True)
+        response = self.client.get(f"/api/patients/{self.patient.id}/undated_medications/")
+        self.assertEqual(response.content, JSONRenderer().render(PrescriptionSerializer(undated, many=True).data))
+
+        response = self.client.get("/api/prescriptions/")
+        expected = PrescriptionSerializer(Prescription.objects.order_by("id"), many=True).data
+        self.assertEqual(JSONRenderer().render(response.data["results"]), JSONRenderer().render(expected))
+
+
+class ColumnarTimelineTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patient = Patient.objects.create(name="Test Patient")
+        medications = [Medication.objects.create(name=f"Medication {i}") for i in range(3)]
+        for i in range(60):
+            prescription = make_prescription(
+                self.patient, medications[i % 3], date(2025, 1, 1) + timedelta(days=5 * i), 7, 3, notes="Note"
+            )
+            prescription.dosageschedule_set.update(dose="100mg", frequency="twice daily", route="oral")
+        self.url = f"/api/patients/{self.patient.id}/timeline/"
+
+    def test_columnar_round_trips_and_is_smaller(self):
+        for params in ({}, {"lanes": "1"}):
+            plain = self.client.get(self.url, params)
+            compact = self.client.get(self.url, {**params, "format": "columnar"})
+            self.assertEqual(compact["Content-Type"], "application/vnd.timeline.columnar+json")
+            payload = json.loads(compact.content)
+            items = plain.json()["items"] if params else plain.json()
+            self.assertEqual(decode_timeline(payload), items)
+            self.assertLess(len(compact.content) * 3, len(plain.content))
+        self.assertEqual(payload["lane_count"], plain.json()["lane_count"])
+
+        response = self.client.get(self.url, HTTP_ACCEPT="application/vnd.timeline.columnar+json")
+        self.assertEqual(response.json()["format"], "columnar")
+
+    def test_etag_varies_by_format(self):
+        plain = self.client.get(self.url)
+        compact = self.client.get(self.url, {"format": "columnar"})
+        self.assertNotEqual(plain["ETag"], compact["ETag"])
+        self.assertIn("Accept", compact["Vary"])
+        response = self.client.get(self.url, {"format": "columnar"}, HTTP_IF_NONE_MATCH=plain["ETag"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_errors_are_not_encoded(self):
+        response = self.client.get(self.url, {"format": "columnar", "from": "soon"})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("from", response.json())
+
+    def test_chart_items_in_columnar(self):
+        chart = self.client.get(f"/api/patients/{self.patient.id}/chart/").json()
+        compact = self.client.get(f"/api/patients/{self.patient.id}/chart/", {"format": "columnar"}).json()
+        self.assertEqual(decode_timeline(compact["items"]), chart["items"])
+        self.assertEqual(compact["undated"], chart["undated"])
+
+    @unittest.skipUnless(renderers.msgpack, "msgpack is not installed")
+    def test_messagepack(self):
+        response = self.client.get(self.url, {"format": "columnar-msgpack"})
+        payload = renderers.msgpack.unpackb(response.content)
+        self.assertEqual(decode_timeline(payload), self.client.get(self.url).json())
+
+
+class CohortTests(MedicationsTestCase):
+    def setUp(self):
+        super().setUp()
+        self.aspirin = Medication.objects.create(name="Aspirin")
+        other = Medication.objects.create(name="Ibuprofen")
+        rng = random.Random(3)
+        self.patients = [Patient.objects.create(name=f"Patient {i}") for i in range(8)]
+        for patient in self.patients:
+            for _ in range(4):
+                medication = self.aspirin if rng.random() < 0.75 else other
+                start = date(2025, 1, 1) + timedelta(days=rng.randint(0, 40))
+                make_prescription(patient, medication, start, rng.randint(1, 15))
+
+    def expected_active(self, day):
+        active = set()
+        for patient in self.patients:
+            for item in build_timeline_items(get_timeline_queryset(patient=patient, medication=self.aspirin)):
+                if item["start_date"] <= day < item["end_date"]:
+                    active.add(patient.id)
+        return active
+
+    def test_active_patients(self):
+        url = f"/api/medications/{self.aspirin.id}/active_patients/"
+        for day in (date(2025, 1, 1), date(2025, 1, 20), date(2025, 2, 10), date(2026, 1, 1)):
+            response = self.client.get(url, {"on": day.isoformat(), "page_size": 100})
+            self.assertEqual({p["id"] for p in response.data["results"]}, self.expected_active(day))
+
+        response = self.client.get(url, {"on": "someday"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_active_counts(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(
+                f"/api/medications/{self.aspirin.id}/active_counts/", {"from": "2024-12-30", "to": "2025-03-01"}
+            )
+        counts = response.data["counts"]
+        self.assertEqual(len(counts), 62)
+        for offset in (0, 2, 10, 25, 45, 61):
+            day = date(2024, 12, 30) + timedelta(days=offset)
+            self.assertEqual(counts[offset], len(self.expected_active(day)))
@@ -6,6 +6,9 @@ from .views import (
     FacilityViewSet,
     PrescriptionViewSet,
     DosageScheduleViewSet,
+    TimelineCacheViewSet,
+    patient_chart,
+    timeline_events,
 )
 
 router = DefaultRouter()
@@ -14,7 +17,10 @@ router.register(r'medications', MedicationViewSet)
 router.register(r'facilities', FacilityViewSet)
 router.register(r'prescriptions', PrescriptionViewSet)
 router.register(r'dosageschedules', DosageScheduleViewSet)
+router.register(r'timeline-cache', TimelineCacheViewSet, basename='timeline-cache')
 
 urlpatterns = [
+    path('api/patients/<int:pk>/events/', timeline_events, name='patient-events'),
+    path('api/patients/<int:pk>/chart/', patient_chart, name='patient-chart'),
     path('api/', include(router.urls)),  # ✅ include the router only once
 ]
\ No newline at end of file
@@ -1,7 +1,39 @@
+import asyncio
+import io
+import json
+from datetime import datetime, time
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import http_date
 from rest_framework import viewsets
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from . import cache as timeline_cache
+from . import cohorts, events, history
+from . import search as medication_search
+from .columnar import encode_timeline
+from .conflicts import MAX_CONCURRENT_MEDICATIONS, find_conflicts
+from .exporters import export_prescriptions
+from .exposure import (
+    MAX_CALENDAR_DAYS,
+    build_patient_calendars,
+    get_calendar_window,
+    merge_dose_calendars,
+)
+from .importers import READERS, import_prescriptions
+from .lean import prescription_rows, render_prescriptions
 from .models import Patient, Medication, Facility, Prescription, DosageSchedule
+from .renderers import TIMELINE_RENDERERS, ColumnarRenderer, CSVRenderer, NDJSONRenderer
 from .serializer import (
     PatientSerializer,
     MedicationSerializer,
@@ -9,42 +41,580 @@ from .serializer import (
     PrescriptionSerializer,
     DosageScheduleSerializer,
 )
-from .services import build_timeline_items
+from .projection import read_timeline, read_timelines
+from .services import (
+    assign_lanes,
+    build_medication_group_items,
+    build_timeline_items,
+    get_timeline_queryset,
+)
+
+
+def get_date_window(request):
+    """
+    Reads the optional ?from=&to= window (YYYY-MM-DD) from the query string
+    """
+    window = {}
+    for param in ("from", "to"):
+        value = request.query_params.get(param)
+        if not value:
+            window[param] = None
+            continue
+        try:
+            window[param] = parse_date(value)
+        except ValueError:
+            window[param] = None
+        if window[param] is None:
+            raise ValidationError({param: "Expected a date in YYYY-MM-DD format."})
+
+    if window["from"] and window["to"] and window["from"] > window["to"]:
+        raise ValidationError({"from": "Must not be after 'to'."})
+    return window["from"], window["to"]
+
+
+def get_as_of(request):
+    """
+    Reads ?as_of= as an aware datetime. A bare date means the end of that day.
+    """
+    value = request.query_params.get("as_of", "")
+    try:
+        as_of = parse_datetime(value)
+        if as_of is None:
+            day = parse_date(value)
+            as_of = day and datetime.combine(day, time.max)
+    except ValueError:
+        as_of = None
+    if as_of is None:
+        raise ValidationError({"as_of": "Expected an ISO 8601 date or timestamp."})
+    if timezone.is_naive(as_of):
+        as_of = timezone.make_aware(as_of)
+    return as_of
+
+
+def get_dose_calendar_window(request):
+    """
+    The ?from=&to= window of a dose calendar, defaulting to the last year
+    """
+    window = get_calendar_window(*get_date_window(request), timezone.localdate())
+    if window is None:
+        raise ValidationError({"from": f"At most {MAX_CALENDAR_DAYS} days per calendar."})
+    return window
+
+
+MAX_BATCH_PATIENTS = 500
+# Patients read (or fetched from the cache) at a time by /patients/timelines/
+TIMELINES_CHUNK_SIZE = 50
+
+
+def get_id_list(request, param="ids"):
+    """
+    Reads a comma separated list of integer ids from the query string
+    """
+    raw = request.query_params.get(param, "")
+    try:
+        ids = [int(value) for value in raw.split(",") if value.strip()]
+    except ValueError:
+        raise ValidationError({param: "Expected a comma separated list of ids."})
+    if not ids:
+        raise ValidationError({param: "At least one id is required."})
+    if len(ids) > MAX_BATCH_PATIENTS:
+        raise ValidationError({param: f"At most {MAX_BATCH_PATIENTS} ids per request."})
+    return list(dict.fromkeys(ids))
+
+
+def stream_json_array(rows):
+    """
+    Encodes an iterable of dicts as a JSON array one element at a time
+    """
+    yield "["
+    for i, row in enumerate(rows):
+        yield ("," if i else "") + json.dumps(row, cls=JSONEncoder)
+    yield "]"
+
+
+STREAM_BATCH_SIZE = 100
+
+
+def is_asgi(request):
+    return isinstance(getattr(request, "_request", request), ASGIRequest)
+
+
+async def iterate_in_thread(iterable, batch_size=STREAM_BATCH_SIZE):
+    """
+    Async iterator over a sync one, advanced batch_size parts at a time on
+    the thread that owns the database connection
+    """
+    iterator = iter(iterable)
+    next_batch = sync_to_async(lambda: list(islice(iterator, batch_size)))
+    while batch := await next_batch():
+        for part in batch:
+            yield part
+
+
+def streaming_response(request, content, **kwargs):
+    """
+    StreamingHttpResponse that streams under both servers: under ASGI Django
+    reads a sync iterator whole before sending it, so there it gets an async one
+    """
+    if is_asgi(request):
+        content = iterate_in_thread(content)
+    return StreamingHttpResponse(content, **kwargs)
+
+
+EVENTS_KEEPALIVE_SECONDS = 15
+EVENTS_RETRY_MS = 3000
+
 
-class MedicationViewSet(viewsets.ModelViewSet):
+def format_event(event):
+    return f"event: {event['type']}\ndata: {json.dumps(event, cls=JSONEncoder)}\n\n"
+
+
+async def timeline_events(request, pk):
+    """
+    GET /patients/<pk>/events/ streams the patient's timeline diff events
+    as server-sent events, with a comment line every
+    EVENTS_KEEPALIVE_SECONDS to keep proxies from closing the connection
+    """
+    if not is_asgi(request):
+        # A WSGI server would hold a worker thread for as long as the page is open
+        return HttpResponse(
+            "The events stream needs an ASGI server.", status=501, content_type="text/plain"
+        )
+    if not await Patient.objects.filter(pk=pk).aexists():
+        raise Http404
+
+    async def stream():
+        async with events.get_broker().subscribe(int(pk)) as queue:
+            yield f"retry: {EVENTS_RETRY_MS}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), EVENTS_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_event(event)
+
+    response = StreamingHttpResponse(stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+async def build_chart(patient):
+    """
+    The patient's whole chart: timeline items (with lanes) from the
+    persisted timeline, undated prescriptions, and the facilities and
+    contributors behind them
+    """
+    undated = Prescription.objects.filter(patient=patient, start_date__isnull=True).order_by("id")
+    facilities = (
+        Facility.objects.filter(prescription__patient=patient)
+        .distinct()
+        .order_by("name", "id")
+        .values("id", "name", "external_id")
+    )
+    contributors = (
+        User.objects.filter(medication_entries__patient=patient)
+        .distinct()
+        .order_by("username", "id")
+        .values("id", "username")
+    )
+
+    items = await sync_to_async(read_timeline)(patient.pk)
+    return {
+        "patient": PatientSerializer(patient).data,
+        "lane_count": assign_lanes(items),
+        "items": items,
+        "undated": await sync_to_async(render_prescriptions)(prescription_rows(undated)),
+        "facilities": [row async for row in facilities],
+        "contributors": [row async for row in contributors],
+    }
+
+
+async def patient_chart(request, pk):
+    """
+    GET /patients/<pk>/chart/ returns everything the chart page shows in
+    one response: {"patient", "lane_count", "items", "undated",
+    "facilities", "contributors"}. Cached and validated like the timeline.
+    With ?format=columnar the items come in the columnar encoding.
+    """
+    patient = await Patient.objects.filter(pk=pk).afirst()
+    if patient is None:
+        raise Http404
+
+    columnar = request.GET.get("format") == ColumnarRenderer.format
+    validators, last_modified = get_timeline_validators(patient, "chart:columnar" if columnar else "chart")
+    response = get_conditional_response(request, etag=validators["ETag"], last_modified=last_modified)
+    if response is None:
+        chart = await timeline_cache.aget_cached(patient, "chart", lambda: build_chart(patient))
+        if columnar:
+            chart = {**chart, "items": encode_timeline(chart["items"])}
+        response = JsonResponse(chart, encoder=JSONEncoder)
+    for header, value in validators.items():
+        response[header] = value
+    return response
+
+
+def get_timeline_validators(patient, variant):
+    """
+    Returns:
+        (response headers, last modified timestamp or None)
+    """
+    validators = {
+        "ETag": timeline_cache.get_etag(patient, variant),
+        "Cache-Control": "private, no-cache",
+    }
+    last_modified = None
+    if patient.timeline_modified_at:
+        last_modified = int(patient.timeline_modified_at.timestamp())
+        validators["Last-Modified"] = http_date(last_modified)
+    return validators, last_modified
+
+
+def cached_timeline_response(request, patient, variant, compute):
+    """
+    Serves compute() through the timeline cache with ETag / Last-Modified
+    validators. A client that is already up to date gets a 304 before
+    anything is computed or read from the cache.
+    """
+    # The same data renders to different bytes in each format
+    validators, last_modified = get_timeline_validators(
+        patient, f"{variant}:{request.accepted_renderer.format}"
+    )
+    response = get_conditional_response(
+        request._request, etag=validators["ETag"], last_modified=last_modified
+    )
+    if response is None:
+        response = Response(timeline_cache.get_cached(patient, variant, compute))
+    for header, value in validators.items():
+        response[header] = value
+    patch_vary_headers(response, ["Accept"])
+    return response
+
+
+class FieldProjectionMixin:
+    """
+    Reads ?fields=a,b,c on GET requests and hands it to the serializer
+    (see serializer.FieldProjectionMixin)
+    """
+
+    def get_requested_fields(self):
+        raw = self.request.query_params.get("fields")
+        if self.request.method != "GET" or not raw:
+            return None
+        return {name.strip() for name in raw.split(",") if name.strip()}
+
+    def wants_field(self, name):
+        fields = self.get_requested_fields()
+        return fields is None or name in fields
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context["fields"] = self.get_requested_fields()
+        return context
+
+
+class MedicationViewSet(FieldProjectionMixin, viewsets.ModelViewSet):
     queryset = Medication.objects.all()
     serializer_class = MedicationSerializer
 
-class FacilityViewSet(viewsets.ModelViewSet):
+    @action(detail=False)
+    def search(self, request):
+        """
+        GET /medications/search/?q=amox&limit=10&fuzzy=1
+        Typeahead matches as [{"id", "name"}], prefix matches first
+        """
+        try:
+            limit = int(request.query_params.get("limit", medication_search.DEFAULT_LIMIT))
+        except ValueError:
+            raise ValidationError({"limit": "Expected an integer."})
+        if not 1 <= limit <= medication_search.MAX_LIMIT:
+            raise ValidationError({"limit": f"Expected 1 to {medication_search.MAX_LIMIT}."})
+        fuzzy = request.query_params.get("fuzzy", "1") not in ("0", "false")
+        query = request.query_params.get("q", "")
+        return Response(medication_search.search_medications(query, limit, fuzzy))
+
+    @action(detail=True, methods=["get"])
+    def active_patients(self, request, pk=None):
+        """
+        GET /medications/<pk>/active_patients/?on=YYYY-MM-DD
+        The patients on this medication on that day (today by default),
+        cursor paginated
+        """
+        medication = self.get_object()
+        value = request.query_params.get("on")
+        try:
+            on = parse_date(value) if value else timezone.localdate()
+        except ValueError:
+            on = None
+        if on is None:
+            raise ValidationError({"on": "Expected a date in YYYY-MM-DD format."})
+
+        patients = cohorts.active_patients(medication.pk, on)
+        page = self.paginate_queryset(patients)
+        return self.get_paginated_response(PatientSerializer(page, many=True).data)
+
+    @action(detail=True, methods=["get"])
+    def active_counts(self, request, pk=None):
+        """
+        GET /medications/<pk>/active_counts/?from=YYYY-MM-DD&to=YYYY-MM-DD
+        The number of patients on this medication for each day of the
+        window (the last year by default)
+        """
+        medication = self.get_object()
+        date_from, date_to = get_dose_calendar_window(request)
+        return Response({
+            "from": date_from,
+            "to": date_to,
+            "counts": cohorts.count_active_per_day(medication.pk, date_from, date_to),
+        })
+
+class FacilityViewSet(FieldProjectionMixin, viewsets.ModelViewSet):
     queryset = Facility.objects.all()
     serializer_class = FacilitySerializer
 
-class PrescriptionViewSet(viewsets.ModelViewSet):
+    @action(detail=True, methods=["get"])
+    def calendar(self, request, pk=None):
+        """
+        GET /facilities/<pk>/calendar/?from=YYYY-MM-DD&to=YYYY-MM-DD
+        Daily dose totals and active course counts per medication over the
+        prescriptions written at this facility (ward). Each patient's share
+        is cached per timeline version and the shares are added up.
+        """
+        facility = self.get_object()
+        date_from, date_to = get_dose_calendar_window(request)
+
+        patients = Patient.objects.filter(
+            pk__in=Prescription.objects.filter(
+                source_facility=facility,
+                start_date__lte=date_to,
+                end_date__gte=date_from,
+            ).values("patient_id")
+        )
+        calendars = timeline_cache.get_many_cached(
+            patients,
+            f"calendar:{facility.pk}:{date_from}:{date_to}",
+            lambda missing: build_patient_calendars(
+                [p.pk for p in missing], date_from, date_to, facility_id=facility.pk
+            ),
+        )
+        return Response(merge_dose_calendars(calendars.values(), date_from, date_to))
+
+class PrescriptionViewSet(FieldProjectionMixin, viewsets.ModelViewSet):
+    """
+    Create / update accept a nested dosage_schedules list and answer with
+    the prescription plus the refreshed timeline items of its medication
+    group, so the client can patch its timeline without refetching
+    """
     queryset = Prescription.objects.all()
     serializer_class = PrescriptionSerializer
 
-class DosageScheduleViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.action not in ("list", "retrieve", "create", "update", "partial_update"):
+            return queryset
+
+        # Only join / prefetch what the serializer is going to render
+        related = [
+            name for name in ("patient", "medication", "source_facility")
+            if self.wants_field(name)
+        ]
+        if related:
+            queryset = queryset.select_related(*related)
+        if self.wants_field("dosage_schedules"):
+            queryset = queryset.prefetch_related("dosageschedule_set")
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        # Read-only, so it skips the serializer (see medications.lean)
+        fields = self.get_requested_fields()
+        rows = prescription_rows(self.filter_queryset(Prescription.objects.all()), fields)
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(render_prescriptions(page, fields))
+        return Response(render_prescriptions(rows, fields))
+
+    def create(self, request, *args, **kwargs):
+        return self._with_timeline_items(super().create(request, *args, **kwargs))
+
+    def update(self, request, *args, **kwargs):
+        return self._with_timeline_items(super().update(request, *args, **kwargs))
+
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="import",
+        parser_classes=[MultiPartParser, FormParser],
+    )
+    def import_file(self, request):
+        """
+        POST /prescriptions/import/ (multipart: file, input_format)
+        Bulk imports a CSV, NDJSON or FHIR MedicationStatement NDJSON file
+        and returns row counts, throughput and per-row errors
+        """
+        upload = request.FILES.get("file")
+        if upload is None:
+            raise ValidationError({"file": "No file was uploaded."})
+
+        input_format = request.data.get("input_format") or upload.name.rsplit(".", 1)[-1].lower()
+        if input_format not in READERS:
+            raise ValidationError({"input_format": f"Expected one of {', '.join(READERS)}."})
+
+        lines = io.TextIOWrapper(upload.file, encoding="utf-8", newline="")
+        try:
+            result = import_prescriptions(lines, input_format)
+        except UnicodeDecodeError:
+            raise ValidationError({"file": "Expected UTF-8 text."})
+        return Response(result.as_dict())
+
+    @action(detail=False, methods=["get"], renderer_classes=[NDJSONRenderer, CSVRenderer])
+    def export(self, request):
+        """
+        GET /prescriptions/export/?format=ndjson|csv&include_timeline=1&patients=1,2
+        Streams every prescription (optionally only some patients') with its
+        schedules, in the import file format
+        """
+        queryset = Prescription.objects.all()
+        if "patients" in request.query_params:
+            queryset = queryset.filter(patient_id__in=get_id_list(request, "patients"))
+        include_timeline = request.query_params.get("include_timeline") in ("1", "true")
+
+        renderer = request.accepted_renderer
+        response = streaming_response(
+            request,
+            export_prescriptions(renderer.format, queryset, include_timeline),
+            content_type=f"{renderer.media_type}; charset=utf-8",
+        )
+        response["Content-Disposition"] = f'attachment; filename="prescriptions.{renderer.format}"'
+        return response
+
+    def _with_timeline_items(self, response):
+        data = response.data
+        response.data = {
+            **data,
+            "timeline_items": build_medication_group_items(
+                data["patient"]["id"], data["medication"]["id"]
+            ),
+        }
+        return response
+
+class DosageScheduleViewSet(FieldProjectionMixin, viewsets.ModelViewSet):
     queryset = DosageSchedule.objects.all()
     serializer_class = DosageScheduleSerializer
 
 
-class PatientViewSet(viewsets.ModelViewSet):
+class PatientViewSet(FieldProjectionMixin, viewsets.ModelViewSet):
     queryset = Patient.objects.all()
     serializer_class = PatientSerializer
 
-    @action(detail=True, methods=["get"])
+    @action(detail=True, methods=["get"], renderer_classes=TIMELINE_RENDERERS)
     def timeline(self, request, pk=None):
         """
-        GET /patients/<pk>/timeline/
-        Returns the patient's timeline as JSON
+        GET /patients/<pk>/timeline/?from=YYYY-MM-DD&to=YYYY-MM-DD&lanes=1&as_of=<timestamp>
+        Returns the patient's timeline as JSON, optionally limited to the
+        prescriptions overlapping the given window. With lanes=1 the answer
+        is {"lane_count", "items"} and every item carries its row ("lane").
+        With as_of (ISO timestamp, or a date meaning the end of that day)
+        the timeline is rebuilt as it was at that moment from the change log.
+        ?format=columnar (or columnar-msgpack) selects the compact encoding
+        of medications.columnar.
+        """
+        patient = self.get_object()
+        date_from, date_to = get_date_window(request)
+        lanes = request.query_params.get("lanes") in ("1", "true")
+
+        def payload(items):
+            if not lanes:
+                return items
+            lane_count = max((item["lane"] for item in items), default=-1) + 1
+            return {"lane_count": lane_count, "items": items}
+
+        if "as_of" in request.query_params:
+            as_of = get_as_of(request)
+            prescriptions = history.get_prescriptions_as_of(patient, as_of)
+            if prescriptions is None:
+                start = history.get_history_start(patient)
+                raise ValidationError({"as_of": (
+                    f"History for this patient starts at {start.isoformat()}."
+                    if start else "No history has been recorded for this patient."
+                )})
+            dated = [p for p in prescriptions if p.start_date]
+            return Response(payload(build_timeline_items(dated, date_from, date_to, lanes=lanes)))
+
+        def compute():
+            items = read_timeline(patient.pk, date_from, date_to)
+            if lanes:
+                assign_lanes(items)
+            return payload(items)
+
+        variant = f"timeline:{date_from}:{date_to}"
+        if lanes:
+            variant += ":lanes"
+        return cached_timeline_response(request, patient, variant, compute)
+
+    @action(detail=True, methods=["get"])
+    def conflicts(self, request, pk=None):
+        """
+        GET /patients/<pk>/conflicts/?max_concurrent=5
+        Lists overlapping courses of the same medication, same-route
+        overlaps between medications and days with more than max_concurrent
+        medications active
+        """
+        patient = self.get_object()
+        try:
+            max_concurrent = int(request.query_params.get("max_concurrent", MAX_CONCURRENT_MEDICATIONS))
+        except ValueError:
+            raise ValidationError({"max_concurrent": "Expected an integer."})
+
+        def compute():
+            return find_conflicts(get_timeline_queryset(patient=patient), max_concurrent)
+
+        return cached_timeline_response(
+            request, patient, f"conflicts:{max_concurrent}", compute
+        )
+
+    @action(detail=True, methods=["get"])
+    def calendar(self, request, pk=None):
+        """
+        GET /patients/<pk>/calendar/?from=YYYY-MM-DD&to=YYYY-MM-DD
+        Daily dose totals and active course counts per medication, one
+        value per day of the window (the last year by default)
         """
         patient = self.get_object()
+        date_from, date_to = get_dose_calendar_window(request)
 
-        prescriptions = Prescription.objects.filter(patient=patient).prefetch_related("dosageschedule_set", "medication")
+        def compute():
+            return build_patient_calendars([patient.pk], date_from, date_to)[patient.pk]
 
-        timeline_items = build_timeline_items(prescriptions)
+        return cached_timeline_response(
+            request, patient, f"calendar:{date_from}:{date_to}", compute
+        )
 
-        return Response(timeline_items)
+    @action(detail=False, methods=["get"])
+    def timelines(self, request):
+        """
+        GET /patients/timelines/?ids=1,2,3&from=YYYY-MM-DD&to=YYYY-MM-DD
+        Returns the timelines of several patients, streamed as a JSON array
+        of {"patient", "name", "timeline"} objects in the requested order
+        """
+        ids = get_id_list(request)
+        date_from, date_to = get_date_window(request)
+
+        def rows():
+            # One chunk of patients in memory at a time
+            for first in range(0, len(ids), TIMELINES_CHUNK_SIZE):
+                chunk = ids[first:first + TIMELINES_CHUNK_SIZE]
+                patients = Patient.objects.in_bulk(chunk)
+                patients = [patients[pid] for pid in chunk if pid in patients]
+                timelines = timeline_cache.get_many_cached(
+                    patients,
+                    f"timeline:{date_from}:{date_to}",
+                    lambda missing: read_timelines([p.pk for p in missing], date_from, date_to),
+                )
+                for p in patients:
+                    yield {"patient": p.pk, "name": p.name, "timeline": timelines[p.pk]}
+
+        return streaming_response(request, stream_json_array(rows()), content_type="application/json")
 
     @action(detail=True, methods=["get"])
     def undated_medications(self, request, pk=None):
@@ -54,10 +624,26 @@ class PatientViewSet(viewsets.ModelViewSet):
         """
         patient = self.get_object()
 
-        prescriptions = Prescription.objects.filter(
-            patient=patient,
-            start_date__isnull=True
-        ).prefetch_related("dosageschedule_set", "medication")
+        def compute():
+            prescriptions = Prescription.objects.filter(
+                patient=patient,
+                start_date__isnull=True
+            ).order_by("id")
+            return render_prescriptions(prescription_rows(prescriptions))
+
+        return cached_timeline_response(request, patient, "undated", compute)
+
+
+class TimelineCacheViewSet(viewsets.ViewSet):
+    """
+    GET /timeline-cache/ returns hit/miss counters for the timeline cache,
+    DELETE /timeline-cache/reset/ zeroes them
+    """
+
+    def list(self, request):
+        return Response(timeline_cache.get_stats())
 
-        serializer = PrescriptionSerializer(prescriptions, many=True)
-        return Response(serializer.data)
+    @action(detail=False, methods=["delete"])
+    def reset(self, request):
+        timeline_cache.reset_stats()
+        return Response(status=204)
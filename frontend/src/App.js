@@ -1,5 +1,5 @@
-import React, { useEffect, useState } from "react";
-import MedicationTimeline from "./components/Timeline";
+import React, { useEffect, useRef, useState } from "react";
+import MedicationTimeline, { decodeColumnarTimeline } from "./components/Timeline";
 import UndatedMedications from "./components/UndatedMedications";
 import AddPrescription from "./components/AddPrescription";
 
@@ -11,19 +11,43 @@ function App() {
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
 
-  const fetchTimeline = async () => {
+  // Last ETag and body per URL so unchanged data comes back as a 304
+  const validators = useRef({});
+
+  const fetchWithValidators = async (url, errorMessage, options = {}) => {
+    const cached = validators.current[url];
+    const response = await fetch(url, {
+      ...options,
+      cache: "no-store",
+      headers: cached ? { "If-None-Match": cached.etag } : {},
+    });
+
+    if (response.status === 304 && cached) {
+      return cached.data;
+    }
+    if (!response.ok) {
+      throw new Error(errorMessage);
+    }
+
+    const data = await response.json();
+    const etag = response.headers.get("ETag");
+    if (etag) {
+      validators.current[url] = { etag, data };
+    }
+    return data;
+  };
+
+  // Timeline items and undated prescriptions come from one request
+  const fetchChart = async () => {
     try {
-      const response = await fetch(
-        `${API_URL}/api/patients/1/timeline/`,
+      const data = await fetchWithValidators(
+        `${API_URL}/api/patients/1/chart/?format=columnar`,
+        "Failed to fetch medication timeline",
         { timeout: 60000 }  // 60 second timeout for cold starts
       );
-
-      if (!response.ok) {
-        throw new Error("Failed to fetch medication timeline");
-      }
-
-      const data = await response.json();
-      setTimelineItems(data);
+      // Items come columnar, with the row ("lane") the server packed them into
+      setTimelineItems(decodeColumnarTimeline(data.items));
+      setUndatedItems(data.undated);
       setError(null);  // Clear any previous errors on success
     } catch (err) {
       if (err.name === 'TypeError' && err.message.includes('fetch')) {
@@ -36,26 +60,72 @@ function App() {
     }
   };
 
-  const fetchUndatedMeds = async () => {
-    try {
-      const response = await fetch(
-        `${API_URL}/api/patients/1/undated_medications/`
-      );
+  // Apply a create response without refetching: dated prescriptions come
+  // back with the refreshed items of their medication group
+  const applyPrescriptionAdded = (prescription) => {
+    const { timeline_items: groupItems, ...undated } = prescription;
+    if (!prescription.start_date) {
+      setUndatedItems((prev) => [...prev, undated]);
+      return;
+    }
+    setTimelineItems((prev) => [
+      ...prev.filter((item) => item.medication !== prescription.medication.name),
+      ...groupItems,
+    ]);
+  };
 
-      if (!response.ok) {
-        throw new Error("Failed to fetch undated medications");
-      }
+  // Apply one change-feed event: dated items are replaced in place by id,
+  // anything the diff can't express triggers a refetch
+  const applyTimelineEvent = (event) => {
+    switch (event.type) {
+      case "added":
+      case "updated":
+      case "truncated":
+        setTimelineItems((prev) => [
+          ...prev.filter((item) => item.id !== event.item.id),
+          event.item,
+        ]);
+        break;
+      case "removed":
+        setTimelineItems((prev) => prev.filter((item) => item.id !== event.id));
+        break;
+      case "undated_changed":
+      case "reset":
+        fetchChart();
+        break;
+      default:
+    }
+  };
 
-      const data = await response.json();
-      setUndatedItems(data);
-    } catch (err) {
-      // Silently fail - undated meds section just won't show
+  // Whether the change feed is connected; without it mutations refetch
+  const feedConnected = useRef(false);
+
+  const refreshUnlessFeed = () => {
+    if (!feedConnected.current) {
+      fetchChart();
     }
   };
 
   useEffect(() => {
-    fetchTimeline();
-    fetchUndatedMeds();
+    fetchChart();
+
+    const source = new EventSource(`${API_URL}/api/patients/1/events/`);
+    const types = ["added", "updated", "truncated", "removed", "undated_changed", "reset"];
+    const onEvent = (message) => applyTimelineEvent(JSON.parse(message.data));
+    types.forEach((type) => source.addEventListener(type, onEvent));
+    source.onopen = () => {
+      // Changes made while disconnected were missed
+      if (feedConnected.current === null) {
+        fetchChart();
+      }
+      feedConnected.current = true;
+    };
+    source.onerror = () => {
+      if (feedConnected.current) {
+        feedConnected.current = null;
+      }
+    };
+    return () => source.close();
   }, []);
 
   if (loading) {
@@ -71,8 +141,7 @@ function App() {
         <button onClick={() => {
           setLoading(true);
           setError(null);
-          fetchTimeline();
-          fetchUndatedMeds();
+          fetchChart();
         }}>
           Retry
         </button>
@@ -85,27 +154,18 @@ function App() {
       <h2>Medication History</h2>
       <AddPrescription
         patientId={1}
-        onPrescriptionAdded={() => {
-          fetchTimeline();
-          fetchUndatedMeds();
-        }}
+        onPrescriptionAdded={applyPrescriptionAdded}
         apiUrl={API_URL}
       />
       <MedicationTimeline
         items={timelineItems}
         apiUrl={API_URL}
-        onPrescriptionDeleted={() => {
-          fetchTimeline();
-          fetchUndatedMeds();
-        }}
+        onPrescriptionDeleted={refreshUnlessFeed}
       />
       <UndatedMedications
         items={undatedItems}
         apiUrl={API_URL}
-        onPrescriptionDeleted={() => {
-          fetchTimeline();
-          fetchUndatedMeds();
-        }}
+        onPrescriptionDeleted={refreshUnlessFeed}
       />
     </div>
   );
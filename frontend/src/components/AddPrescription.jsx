@@ -3,7 +3,9 @@ import "./AddPrescription.css";
 
 const AddPrescription = ({ patientId, onPrescriptionAdded, apiUrl }) => {
     const [showForm, setShowForm] = useState(false);
-    const [medications, setMedications] = useState([]);
+    // Typeahead: what was typed and the server's matches for it
+    const [medicationQuery, setMedicationQuery] = useState("");
+    const [suggestions, setSuggestions] = useState([]);
     const [formData, setFormData] = useState({
         medication_id: "",
         start_date: "",
@@ -13,21 +15,41 @@ const AddPrescription = ({ patientId, onPrescriptionAdded, apiUrl }) => {
     const [loading, setLoading] = useState(false);
     const [error, setError] = useState(null);
 
-    const fetchMedications = async () => {
-        try {
-            const response = await fetch(`${apiUrl}/api/medications/`);
-            if (!response.ok) throw new Error("Failed to fetch medications");
-            const data = await response.json();
-            setMedications(data);
-        } catch (err) {
-            // Silently fail - medication list won't populate
+    useEffect(() => {
+        // Only search while typing, not after a suggestion was picked
+        if (!medicationQuery.trim() || formData.medication_id) {
+            setSuggestions([]);
+            return;
         }
+        const controller = new AbortController();
+        const timer = setTimeout(async () => {
+            try {
+                const params = new URLSearchParams({ q: medicationQuery, limit: 10 });
+                const response = await fetch(`${apiUrl}/api/medications/search/?${params}`, {
+                    signal: controller.signal
+                });
+                if (!response.ok) throw new Error("Failed to search medications");
+                setSuggestions(await response.json());
+            } catch (err) {
+                // Silently fail - no suggestions shown
+            }
+        }, 150);
+        return () => {
+            clearTimeout(timer);
+            controller.abort();
+        };
+    }, [medicationQuery, formData.medication_id, apiUrl]);
+
+    const handleMedicationQueryChange = (e) => {
+        setMedicationQuery(e.target.value);
+        setFormData(prev => ({ ...prev, medication_id: "" }));
     };
 
-    useEffect(() => {
-        fetchMedications();
-        // eslint-disable-next-line react-hooks/exhaustive-deps
-    }, [apiUrl]);
+    const selectMedication = (medication) => {
+        setMedicationQuery(medication.name);
+        setFormData(prev => ({ ...prev, medication_id: String(medication.id) }));
+        setSuggestions([]);
+    };
 
     const handleInputChange = (e) => {
         const { name, value } = e.target;
@@ -61,7 +83,7 @@ const AddPrescription = ({ patientId, onPrescriptionAdded, apiUrl }) => {
 
         // Validate medication is selected
         if (!formData.medication_id || formData.medication_id === "") {
-            setError("Please select a medication");
+            setError("Please select a medication from the suggestions");
             return;
         }
 
@@ -71,14 +93,25 @@ const AddPrescription = ({ patientId, onPrescriptionAdded, apiUrl }) => {
         try {
             const medicationId = parseInt(formData.medication_id);
 
+            const dosageSchedules = formData.dosages
+                .filter(dosage => dosage.dose || dosage.frequency || dosage.route)
+                .map(dosage => ({
+                    dose: dosage.dose,
+                    frequency: dosage.frequency,
+                    route: dosage.route,
+                    // Parse duration as integer, default to 1 if empty
+                    duration: dosage.duration && dosage.duration !== "" ? parseInt(dosage.duration) : 1
+                }));
+
             const payload = {
                 patient: parseInt(patientId),
                 medication: medicationId,
                 start_date: formData.start_date || null,  // Allow null for undated medications
-                notes: formData.notes
+                notes: formData.notes,
+                dosage_schedules: dosageSchedules
             };
 
-            // Create prescription
+            // Prescription and its dosage schedules are saved in one request
             const prescriptionResponse = await fetch(`${apiUrl}/api/prescriptions/`, {
                 method: "POST",
                 headers: { "Content-Type": "application/json" },
@@ -92,33 +125,6 @@ const AddPrescription = ({ patientId, onPrescriptionAdded, apiUrl }) => {
 
             const prescription = await prescriptionResponse.json();
 
-            // Create dosage schedules
-            for (const dosage of formData.dosages) {
-                if (dosage.dose || dosage.frequency || dosage.route) {
-                    // Parse duration as integer, default to 1 if empty
-                    const durationDays = dosage.duration && dosage.duration !== "" ? parseInt(dosage.duration) : 1;
-
-                    const payload = {
-                        prescription: prescription.id,
-                        dose: dosage.dose,
-                        frequency: dosage.frequency,
-                        route: dosage.route,
-                        duration: durationDays
-                    };
-
-                    const dosageResponse = await fetch(`${apiUrl}/api/dosageschedules/`, {
-                        method: "POST",
-                        headers: { "Content-Type": "application/json" },
-                        body: JSON.stringify(payload)
-                    });
-
-                    if (!dosageResponse.ok) {
-                        const dosageError = await dosageResponse.json().catch(() => ({}));
-                        throw new Error(`Failed to create dosage schedule: ${JSON.stringify(dosageError)}`);
-                    }
-                }
-            }
-
             // Reset form and notify parent
             setFormData({
                 medication_id: "",
@@ -126,8 +132,9 @@ const AddPrescription = ({ patientId, onPrescriptionAdded, apiUrl }) => {
                 notes: "",
                 dosages: [{ dose: "", frequency: "", route: "", duration: "" }]
             });
+            setMedicationQuery("");
             setShowForm(false);
-            onPrescriptionAdded();
+            onPrescriptionAdded(prescription);
         } catch (err) {
             setError(err.message);
         } finally {
@@ -150,17 +157,25 @@ const AddPrescription = ({ patientId, onPrescriptionAdded, apiUrl }) => {
 
                     <div className="form-group">
                         <label>Medication *</label>
-                        <select
-                            name="medication_id"
-                            value={formData.medication_id}
-                            onChange={handleInputChange}
-                            required
-                        >
-                            <option value="">Select a medication</option>
-                            {medications.map(med => (
-                                <option key={med.id} value={med.id}>{med.name}</option>
-                            ))}
-                        </select>
+                        <div className="medication-typeahead">
+                            <input
+                                type="text"
+                                value={medicationQuery}
+                                onChange={handleMedicationQueryChange}
+                                placeholder="Start typing a medication name"
+                                autoComplete="off"
+                                required
+                            />
+                            {suggestions.length > 0 && (
+                                <ul className="medication-suggestions">
+                                    {suggestions.map(med => (
+                                        <li key={med.id} onMouseDown={() => selectMedication(med)}>
+                                            {med.name}
+                                        </li>
+                                    ))}
+                                </ul>
+                            )}
+                        </div>
                     </div>
 
                     <div className="form-group">
@@ -41,11 +41,62 @@ const getDateRange = (start, end) => {
     return result;
 };
 
+// Decode the server's columnar timeline (?format=columnar, see
+// medications/columnar.py) back into the items the timeline renders
+export const decodeColumnarTimeline = (payload) => {
+    const { medications, strings, items: columns, dosages } = payload;
+    const base = payload.base_date ? Date.parse(`${payload.base_date}T00:00:00Z`) : 0;
+    const day = (offset) =>
+        offset === null ? null : new Date(base + offset * 86400000).toISOString().slice(0, 10);
+    const text = (index) => (index === null ? null : strings[index]);
+
+    const items = [];
+    for (let i = 0; i < payload.count; i++) {
+        const item = {
+            id: columns.id[i],
+            medication: medications[columns.medication[i]],
+            start_date: day(columns.start[i]),
+            end_date: day(columns.end[i]),
+            natural_end_date: day(columns.natural_end[i]),
+            is_truncated: columns.is_truncated[i] === 1,
+            dosages: [],
+            notes: text(columns.notes[i]),
+        };
+        if (columns.lane) item.lane = columns.lane[i];
+        items.push(item);
+    }
+
+    dosages.item.forEach((position, row) => {
+        items[position].dosages.push({
+            dose: text(dosages.dose[row]),
+            frequency: text(dosages.frequency[row]),
+            route: text(dosages.route[row]),
+            duration: text(dosages.duration[row]),
+            start_date: day(dosages.start[row]),
+            end_date: day(dosages.end[row]),
+            dose_amount: dosages.dose_amount[row],
+            dose_unit: text(dosages.dose_unit[row]),
+            doses_per_day: dosages.doses_per_day[row],
+            daily_amount: dosages.daily_amount[row],
+        });
+    });
+    return items;
+};
+
 /**
  * Stack overlapping meds into rows
  * Same medications stay on same row (old gets truncated), different meds stack
+ * Items fetched with ?lanes=1 already carry a packed row from the server;
+ * this is only the fallback for items merged in locally without one
  */
 const assignRows = (items) => {
+    if (items.every((item) => item.lane !== undefined)) {
+        items.forEach((item) => {
+            item._row = item.lane;
+        });
+        return;
+    }
+
     const medRowMap = {};
     const rows = [];
 
@@ -230,6 +281,7 @@ const Timeline = ({ items, daysAfter = 14, apiUrl, onPrescriptionDeleted }) => {
                                         <li key={idx}>
                                             <strong>{dosage.dose}</strong> - {dosage.frequency} ({dosage.route})
                                             {dosage.duration && <span> for {formatDuration(dosage.duration)}</span>}
+                                            {dosage.start_date && <span> ({dosage.start_date} → {dosage.end_date})</span>}
                                         </li>
                                     ))}
                                 </ul>